@@ -1,4 +1,7 @@
 # flake8: noqa
+import os as _os
+
+from . import trace as _trace
 from .ansible.deploy import *
 from .ansible.vars import *
 from .image import *
@@ -6,4 +9,8 @@ from .info import *
 from .pod import *
 from .providers.aws import *
 from .providers.gcp import *
+from .trace import profile
 from .utils import *
+
+if _os.environ.get("KUBESAE_PROFILE"):
+    _trace.enable(_os.environ["KUBESAE_PROFILE"])
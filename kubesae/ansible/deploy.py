@@ -1,23 +1,167 @@
+import concurrent.futures
+import hashlib
+import io
+import json
 import os
+import sys
+import tempfile
+import threading
+import time
 
 from pathlib import Path
 
 import invoke
 
+from kubesae import kube
+from kubesae.ansible import vars as ansible_vars
+
+PAUSE_IMAGE = "registry.k8s.io/pause:3.9"
+# saved in the roles directory, so removing it forces a reinstall
+REQUIREMENTS_STAMP = ".kubesae-requirements.json"
+
+
+def requirements_state(requirements, roles_path):
+    """Return a digest of a requirements file and the versions of the installed roles."""
+    import yaml
+
+    with open(requirements, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    roles = {}
+    if os.path.isdir(roles_path):
+        for entry in sorted(os.scandir(roles_path), key=lambda entry: entry.name):
+            if not entry.is_dir():
+                continue
+            try:
+                with open(
+                    os.path.join(entry.path, "meta", ".galaxy_install_info")
+                ) as f:
+                    roles[entry.name] = (yaml.safe_load(f) or {}).get("version")
+            except (OSError, yaml.YAMLError, AttributeError):
+                roles[entry.name] = None
+    return {"requirements": digest, "roles": roles}
+
+
+def read_requirements_stamp(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_requirements_stamp(path, state):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def split_requirements(requirements):
+    """Return the role entries of a requirements file, or None if they can't be
+    installed one by one (the file includes others or has collections)."""
+    import yaml
+
+    with open(requirements) as f:
+        data = yaml.safe_load(f) or []
+    if isinstance(data, dict):
+        if data.get("collections"):
+            return None
+        data = data.get("roles") or []
+    if not isinstance(data, list) or any(
+        isinstance(role, dict) and "include" in role for role in data
+    ):
+        return None
+    return data
+
+
+def install_roles(c, roles, workers, req_file):
+    """Install roles concurrently, one ansible-galaxy process per role.
+
+    The roles are installed without their dependencies, since roles sharing a
+    dependency would install it at the same time. The dependencies are installed
+    afterwards by a single ansible-galaxy run over the whole requirements file, which
+    skips the roles that are already there.
+    """
+    import yaml
+
+    def install(role):
+        start = time.monotonic()
+        with tempfile.NamedTemporaryFile("w", suffix=".yml", delete=False) as f:
+            yaml.safe_dump([role], f)
+        try:
+            result = c.run(
+                f"ansible-galaxy install -f --no-deps -r '{f.name}' -p roles/",
+                hide=True,
+                warn=True,
+            )
+        finally:
+            os.unlink(f.name)
+        return result, time.monotonic() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(role, executor.submit(install, role)) for role in roles]
+
+    failed = False
+    print(f"{'ROLE':<60} {'INSTALLED':>9}")
+    for role, future in futures:
+        name = role if isinstance(role, str) else role.get("name") or role.get("src")
+        result, seconds = future.result()
+        if result.failed:
+            failed = True
+            print(f"{name:<60} failed:\n{result.stderr or result.stdout}")
+        else:
+            print(f"{name:<60} {seconds:>8.1f}s")
+    if failed:
+        raise invoke.exceptions.Exit(code=1)
+    start = time.monotonic()
+    result = c.run(
+        f"ansible-galaxy install -r '{req_file}' -p roles/", hide=True, warn=True
+    )
+    if result.failed:
+        print(f"{'(dependencies)':<60} failed:\n{result.stderr or result.stdout}")
+        raise invoke.exceptions.Exit(code=1)
+    print(f"{'(dependencies)':<60} {time.monotonic() - start:>8.1f}s")
+
 
 @invoke.task
-def install_requirements(c):
+def install_requirements(c, force=False, workers=4):
     """Install ansible-galaxy requirements.yml
 
-    Usage: inv deploy.install
+    Skipped when neither the requirements file nor the roles installed in
+    ``deploy/roles/`` changed since the last install. Otherwise the roles are
+    reinstalled, ``workers`` at a time, and then their dependencies in one go.
+
+    Params:
+        force: Reinstall the requirements even if nothing changed
+        workers: How many roles to install at once (default: 4)
+
+    Usage: inv deploy.install [--force]
     """
     req_file = (
         "requirements.yml"
         if os.path.exists("deploy/requirements.yml")
         else "requirements.yaml"
     )
+    requirements = os.path.join("deploy", req_file)
+    roles_path = os.path.join("deploy", "roles")
+    stamp = os.path.join(roles_path, REQUIREMENTS_STAMP)
+    if not os.path.exists(requirements):
+        # let ansible-galaxy report it
+        with c.cd("deploy/"):
+            c.run(f"ansible-galaxy install -f -r '{req_file}' -p roles/")
+        return
+    if not force and read_requirements_stamp(stamp) == requirements_state(
+        requirements, roles_path
+    ):
+        print("Ansible requirements are up to date.")
+        return
+    roles = split_requirements(requirements)
     with c.cd("deploy/"):
-        c.run(f"ansible-galaxy install -f -r '{req_file}' -p roles/")
+        if roles is None or len(roles) < 2 or workers < 2:
+            c.run(f"ansible-galaxy install -f -r '{req_file}' -p roles/")
+        else:
+            install_roles(c, roles, workers, req_file)
+    os.makedirs(roles_path, exist_ok=True)
+    write_requirements_stamp(stamp, requirements_state(requirements, roles_path))
 
 
 def get_verbosity_flag(verbosity):
@@ -32,8 +176,76 @@ def get_verbosity_flag(verbosity):
     return v_flag
 
 
+def prepull_image(c, image, timeout=300):
+    """Pull an image onto every node of the cluster with a short-lived DaemonSet.
+
+    Prints how long each node took. Nodes still pulling after ``timeout`` seconds are
+    reported and left to finish during the deploy, but a node failing to pull the image
+    fails the task.
+    """
+    namespace = c.config.namespace
+    # named after the image, so a DaemonSet left by an interrupted run is picked up again
+    name = f"kubesae-prepull-{hashlib.sha256(image.encode()).hexdigest()[:10]}"
+    daemonset = kube.prepull_daemonset(
+        name,
+        image,
+        c.config.get("deploy_prepull_pause_image", PAUSE_IMAGE),
+        c.config.get("deploy_prepull_pull_secrets", []),
+    )
+    print(f"Pre-pulling {image} onto the cluster's nodes")
+    start = time.monotonic()
+
+    def api(client):
+        path = f"/apis/apps/v1/namespaces/{namespace}/daemonsets"
+        try:
+            client.create(path, daemonset)
+        except kube.KubeApiError as e:
+            if e.status != 409:
+                raise
+        try:
+            return kube.wait_for_prepull(
+                client, namespace, name, start + timeout, start
+            )
+        finally:
+            client.delete(f"{path}/{name}", propagationPolicy="Background")
+
+    def kubectl():
+        kubectl = kube.kubectl(c)
+        c.run(
+            f"{kubectl} apply -n {namespace} -f -",
+            in_stream=io.StringIO(json.dumps(daemonset)),
+        )
+        try:
+            c.run(
+                f"{kubectl} rollout status -n {namespace} daemonset/{name} "
+                f"--timeout={timeout}s",
+                warn=True,
+            )
+        finally:
+            c.run(f"{kubectl} delete -n {namespace} daemonset/{name} --wait=false")
+
+    nodes = kube.api_or_kubectl(c, api, kubectl)
+    if nodes is None:
+        return
+    failed = False
+    print(f"\n{'NODE':<50} {'PULLED':>8}")
+    for node, (seconds, error) in sorted(nodes.items()):
+        if error:
+            failed = True
+            print(f"{node:<50} failed: {error}")
+        elif seconds is None:
+            print(f"{node:<50} still pulling after {timeout}s")
+        else:
+            print(f"{node:<50} {seconds:>7.1f}s")
+    print(f"Pre-pulled in {time.monotonic() - start:.1f}s\n")
+    if failed:
+        raise invoke.exceptions.Exit(code=1)
+
+
 @invoke.task(pre=[install_requirements], default=True)
-def ansible_deploy(c, env=None, tag=None, verbosity=1):
+def ansible_deploy(
+    c, env=None, tag=None, verbosity=1, prepull=False, prepull_timeout=300
+):
     """Deploy K8s application.
 
     WARNING: if you are running this in CI, make sure to set `--verbosity=0` to prevent
@@ -43,18 +255,27 @@ def ansible_deploy(c, env=None, tag=None, verbosity=1):
         env: The target ansible host ("staging", "production", etc ...)
         tag: Image tag to deploy (default: same as default tag for build & push)
         verbosity: integer level of verbosity from 0 to 4 (most verbose)
+        deploy_prepull: Pre-pull the image before every deploy (default: False)
+        deploy_prepull_pull_secrets: Image pull secrets the pre-pull DaemonSet needs
+        deploy_prepull_pause_image: The DaemonSet's main container image
+            (default: registry.k8s.io/pause:3.9)
 
     Params:
         env: The target ansible host ("staging", "production", etc ...)
         tag: Image tag to deploy (default: same as default tag for build & push)
         verbosity: integer level of verbosity from 0 to 4 (most verbose)
+        prepull: Pull the image onto every node with a short-lived DaemonSet first, so
+            the rollout doesn't wait for pulls
+        prepull_timeout: Seconds to wait for the nodes to pull the image (default: 300)
 
-    Usage: inv deploy.deploy --env=<ENVIRONMENT> --tag=<TAG> --verbosity=<VERBOSITY>
+    Usage: inv deploy.deploy --env=<ENVIRONMENT> --tag=<TAG> --verbosity=<VERBOSITY> [--prepull]
     """
     if env is None:
         env = c.config.env
     if tag is None:
         tag = c.config.tag
+    if prepull or c.config.get("deploy_prepull", False):
+        prepull_image(c, f"{c.config.repository}:{tag}", prepull_timeout)
     playbook = "deploy.yaml" if os.path.exists("deploy/deploy.yaml") else "deploy.yml"
     v_flag = get_verbosity_flag(verbosity)
     with c.cd("deploy/"):
@@ -63,6 +284,134 @@ def ansible_deploy(c, env=None, tag=None, verbosity=1):
         )
 
 
+class PrefixedWriter:
+    """A stream that writes whole lines to another stream, each with a prefix, so the
+    output of concurrent commands can be told apart."""
+
+    def __init__(self, prefix, stream, lock):
+        self.prefix = prefix
+        self.stream = stream
+        self.lock = lock
+        self.buffer = ""
+
+    def write(self, text):
+        self.buffer += text
+        *lines, self.buffer = self.buffer.split("\n")
+        if lines:
+            with self.lock:
+                for line in lines:
+                    self.stream.write(f"{self.prefix}{line}\n")
+        return len(text)
+
+    def flush(self):
+        # invoke flushes after every chunk, which may end mid-line
+        with self.lock:
+            self.stream.flush()
+
+    def close(self):
+        if self.buffer:
+            with self.lock:
+                self.stream.write(f"{self.prefix}{self.buffer}\n")
+                self.stream.flush()
+            self.buffer = ""
+
+
+def env_context(c, env, lock):
+    """Return a context for deploying to ``env``, with its ``deploy_environments``
+    settings and output prefixed by its name."""
+    config = c.config.clone()
+    for key, value in (c.config.get("deploy_environments") or {}).get(env, {}).items():
+        config[key] = value
+    config.env = env
+    config.run.pty = False
+    config.run.out_stream = PrefixedWriter(f"[{env}] ", sys.stdout, lock)
+    config.run.err_stream = PrefixedWriter(f"[{env}] ", sys.stderr, lock)
+    return invoke.Context(config=config)
+
+
+@invoke.task(pre=[install_requirements], iterable=["env"])
+def deploy_many(
+    c,
+    env=None,
+    group=None,
+    tag=None,
+    workers=4,
+    verbosity=0,
+    prepull=False,
+    prepull_timeout=300,
+):
+    """Deploy the same tag to several environments at once.
+
+    Each environment runs the deploy playbook in its own context, with its output prefixed
+    by its name, ``workers`` at a time. A failing environment doesn't stop the others, and
+    a summary of the results is printed at the end.
+
+    Config:
+        deploy_environments: Settings to override per environment, e.g.
+            ``{"client-a": {"namespace": "client-a", "kube": {"context": "cluster-2"}}}``
+
+    Params:
+        env: The target ansible hosts: repeat the option or separate them with commas
+        group: An inventory group to deploy all the hosts of
+        tag: Image tag to deploy (default: same as default tag for build & push)
+        workers: How many environments to deploy at once (default: 4)
+        verbosity: integer level of verbosity from 0 to 4 (most verbose)
+        prepull: Pre-pull the image in each environment's cluster first
+        prepull_timeout: Seconds to wait for the nodes to pull the image (default: 300)
+
+    Usage: inv deploy.deploy-many --group=<GROUP> --tag=<TAG>
+    """
+    envs = [name.strip() for x in env or [] for name in x.split(",") if name.strip()]
+    if group:
+        inventory = ansible_vars.Inventory.load(ansible_vars.find_inventory("deploy"))
+        envs += [x for x in inventory.group_hosts(group) if x not in envs]
+    if not envs:
+        raise invoke.exceptions.Exit("No environments to deploy: use --env or --group.")
+    if tag is None:
+        tag = c.config.tag
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def run(env):
+        context = env_context(c, env, lock)
+        started = time.monotonic()
+        try:
+            ansible_deploy(
+                context,
+                env=env,
+                tag=tag,
+                verbosity=verbosity,
+                prepull=prepull,
+                prepull_timeout=prepull_timeout,
+            )
+        finally:
+            context.config.run.out_stream.close()
+            context.config.run.err_stream.close()
+        return time.monotonic() - started
+
+    print(f"Deploying {tag} to {', '.join(envs)}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(env, executor.submit(run, env)) for env in envs]
+
+    failed = False
+    print(f"\n{'ENVIRONMENT':<30} {'RESULT':<10} {'TIME':>8}")
+    for env, future in futures:
+        try:
+            seconds = future.result()
+        except Exception as e:
+            failed = True
+            if isinstance(e, invoke.exceptions.UnexpectedExit):
+                reason = f"exit code {e.result.exited}"
+            else:
+                reason = str(e).strip().splitlines()[0] if str(e).strip() else repr(e)
+            print(f"{env:<30} {'failed':<10} {'-':>8}  {reason}")
+            continue
+        print(f"{env:<30} {'ok':<10} {seconds:>7.1f}s")
+    print(f"Deployed in {time.monotonic() - start:.1f}s")
+    if failed:
+        raise invoke.exceptions.Exit(code=1)
+
+
 def get_boto_env(profile_name):
     """
     Use an existing AWS_PROFILE to get the other AWS credentials that boto needs.
@@ -149,5 +498,6 @@ def ansible_db_restore(c, filename, name="", extra="", verbosity=0, limit=""):
 deploy = invoke.Collection("deploy")
 deploy.add_task(install_requirements, "install")
 deploy.add_task(ansible_deploy, "deploy")
+deploy.add_task(deploy_many, "deploy-many")
 deploy.add_task(ansible_playbook, "playbook")
 deploy.add_task(ansible_db_restore, "db-restore")
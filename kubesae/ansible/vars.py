@@ -1,101 +1,504 @@
 """Ansible vars module.
 
-Provides utilities to load host and group vars from Ansible.
+Resolves the variables of an inventory host in-process, without running a play: the
+inventory's group and host variables are merged with the ``group_vars`` and
+``host_vars`` files next to the inventory and the playbooks, with Ansible's precedence.
 
-Adoped from Ansible's Python API:
-    https://docs.ansible.com/ansible/latest/dev_guide/developing_api.html
+Values are only templated, and vault-encrypted values only decrypted, when they are
+read. Parsed files are cached by path and modification time for the whole ``inv`` run,
+so repeat lookups only stat the files.
+
+Config (read from ``deploy/ansible.cfg`` or the environment, as ansible does):
+
+    inventory / ANSIBLE_INVENTORY: The inventory file or directory (default: inventory)
+    vault_password_file / ANSIBLE_VAULT_PASSWORD_FILE: The vault password file, or a
+        script printing the password
 """
 
-import json
-import shutil
+import ast
+import collections.abc
+import configparser
+import os
+import subprocess
+import threading
 
 import invoke
 
-import ansible.constants as C
+VARS_EXTENSIONS = ("", ".yml", ".yaml", ".json")
+VAULT_HEADER = "$ANSIBLE_VAULT;"
+
+_files = {}
+_files_lock = threading.Lock()
+_loader = None
+
+
+class VarsError(invoke.exceptions.Exit):
+    """A variable couldn't be resolved."""
+
+    def __init__(self, message):
+        super().__init__(f"Ansible vars: {message}")
+
+    def __str__(self):
+        return self.message
+
+
+class VaultValue:
+    """A ``!vault`` encrypted value, decrypted when read."""
+
+    def __init__(self, ciphertext):
+        self.ciphertext = ciphertext
+
+    def __repr__(self):
+        return "VaultValue(...)"
+
+
+class UnsafeValue(str):
+    """An ``!unsafe`` string, which is never templated."""
+
+
+def parse_yaml(text, name):
+    """Parse YAML with Ansible's ``!vault`` and ``!unsafe`` tags."""
+    global _loader
+    import yaml
+
+    if _loader is None:
+
+        class VarsLoader(yaml.SafeLoader):
+            pass
+
+        VarsLoader.add_constructor(
+            "!vault", lambda loader, node: VaultValue(loader.construct_scalar(node))
+        )
+        VarsLoader.add_constructor(
+            "!unsafe", lambda loader, node: UnsafeValue(loader.construct_scalar(node))
+        )
+        _loader = VarsLoader
+    try:
+        return yaml.load(text, Loader=_loader)
+    except yaml.YAMLError as e:
+        raise VarsError(f"can't parse {name}: {e}")
+
+
+def read_config(path):
+    """Return the ``[defaults]`` of the ansible.cfg in ``path`` (or $ANSIBLE_CONFIG)."""
+    parser = configparser.ConfigParser(interpolation=None)
+    parser.read(os.environ.get("ANSIBLE_CONFIG") or os.path.join(path, "ansible.cfg"))
+    return dict(parser["defaults"]) if parser.has_section("defaults") else {}
+
+
+class Vault:
+    """Decrypts vault data with the password from a password file, read on first use."""
+
+    def __init__(self, password_file=None):
+        self.password_file = password_file
+        self._lib = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path):
+        password_file = os.environ.get("ANSIBLE_VAULT_PASSWORD_FILE")
+        if not password_file:
+            password_file = read_config(path).get("vault_password_file")
+            if password_file:
+                password_file = os.path.join(path, os.path.expanduser(password_file))
+        return cls(password_file)
 
-from ansible import context
-from ansible.executor.task_queue_manager import TaskQueueManager
-from ansible.inventory.manager import InventoryManager
-from ansible.module_utils._text import to_bytes
-from ansible.module_utils.common.collections import ImmutableDict
-from ansible.parsing.dataloader import DataLoader
-from ansible.parsing.vault import VaultSecret
-from ansible.playbook.play import Play
-from ansible.plugins.callback import CallbackBase
-from ansible.vars.manager import VariableManager
+    def password(self):
+        if not self.password_file:
+            raise VarsError(
+                "a vault password is needed: set ANSIBLE_VAULT_PASSWORD_FILE or "
+                "vault_password_file in ansible.cfg"
+            )
+        try:
+            if os.access(self.password_file, os.X_OK):
+                result = subprocess.run(
+                    [self.password_file], capture_output=True, check=True
+                )
+                return result.stdout.strip()
+            with open(self.password_file, "rb") as f:
+                return f.read().strip()
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise VarsError(f"can't read the vault password ({e})")
 
+    def decrypt(self, data):
+        with self._lock:
+            if self._lib is None:
+                from ansible.parsing.vault import VaultLib, VaultSecret
 
-class ResultCallback(CallbackBase):
-    """A sample callback plugin used for performing an action as results come in
+                self._lib = VaultLib([("default", VaultSecret(self.password()))])
+        try:
+            return self._lib.decrypt(data).decode()
+        except Exception as e:
+            raise VarsError(f"can't decrypt vault data ({e})")
 
-    If you want to collect all results into a single object for processing at
-    the end of the execution, look into utilizing the ``json`` callback plugin
-    or writing your own custom callback plugin
+
+def load_file(path, vault=None):
+    """Parse a YAML (or JSON) vars file, decrypting it first if it's vault-encrypted.
+
+    Files are cached by path, size and modification time.
     """
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    with _files_lock:
+        cached = _files.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(path) as f:
+        text = f.read()
+    if text.startswith(VAULT_HEADER):
+        if vault is None:
+            raise VarsError(f"{path} is vault-encrypted")
+        text = vault.decrypt(text)
+    data = parse_yaml(text, path)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        raise VarsError(f"{path} doesn't contain a mapping of variables")
+    with _files_lock:
+        _files[path] = (key, data)
+    return data
+
+
+def vars_files(directory, name):
+    """Return the files holding the vars of a group or host, as Ansible finds them:
+    ``<name>``, ``<name>.yml`` and so on, or the files in a ``<name>`` directory."""
+    paths = []
+    for extension in VARS_EXTENSIONS:
+        path = os.path.join(directory, f"{name}{extension}")
+        if os.path.isfile(path):
+            paths.append(path)
+        elif extension == "" and os.path.isdir(path):
+            for root, directories, files in os.walk(path):
+                directories.sort()
+                for filename in sorted(files):
+                    if os.path.splitext(filename)[1] in VARS_EXTENSIONS:
+                        paths.append(os.path.join(root, filename))
+    return paths
+
 
-    def v2_runner_on_ok(self, result, **kwargs):
-        """Print a json representation of the result
+class Inventory:
+    """The groups, hosts and variables of an INI or YAML inventory."""
 
-        This method could store the result in an instance attribute for retrieval later
+    def __init__(self):
+        self.children = collections.defaultdict(set)
+        self.hosts = collections.defaultdict(set)
+        self.group_vars = collections.defaultdict(dict)
+        self.host_vars = collections.defaultdict(dict)
+
+    @classmethod
+    def load(cls, path):
+        """Parse an inventory file, or the files in an inventory directory.
+
+        Inventories are cached by their files' paths and modification times.
         """
-        host = result._host
-        print(json.dumps({host.name: result._result}, indent=4))
+        if not os.path.exists(path):
+            raise VarsError(f"no inventory at {path}")
+        paths = [path]
+        if os.path.isdir(path):
+            paths = [
+                os.path.join(path, x)
+                for x in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, x))
+                and not x.startswith(".")
+                and not x.endswith((".cfg", ".retry", ".pyc", "~"))
+            ]
+        key = tuple((x, os.stat(x).st_mtime_ns, os.stat(x).st_size) for x in paths)
+        with _files_lock:
+            cached = _files.get(("inventory", path))
+        if cached and cached[0] == key:
+            return cached[1]
+        inventory = cls()
+        for inventory_file in paths:
+            with open(inventory_file) as f:
+                text = f.read()
+            if os.path.splitext(inventory_file)[1] in (".yml", ".yaml", ".json"):
+                inventory.parse_yaml("all", parse_yaml(text, inventory_file) or {})
+            else:
+                inventory.parse_ini(text)
+        with _files_lock:
+            _files[("inventory", path)] = (key, inventory)
+        return inventory
 
+    def parse_ini(self, text):
+        group, section = "ungrouped", "hosts"
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith(("#", ";")):
+                continue
+            if line.startswith("[") and line.endswith("]"):
+                group, _, section = line[1:-1].partition(":")
+                section = section or "hosts"
+                if group not in ("all", "ungrouped"):
+                    self.children["all"].add(group)
+                continue
+            if section == "vars":
+                key, _, value = line.partition("=")
+                self.group_vars[group][key.strip()] = value.strip()
+            elif section == "children":
+                self.children[group].add(line.split()[0])
+            else:
+                host, *assignments = line.split()
+                self.hosts[group].add(host)
+                for assignment in assignments:
+                    key, _, value = assignment.partition("=")
+                    self.host_vars[host][key] = parse_ini_value(value)
 
-# since the API is constructed for CLI it expects certain options to always
-# be set in the context object
-context.CLIARGS = ImmutableDict(
-    connection="local",
-    module_path=["/to/mymodules"],
-    forks=10,
-    become=None,
-    become_method=None,
-    become_user=None,
-    check=False,
-    diff=False,
-)
+    def parse_yaml(self, group, data):
+        data = data or {}
+        if group == "all" and "all" not in data and "hosts" not in data:
+            for name, child in data.items():
+                self.parse_yaml(name, child)
+                if name != "all":
+                    self.children["all"].add(name)
+            return
+        if group == "all" and "all" in data:
+            data = data["all"] or {}
+        for host, host_vars in (data.get("hosts") or {}).items():
+            self.hosts[group].add(host)
+            self.host_vars[host].update(host_vars or {})
+        self.group_vars[group].update(data.get("vars") or {})
+        for name, child in (data.get("children") or {}).items():
+            self.children[group].add(name)
+            self.parse_yaml(name, child)
 
-loader = DataLoader()
-# Instantiate our ResultCallback for handling results as they come in. Ansible
-# expects this to be one of its main display outlets
-results_callback = ResultCallback()
+    def all_hosts(self):
+        return sorted(set().union(*self.hosts.values()) if self.hosts else ())
 
+    def group_hosts(self, group):
+        """Return the hosts in a group or its children, sorted."""
+        if group == "all":
+            return self.all_hosts()
+        hosts, stack, seen = set(), [group], set()
+        while stack:
+            name = stack.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            hosts |= self.hosts.get(name, set())
+            stack.extend(self.children.get(name, ()))
+        return sorted(hosts)
 
-@invoke.task
-def play_vars(ctx):
-    # create inventory, use path to host config file as source or hosts in a comma
-    # separated string
-    inventory = InventoryManager(loader=loader, sources="inventory")
-    # variable manager takes care of merging all the different sources to give you
-    # a unified view of variables available in each context
-    variable_manager = VariableManager(loader=loader, inventory=inventory)
-    # create data structure that represents our play, including tasks, this is basically
-    # what our YAML loader does internally.
-    play_source = dict(name="Ansible Play", hosts="all", gather_facts="no", tasks=[])
-    loader.set_vault_secrets([("default", VaultSecret(_bytes=to_bytes("TBD")))])
-    # Create play object, playbook objects use .load instead of init or new methods,
-    # this will also automatically create the task objects from the info provided
-    # in play_source
-    play = Play().load(play_source, variable_manager=variable_manager, loader=loader)
-    tqm = None
+    def host_groups(self, host):
+        """Return the groups a host belongs to, in the order their vars apply: by depth
+        under ``all``, then name."""
+        depths, stack = {"all": 0}, ["all"]
+        while stack:
+            group = stack.pop()
+            for child in self.children[group]:
+                if depths.get(child, -1) < depths[group] + 1:
+                    depths[child] = depths[group] + 1
+                    stack.append(child)
+        parents = collections.defaultdict(set)
+        for group, children in list(self.children.items()):
+            for child in children:
+                parents[child].add(group)
+        groups = {group for group, hosts in self.hosts.items() if host in hosts}
+        if not groups - {"all", "ungrouped"}:
+            groups.add("ungrouped")
+        stack = list(groups)
+        while stack:
+            for parent in parents[stack.pop()]:
+                if parent not in groups:
+                    groups.add(parent)
+                    stack.append(parent)
+        groups.add("all")
+        return sorted(groups, key=lambda group: (depths.get(group, 1), group))
+
+
+def parse_ini_value(value):
+    """Inline host variables in INI inventories are Python literals, or strings."""
     try:
-        tqm = TaskQueueManager(
-            inventory=inventory,
-            variable_manager=variable_manager,
-            loader=loader,
-            passwords=dict(),
-            # Use our custom callback instead of the ``default`` callback
-            # plugin, which prints to stdout
-            stdout_callback=results_callback,
-        )
-        # most interesting data for a play is actually
-        # sent to the callback's methods
-        tqm.run(play)
-    finally:
-        # we always need to cleanup child procs and the structures we use to
-        # communicate with them
-        if tqm is not None:
-            tqm.cleanup()
-        # Remove ansible tmpdir
-        shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
-    ctx.hostvars = variable_manager.get_vars()["hostvars"]
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+class HostVars(collections.abc.Mapping):
+    """The variables of one host, resolved from lowest to highest precedence layers.
+
+    Layers are functions returning a dict, called the first time a variable might be
+    in them. Values are templated with the host's other variables when read.
+    """
+
+    def __init__(self, host, layers, vault=None):
+        self.host = host
+        self.vault = vault
+        self._layers = layers
+        self._loaded = {}
+        self._values = {}
+        self._resolving = set()
+        self._environment = None
+
+    def layer(self, index):
+        if index not in self._loaded:
+            self._loaded[index] = self._layers[index]()
+        return self._loaded[index]
+
+    def raw(self, key):
+        """Return a variable's value without templating or decrypting it."""
+        for index in reversed(range(len(self._layers))):
+            layer = self.layer(index)
+            if key in layer:
+                return layer[key]
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key in self._resolving:
+                raise VarsError(f"{key} is defined in terms of itself")
+            value = self.raw(key)
+            self._resolving.add(key)
+            try:
+                self._values[key] = self.render(value)
+            finally:
+                self._resolving.discard(key)
+        return self._values[key]
+
+    def __iter__(self):
+        keys = {}
+        for index in range(len(self._layers)):
+            keys.update(dict.fromkeys(self.layer(index)))
+        return iter(keys)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def render(self, value):
+        """Decrypt and template a value, recursively."""
+        if isinstance(value, VaultValue):
+            if self.vault is None:
+                raise VarsError("can't decrypt a vault value without a vault password")
+            value = self.vault.decrypt(value.ciphertext)
+        if isinstance(value, dict):
+            return {k: self.render(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.render(v) for v in value]
+        if isinstance(value, UnsafeValue):
+            return str(value)
+        if isinstance(value, str) and ("{{" in value or "{%" in value):
+            return self.template(value)
+        return value
+
+    def environment(self, ansible_filters=False):
+        """Return the Jinja environment, adding Ansible's filters when asked to, since
+        importing them takes a while."""
+        import jinja2
+        import jinja2.nativetypes
+
+        if self._environment is None:
+            self._environment = jinja2.nativetypes.NativeEnvironment(
+                undefined=jinja2.StrictUndefined
+            )
+        if ansible_filters and "to_json" not in self._environment.filters:
+            from ansible.plugins.filter.core import FilterModule
+
+            self._environment.filters.update(FilterModule().filters())
+        return self._environment
+
+    def template(self, text):
+        """Render a template with Jinja's native types, as Ansible does: a lone
+        expression keeps its type."""
+        import jinja2
+        import jinja2.nativetypes
+
+        try:
+            template = self.environment().from_string(text)
+        except jinja2.TemplateAssertionError:
+            # most likely a filter of Ansible's
+            template = self.environment(ansible_filters=True).from_string(text)
+        # share this mapping as the context, so only the variables used are resolved
+        context = template.new_context(self, shared=True)
+        try:
+            value = jinja2.nativetypes.native_concat(template.root_render_func(context))
+            if isinstance(value, jinja2.Undefined):
+                value._fail_with_undefined_error()
+        except jinja2.UndefinedError as e:
+            raise VarsError(f"{text}: {e.message}")
+        return value
+
+
+def find_inventory(path):
+    """Return the inventory path set by $ANSIBLE_INVENTORY or ansible.cfg."""
+    inventory = os.environ.get("ANSIBLE_INVENTORY") or read_config(path).get(
+        "inventory", "inventory"
+    )
+    return os.path.join(path, os.path.expanduser(inventory))
+
+
+def resolve_host_vars(path, host, extra_files=()):
+    """Return the variables of an inventory host.
+
+    Params:
+        path (str): The directory with the playbooks and ansible.cfg (e.g. "deploy")
+        host (str): The inventory host, such as "staging"
+        extra_files (list): Vars files applied last, as with ``-e @<file>``
+    """
+    inventory_path = find_inventory(path)
+    inventory = Inventory.load(inventory_path)
+    vault = Vault.from_config(path)
+    inventory_dir = (
+        inventory_path
+        if os.path.isdir(inventory_path)
+        else os.path.dirname(inventory_path)
+    )
+    # group_vars and host_vars next to the inventory, then next to the playbooks
+    directories = [inventory_dir]
+    if os.path.realpath(inventory_dir) != os.path.realpath(path):
+        directories.append(path)
+    groups = inventory.host_groups(host)
+    other_groups = [group for group in groups if group != "all"]
+
+    def files(kind, names):
+        def load():
+            merged = {}
+            for directory in directories:
+                for name in names:
+                    for vars_file in vars_files(os.path.join(directory, kind), name):
+                        merged.update(load_file(vars_file, vault))
+            return merged
+
+        return load
+
+    def inventory_vars(names):
+        def load():
+            merged = {}
+            for name in names:
+                merged.update(inventory.group_vars.get(name, {}))
+            return merged
+
+        return load
+
+    def extra():
+        merged = {}
+        for extra_file in extra_files:
+            merged.update(load_file(os.path.join(path, extra_file), vault))
+        return merged
+
+    layers = [
+        inventory_vars(["all"]),
+        files("group_vars", ["all"]),
+        inventory_vars(other_groups),
+        files("group_vars", other_groups),
+        lambda: dict(inventory.host_vars.get(host, {})),
+        files("host_vars", [host]),
+        extra,
+        lambda: {
+            "inventory_hostname": host,
+            "group_names": [x for x in groups if x not in ("all", "ungrouped")],
+            "playbook_dir": os.path.abspath(path),
+        },
+    ]
+    return HostVars(host, layers, vault)
+
+
+@invoke.task
+def play_vars(ctx, path="."):
+    """Resolve the variables of every inventory host into ``ctx.hostvars``.
+
+    Params:
+        path: The directory with the inventory and playbooks (default: the current one)
+    """
+    inventory = Inventory.load(find_inventory(path))
+    ctx.hostvars = {
+        host: resolve_host_vars(path, host) for host in inventory.all_hosts()
+    }
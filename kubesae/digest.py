@@ -0,0 +1,206 @@
+"""Build context digest module.
+
+Computes a deterministic digest of what ``docker build`` would be given: the Dockerfile,
+the build target and the context files that ``.dockerignore`` lets through. Images are
+labeled with it, so an image built from the same inputs can be found and reused.
+
+File hashes are cached on disk by size, mtime and inode, so repeat runs only read the
+files that changed.
+"""
+
+import hashlib
+import json
+import os
+import re
+import stat
+import time
+
+from kubesae import s3
+
+LABEL = "kubesae.context-digest"
+CACHE_VERSION = 1
+# files modified this close to when the cache is saved may change again unnoticed
+RACY_SECONDS = 2
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_ignore_file(path):
+    """Return the patterns in a .dockerignore file as ``(regex, exception)`` pairs."""
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    patterns = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        exception = line.startswith("!")
+        if exception:
+            line = line[1:].strip()
+        line = os.path.normpath(line).lstrip("/")
+        if line == ".":
+            continue
+        patterns.append((compile_pattern(line), exception))
+    return patterns
+
+
+def compile_pattern(pattern):
+    """Translate a .dockerignore pattern into a regex, as Docker does.
+
+    ``*`` and ``?`` don't match ``/``, ``**`` matches any number of directories and
+    ``[...]`` is a character class, ``^`` negating it.
+    """
+    regex, index = "^", 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**", index):
+            index += 2
+            if pattern.startswith("/", index):
+                regex += "(.*/)?"
+                index += 1
+            else:
+                regex += ".*"
+            continue
+        if char == "*":
+            regex += "[^/]*"
+        elif char == "?":
+            regex += "[^/]"
+        elif char == "\\" and index + 1 < len(pattern):
+            index += 1
+            regex += re.escape(pattern[index])
+        elif char == "[":
+            end = pattern.find("]", index + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                body = pattern[index + 1 : end]
+                if body.startswith("^") or body.startswith("!"):
+                    body = "^" + body[1:]
+                regex += f"[{body}]"
+                index = end
+        else:
+            regex += re.escape(char)
+        index += 1
+    return re.compile(regex + "$")
+
+
+def is_ignored(patterns, name):
+    """Whether a context path is excluded, i.e. the last pattern matching it or one of
+    its parent directories isn't an exception."""
+    parents = []
+    parts = name.split("/")
+    for depth in range(1, len(parts)):
+        parents.append("/".join(parts[:depth]))
+    ignored = False
+    for regex, exception in patterns:
+        # an exception only matters once a path is ignored, and vice versa
+        if exception != ignored:
+            continue
+        if regex.match(name) or any(regex.match(parent) for parent in parents):
+            ignored = not exception
+    return ignored
+
+
+def walk_context(path, patterns):
+    """Yield the ``(name, stat)`` of each file, link and directory sent to Docker."""
+    can_reinclude = any(exception for _, exception in patterns)
+    stack = [""]
+    while stack:
+        directory = stack.pop()
+        with os.scandir(os.path.join(path, directory)) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            name = f"{directory}{entry.name}"
+            ignored = is_ignored(patterns, name)
+            if entry.is_dir(follow_symlinks=False):
+                if ignored and not can_reinclude:
+                    continue
+                stack.append(f"{name}/")
+            if not ignored:
+                yield name, entry.stat(follow_symlinks=False)
+
+
+class HashCache:
+    """SHA-256 hashes of the files in a build context, cached by their stat data."""
+
+    def __init__(self, context, path=None):
+        self.context = os.path.abspath(context)
+        digest = hashlib.sha256(self.context.encode()).hexdigest()
+        self.path = os.path.join(
+            path or s3.default_cache_dir("context"), f"{digest}.json"
+        )
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+        self.cached = (
+            state.get("files", {}) if state.get("version") == CACHE_VERSION else {}
+        )
+        self.files = {}
+        self.hashed = 0
+
+    def file_hash(self, name, st):
+        key = [st.st_size, st.st_mtime_ns, st.st_ino]
+        cached = self.cached.get(name)
+        if cached and cached[:3] == key:
+            sha = cached[3]
+        else:
+            sha = file_sha256(os.path.join(self.context, name))
+            self.hashed += 1
+        if st.st_mtime < time.time() - RACY_SECONDS:
+            self.files[name] = key + [sha]
+        return sha
+
+    def save(self):
+        """Save the hashes of the files seen since this cache was loaded."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump({"version": CACHE_VERSION, "files": self.files}, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+def context_digest(
+    context=".", dockerfile="Dockerfile", target=None, cache_dir=None, depends_on=()
+):
+    """Return the digest of a build, and the number of files whose contents were read.
+
+    Params:
+        context (str): The build context directory
+        dockerfile (str): The Dockerfile, relative to the current directory
+        target (str): The build stage, if any
+        cache_dir (str): Where to cache file hashes (default: ~/.cache/kubesae/context)
+        depends_on (list): The digests of the builds whose images this one uses
+    """
+    ignore_file = f"{dockerfile}.dockerignore"
+    if not os.path.exists(ignore_file):
+        ignore_file = os.path.join(context, ".dockerignore")
+    patterns = read_ignore_file(ignore_file)
+    cache = HashCache(context, cache_dir)
+    digest = hashlib.sha256()
+    digest.update(f"dockerfile {file_sha256(dockerfile)}\n".encode())
+    digest.update(f"target {target or ''}\n".encode())
+    for dependency in depends_on:
+        digest.update(f"depends {dependency}\n".encode())
+    for name, st in walk_context(cache.context, patterns):
+        mode = st.st_mode & 0o7777
+        if stat.S_ISDIR(st.st_mode):
+            line = f"dir {mode:o} {name}"
+        elif stat.S_ISLNK(st.st_mode):
+            line = f"link {name} {os.readlink(os.path.join(cache.context, name))}"
+        elif stat.S_ISREG(st.st_mode):
+            line = f"file {mode:o} {name} {cache.file_hash(name, st)}"
+        else:
+            continue
+        digest.update(line.encode("utf-8", "surrogateescape") + b"\n")
+    cache.save()
+    return digest.hexdigest(), cache.hashed
@@ -0,0 +1,823 @@
+"""Git module.
+
+Reads the branch, abbreviated commit and dirty state that ``image.generate_tag`` needs
+straight from the ``.git`` directory, without running git.
+
+The dirty check stops at the first difference it finds. Tracked files are compared by
+their stat data in the index, and only read when that has changed. Staged changes are
+found by comparing the index's cached tree with HEAD's, and untracked files with the
+index's untracked cache (``git config core.untrackedCache true``), so a clean tree is
+confirmed without walking it. For large indexes, where git stats files faster than
+Python can, ``git status`` runs alongside the scan, and the first to answer is used.
+Parts of a repository this module doesn't read raise
+``GitUnsupported``, or are handed to a narrow git command, so results always match git's.
+"""
+
+import collections
+import configparser
+import contextlib
+import hashlib
+import itertools
+import mmap
+import os
+import stat
+import struct
+import subprocess
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+EMPTY_BLOB = "e69de29bb2d1d6434b8b29ae775ad8c2e48c5391"
+NANOSECONDS = 10**9
+NULL_SHA = b"\0" * 20
+# like git's core.preloadIndex: stat files ahead of the comparison, on threads
+PRELOAD_CHUNK = 500
+PRELOAD_THREADS = 20
+# from this many index entries git status confirms a clean tree faster than the scan
+# here; it's polled every GIT_STATUS_POLL entries while the scan runs alongside
+GIT_STATUS_ENTRIES = 2000
+GIT_STATUS_POLL = 50
+
+INDEX_ENTRY = struct.Struct(">10I20sH")
+STAT_DATA = struct.Struct(">9I")
+
+# index entry flags
+ASSUME_VALID = 0x8000
+EXTENDED = 0x4000
+STAGE_MASK = 0x3000
+# extended index entry flags
+SKIP_WORKTREE = 0x4000
+INTENT_TO_ADD = 0x2000
+
+# the untracked cache's flags for `git status --untracked-files=normal`
+UNTRACKED_NORMAL = 0x02 | 0x04
+# index extensions whose meaning is understood, or that don't change what's dirty
+KNOWN_EXTENSIONS = {"TREE", "UNTR", "REUC", "EOIE", "IEOT", "FSMN"}
+
+
+class GitUnsupported(Exception):
+    """The repository uses something this module doesn't read; run git instead."""
+
+
+def decode_varint(data, offset):
+    """Decode one of git's variable length integers, returning it and the next offset."""
+    byte = data[offset]
+    offset += 1
+    value = byte & 127
+    while byte & 128:
+        byte = data[offset]
+        offset += 1
+        value = ((value + 1) << 7) + (byte & 127)
+    return value, offset
+
+
+def decode_ewah(data, offset):
+    """Decode a serialized EWAH bitmap, returning its set bits and the next offset."""
+    bit_size, word_count = struct.unpack_from(">II", data, offset)
+    offset += 8
+    words = struct.unpack_from(f">{word_count}Q", data, offset)
+    offset += 8 * word_count + 4
+    bits, position, index = set(), 0, 0
+    while index < word_count:
+        marker = words[index]
+        index += 1
+        running_length = (marker >> 1) & 0xFFFFFFFF
+        if marker & 1:
+            bits.update(range(position, position + 64 * running_length))
+        position += 64 * running_length
+        for word in words[index : index + (marker >> 33)]:
+            while word:
+                low = word & -word
+                bits.add(position + low.bit_length() - 1)
+                word ^= low
+            position += 64
+        index += marker >> 33
+    return {x for x in bits if x < bit_size}, offset
+
+
+def blob_sha(data):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def file_sha(path):
+    """Hash a file as git would (before any filters), or None if it doesn't exist."""
+    try:
+        with open(path, "rb") as f:
+            return blob_sha(f.read())
+    except FileNotFoundError:
+        return None
+
+
+def exclude_file_matches(recorded, path):
+    """Whether an ignore file still has the content the untracked cache recorded.
+
+    git hashes ignore files with a newline appended, unless it took the hash from the
+    index, so either hash matches. A null hash means there was no file.
+    """
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+    except (FileNotFoundError, NotADirectoryError):
+        return recorded is None
+    return recorded in (
+        blob_sha(content),
+        blob_sha(content + b"\n") if content else None,
+    )
+
+
+def usable_cpus():
+    """Return how many CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # not available on macOS
+        return os.cpu_count() or 1
+
+
+def lstat_all(paths):
+    """Return ``os.lstat`` for each path, or None where the path doesn't exist."""
+    results = []
+    for path in paths:
+        try:
+            results.append(os.lstat(path))
+        except (FileNotFoundError, NotADirectoryError):
+            results.append(None)
+    return results
+
+
+def preload_stats(paths, threads=PRELOAD_THREADS):
+    """Yield ``lstat_all`` results in order, statting ahead in chunks on threads.
+
+    Waiting on a cold disk dominates for large trees, and the stat calls release the
+    GIL. ``paths`` is consumed a chunk at a time, and chunks that haven't started are
+    cancelled when the generator is closed.
+    """
+    paths = iter(paths)
+    chunks = iter(lambda: list(itertools.islice(paths, PRELOAD_CHUNK)), [])
+    if threads <= 1:
+        for chunk in chunks:
+            yield from lstat_all(chunk)
+        return
+    executor = ThreadPoolExecutor(threads)
+    pending = collections.deque()
+    try:
+        # read ahead further as chunks are used, so stopping early wastes little
+        ahead = 1
+        while True:
+            for chunk in itertools.islice(chunks, ahead - len(pending)):
+                pending.append(executor.submit(lstat_all, chunk))
+            if not pending:
+                return
+            stats = pending.popleft().result()
+            ahead = min(threads, ahead * 2)
+            yield from stats
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+class Index:
+    """The index (``.git/index``), parsed as it is iterated.
+
+    Entries are ``(name, mode, sha, size, mtime_ns, ctime_ns, ino, uid, gid, stage,
+    assume_valid, extended_flags)`` tuples. Iterating again, or reading ``entries`` or
+    ``extensions``, reuses what was already parsed.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.data = f.read()
+        signature, self.version, self.count = struct.unpack_from(">4sII", self.data)
+        if signature != b"DIRC" or self.version not in (2, 3, 4):
+            raise GitUnsupported(f"index version {self.version}")
+        self.parsed = []
+        self._offset, self._name = 12, b""
+        self._extensions = None
+
+    def __iter__(self):
+        position = 0
+        while True:
+            if position == len(self.parsed):
+                if len(self.parsed) == self.count:
+                    return
+                self._parse(PRELOAD_CHUNK)
+            yield self.parsed[position]
+            position += 1
+
+    def _parse(self, limit):
+        data, offset, name = self.data, self._offset, self._name
+        unpack, find = INDEX_ENTRY.unpack_from, data.index
+        for _ in range(min(limit, self.count - len(self.parsed))):
+            fields = unpack(data, offset)
+            flags = fields[11]
+            extended = 0
+            start = offset + 62
+            if flags & EXTENDED:
+                extended = struct.unpack_from(">H", data, start)[0]
+                start += 2
+            if self.version == 4:
+                strip, start = decode_varint(data, start)
+                end = find(b"\0", start)
+                name = name[: len(name) - strip] + data[start:end]
+                offset = end + 1
+            else:
+                end = find(b"\0", start)
+                name = data[start:end]
+                # entries are padded with 1 to 8 NULs to a multiple of 8 bytes
+                offset += (end - offset + 8) & ~7
+            self.parsed.append(
+                (
+                    name.decode("utf-8", "surrogateescape"),
+                    fields[6],
+                    fields[10],
+                    fields[9],
+                    fields[2] * NANOSECONDS + fields[3],
+                    fields[0] * NANOSECONDS + fields[1],
+                    fields[5],
+                    fields[7],
+                    fields[8],
+                    flags & STAGE_MASK,
+                    flags & ASSUME_VALID,
+                    extended,
+                )
+            )
+        self._offset, self._name = offset, name
+
+    @property
+    def entries(self):
+        self._parse(self.count)
+        return self.parsed
+
+    @property
+    def extensions(self):
+        """The index's extensions, by signature."""
+        if self._extensions is None:
+            self._parse(self.count)
+            data, offset = self.data, self._offset
+            self._extensions = {}
+            while offset < len(data) - 20:
+                signature, size = struct.unpack_from(">4sI", data, offset)
+                self._extensions[signature.decode("latin-1")] = data[
+                    offset + 8 : offset + 8 + size
+                ]
+                offset += 8 + size
+        return self._extensions
+
+    def mentions(self, filename):
+        """Whether an entry may be named ``filename``, without parsing the entries."""
+        if self.version == 4:
+            # names are prefix-compressed, so they can't be searched for
+            return any(x[0].rpartition("/")[2] == filename for x in self.entries)
+        return filename.encode() + b"\0" in self.data
+
+
+def read_config(paths):
+    """Read the parts of git config files this module needs, later files taking precedence.
+
+    Section and key names are lowercased. Raises GitUnsupported for ``[include]`` and
+    ``[includeIf]`` sections, which aren't followed.
+    """
+    config = {}
+    for path in paths:
+        parser = configparser.RawConfigParser(
+            strict=False, allow_no_value=True, comment_prefixes=("#", ";")
+        )
+        try:
+            with open(path) as f:
+                parser.read_string(
+                    "\n".join(line.strip() for line in f.read().splitlines())
+                )
+        except (OSError, configparser.Error):
+            continue
+        for section in parser.sections():
+            if section.lower().split(" ")[0] in ("include", "includeif"):
+                raise GitUnsupported(f"[{section}] in {path}")
+            for key, value in parser.items(section):
+                value = (value or "true").strip().strip('"')
+                config[f"{section.lower()}.{key.lower()}"] = value
+    return config
+
+
+def is_true(value, default):
+    if value is None:
+        return default
+    return value.lower() in ("true", "yes", "on", "1")
+
+
+class Repository:
+    """A git working tree, found from ``path`` like git finds it."""
+
+    def __init__(self, path="."):
+        if os.environ.get("GIT_DIR") or os.environ.get("GIT_INDEX_FILE"):
+            raise GitUnsupported("GIT_DIR or GIT_INDEX_FILE is set")
+        path = os.path.abspath(path)
+        while not os.path.exists(os.path.join(path, ".git")):
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise GitUnsupported("not a git repository")
+            path = parent
+        self.worktree = path
+        self.git_dir = os.path.join(path, ".git")
+        if os.path.isfile(self.git_dir):
+            # a linked worktree or a submodule
+            with open(self.git_dir) as f:
+                content = f.read().strip()
+            if not content.startswith("gitdir:"):
+                raise GitUnsupported(f"can't read {self.git_dir}")
+            self.git_dir = os.path.normpath(os.path.join(path, content[7:].strip()))
+        self.common_dir = self.git_dir
+        if os.path.exists(os.path.join(self.git_dir, "commondir")):
+            with open(os.path.join(self.git_dir, "commondir")) as f:
+                self.common_dir = os.path.normpath(
+                    os.path.join(self.git_dir, f.read().strip())
+                )
+        xdg_config = os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser(
+            "~/.config"
+        )
+        self.config = read_config(
+            [
+                "/etc/gitconfig",
+                os.path.join(xdg_config, "git", "config"),
+                os.path.expanduser("~/.gitconfig"),
+                os.path.join(self.common_dir, "config"),
+            ]
+        )
+        if self.config.get("core.repositoryformatversion", "0") != "0":
+            extensions = [x for x in self.config if x.startswith("extensions.")]
+            if set(extensions) - {"extensions.worktreeconfig", "extensions.noop"}:
+                raise GitUnsupported(f"repository extensions {extensions}")
+        if self.config.get("core.bare") == "true":
+            raise GitUnsupported("bare repository")
+        self.excludes_file = os.path.expanduser(
+            self.config.get("core.excludesfile")
+            or os.path.join(xdg_config, "git", "ignore")
+        )
+
+    # refs and objects
+
+    def read_ref(self, ref, depth=0):
+        """Resolve a ref (e.g. "HEAD" or "refs/heads/main") to a commit id."""
+        if depth > 5:
+            raise GitUnsupported(f"symbolic ref loop at {ref}")
+        for directory in (self.git_dir, self.common_dir):
+            try:
+                with open(os.path.join(directory, ref)) as f:
+                    value = f.read().strip()
+            except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+                continue
+            if value.startswith("ref:"):
+                return self.read_ref(value[4:].strip(), depth + 1)
+            return value
+        return self.packed_refs().get(ref)
+
+    def packed_refs(self):
+        refs = {}
+        try:
+            with open(os.path.join(self.common_dir, "packed-refs")) as f:
+                for line in f:
+                    if line.startswith(("#", "^")):
+                        continue
+                    sha, _, name = line.strip().partition(" ")
+                    refs[name] = sha
+        except FileNotFoundError:
+            pass
+        return refs
+
+    def head(self):
+        """Return the branch HEAD points at (None when detached), and its commit id."""
+        with open(os.path.join(self.git_dir, "HEAD")) as f:
+            value = f.read().strip()
+        if not value.startswith("ref:"):
+            return None, value
+        ref = value[4:].strip()
+        commit = self.read_ref(ref)
+        if not commit:
+            raise GitUnsupported(f"{ref} has no commits")
+        return ref, commit
+
+    def branch(self):
+        """Return the branch name like ``git rev-parse --abbrev-ref HEAD``."""
+        ref, _ = self.head()
+        if ref is None:
+            return "HEAD"
+        if not ref.startswith("refs/heads/"):
+            raise GitUnsupported(f"HEAD points at {ref}")
+        name = ref[len("refs/heads/") :]
+        # git would disambiguate the name from a tag or other ref
+        for other in (f"refs/{name}", f"refs/tags/{name}"):
+            if self.read_ref(other):
+                raise GitUnsupported(f"{name} is ambiguous")
+        return name
+
+    def packs(self):
+        """Return the paths of the pack indexes."""
+        objects = os.path.join(self.common_dir, "objects")
+        if os.path.exists(
+            os.path.join(objects, "info", "alternates")
+        ) or os.path.exists(os.path.join(objects, "pack", "multi-pack-index")):
+            raise GitUnsupported("alternates or a multi-pack-index")
+        pack_dir = os.path.join(objects, "pack")
+        try:
+            names = os.listdir(pack_dir)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(pack_dir, x) for x in sorted(names) if x.endswith(".idx")]
+
+    @staticmethod
+    def _open_idx(path):
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:8] != b"\377tOc\0\0\0\2":
+            raise GitUnsupported(f"{path} is not a version 2 pack index")
+        return data, struct.unpack_from(">I", data, 8 + 255 * 4)[0]
+
+    @staticmethod
+    def _idx_position(data, count, sha):
+        """Return where a binary id is, or would be, in a pack index's sorted id table."""
+        first = sha[0]
+        low = struct.unpack_from(">I", data, 8 + (first - 1) * 4)[0] if first else 0
+        high = struct.unpack_from(">I", data, 8 + first * 4)[0]
+        while low < high:
+            middle = (low + high) // 2
+            if data[1032 + middle * 20 : 1052 + middle * 20] < sha:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def short_id(self, commit):
+        """Abbreviate a commit id like ``git rev-parse --short``.
+
+        The default length grows with the number of packed objects, as git's does, and is
+        then extended until no other object shares the prefix.
+        """
+        if self.config.get("core.abbrev", "auto") != "auto":
+            raise GitUnsupported("core.abbrev is set")
+        sha = bytes.fromhex(commit)
+        count, shared = 0, 0
+
+        def common_length(other):
+            other = other.hex() if isinstance(other, bytes) else other
+            length = 0
+            while length < 40 and other[length] == commit[length]:
+                length += 1
+            return length
+
+        for path in self.packs():
+            data, objects = self._open_idx(path)
+            count += objects
+            position = self._idx_position(data, objects, sha)
+            for neighbour in (position - 1, position, position + 1):
+                if 0 <= neighbour < objects:
+                    other = data[1032 + neighbour * 20 : 1052 + neighbour * 20]
+                    if other != sha:
+                        shared = max(shared, common_length(other))
+        loose = os.path.join(self.common_dir, "objects", commit[:2])
+        if os.path.isdir(loose):
+            for name in os.listdir(loose):
+                if len(name) == 38 and name != commit[2:]:
+                    shared = max(shared, common_length(commit[:2] + name))
+        # git: 2**n objects expect a collision at 2**(n/2) bits, at 4 bits per hex digit
+        length = max(7, (count.bit_length() + 1) // 2) if count else 7
+        return commit[: max(length, shared + 1)]
+
+    def read_object(self, object_id):
+        """Return the type and content of a loose or (undeltified) packed object."""
+        objects = os.path.join(self.common_dir, "objects")
+        try:
+            with open(os.path.join(objects, object_id[:2], object_id[2:]), "rb") as f:
+                raw = zlib.decompress(f.read())
+            header, _, content = raw.partition(b"\0")
+            return header.split(b" ")[0].decode(), content
+        except FileNotFoundError:
+            pass
+        sha = bytes.fromhex(object_id)
+        for path in self.packs():
+            data, count = self._open_idx(path)
+            position = self._idx_position(data, count, sha)
+            if (
+                position >= count
+                or data[1032 + position * 20 : 1052 + position * 20] != sha
+            ):
+                continue
+            offsets = 1032 + count * 24
+            offset = struct.unpack_from(">I", data, offsets + position * 4)[0]
+            if offset & 0x80000000:
+                large = offsets + count * 4 + (offset & 0x7FFFFFFF) * 8
+                offset = struct.unpack_from(">Q", data, large)[0]
+            with open(path[: -len(".idx")] + ".pack", "rb") as f:
+                f.seek(offset)
+                byte = f.read(1)[0]
+                kind = (byte >> 4) & 7
+                while byte & 0x80:
+                    byte = f.read(1)[0]
+                if kind not in (1, 2, 3, 4):
+                    raise GitUnsupported(f"{object_id} is stored as a delta")
+                decompressor = zlib.decompressobj()
+                content = b""
+                while not decompressor.eof:
+                    chunk = f.read(65536)
+                    if not chunk:
+                        raise GitUnsupported(f"{path} is truncated")
+                    content += decompressor.decompress(chunk)
+            return ("commit", "tree", "blob", "tag")[kind - 1], content
+        raise GitUnsupported(f"object {object_id} not found")
+
+    # the index
+
+    def read_index(self):
+        if any(x.startswith("sharedindex.") for x in os.listdir(self.git_dir)):
+            raise GitUnsupported("split index")
+        return Index(os.path.join(self.git_dir, "index"))
+
+    def uses_attributes(self, index):
+        """Whether files may be converted (e.g. line endings) when git hashes them."""
+        return (
+            is_true(self.config.get("core.autocrlf"), False)
+            or self.config.get("core.autocrlf") == "input"
+            or os.path.exists(os.path.join(self.common_dir, "info", "attributes"))
+            or index.mentions(".gitattributes")
+        )
+
+    def modified_file(self, index, stop=None):
+        """Return the first tracked file that differs from the index, or None.
+
+        Only files whose stat data changed (or might have changed without it showing, if
+        they were written in the same second as the index) are read and hashed. ``stop``
+        is called every GIT_STATUS_POLL entries, and the scan gives up (returning None)
+        once it returns True.
+        """
+        index_mtime = os.stat(os.path.join(self.git_dir, "index")).st_mtime_ns
+        # git compares whole seconds when checking whether an entry is racy
+        index_mtime -= index_mtime % NANOSECONDS
+        trust_ctime = is_true(self.config.get("core.trustctime"), True)
+        check_stat = self.config.get("core.checkstat", "default") != "minimal"
+        file_mode = is_true(self.config.get("core.filemode"), True)
+        attributes = self.uses_attributes(index)
+        prefix = os.path.join(self.worktree, "")
+        preload = is_true(self.config.get("core.preloadindex"), True)
+        S_IFMT = stat.S_IFMT
+        with contextlib.closing(
+            preload_stats(
+                (prefix + entry[0] for entry in index),
+                PRELOAD_THREADS if preload else 1,
+            )
+        ) as stats:
+            for position, (entry, st) in enumerate(zip(index, stats)):
+                if stop and not position % GIT_STATUS_POLL and stop():
+                    return None
+                name, mode, sha, size, mtime, ctime, ino, uid, gid = entry[:9]
+                stage, assume_valid, extended = entry[9:]
+                if stage or extended & INTENT_TO_ADD:
+                    return name
+                if assume_valid or extended & SKIP_WORKTREE:
+                    continue
+                if st is None:
+                    return name
+                kind = S_IFMT(st.st_mode)
+                if kind != S_IFMT(mode):
+                    if S_IFMT(mode) == 0o160000:
+                        raise GitUnsupported("submodules")
+                    if S_IFMT(mode) == stat.S_IFDIR:
+                        raise GitUnsupported("sparse index")
+                    return name
+                if file_mode and kind == stat.S_IFREG and (mode ^ st.st_mode) & 0o100:
+                    return name
+                changed = (
+                    mtime != st.st_mtime_ns
+                    or size != st.st_size & 0xFFFFFFFF
+                    or (trust_ctime and check_stat and ctime != st.st_ctime_ns)
+                    or (
+                        check_stat
+                        and (
+                            ino != st.st_ino & 0xFFFFFFFF
+                            or (uid, gid) != (st.st_uid, st.st_gid)
+                        )
+                    )
+                    or (size == 0 and sha.hex() != EMPTY_BLOB)
+                )
+                if not changed and mtime < index_mtime:
+                    continue
+                if size != st.st_size & 0xFFFFFFFF and not attributes:
+                    return name
+                path = prefix + name
+                if kind == stat.S_IFLNK:
+                    current = blob_sha(os.fsencode(os.readlink(path)))
+                else:
+                    current = file_sha(path)
+                if current == sha.hex():
+                    continue
+                if attributes and not self._git_differs(
+                    ["diff", "--quiet", "--", name]
+                ):
+                    # the difference is only in line endings or a filter
+                    continue
+                return name
+        return None
+
+    def _git_differs(self, args):
+        result = subprocess.run(
+            ["git"] + args,
+            cwd=self.worktree,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        return result.returncode != 0
+
+    def has_staged_changes(self, extensions):
+        """Whether the index differs from HEAD, from the index's cached tree."""
+        tree = extensions.get("TREE", b"")
+        _, _, rest = tree.partition(b"\0")
+        counts, _, rest = rest.partition(b"\n")
+        try:
+            if not counts or counts.split(b" ")[0] == b"-1":
+                raise GitUnsupported(
+                    "the cached tree is out of date, e.g. after git add"
+                )
+            _, commit = self.read_object(self.head()[1])
+        except GitUnsupported:
+            return self._git_differs(["diff", "--cached", "--quiet"])
+        head_tree = commit.split(b"\n", 1)[0].split(b" ")[1].decode()
+        return rest[:20].hex() != head_tree
+
+    def _untracked_from_cache(self, extensions, directories):
+        """Whether there are untracked files, according to the untracked cache.
+
+        Returns None when the cache can't answer, e.g. it's missing, or a directory or
+        an ignore file changed since it was written.
+        """
+        data = extensions.get("UNTR")
+        if data is None or not is_true(self.config.get("core.untrackedcache"), True):
+            return None
+        length, offset = decode_varint(data, 0)
+        ident = data[offset : offset + length]
+        offset += length
+        # the cache is only valid for the work tree and system that wrote it
+        system = os.uname().sysname
+        if ident not in {
+            f"Location {path}, system {system}\0".encode("utf-8", "surrogateescape")
+            for path in (self.worktree, os.path.realpath(self.worktree))
+        }:
+            return None
+        offset += 2 * STAT_DATA.size
+        (dir_flags,) = struct.unpack_from(">I", data, offset)
+        offset += 4
+        info_exclude, excludes_file = (
+            data[offset : offset + 20],
+            data[offset + 20 : offset + 40],
+        )
+        offset += 40
+        end = data.index(b"\0", offset)
+        per_dir = data[offset:end].decode()
+        offset = end + 1
+        if dir_flags != UNTRACKED_NORMAL:
+            return None
+        for recorded, path in (
+            (info_exclude, os.path.join(self.common_dir, "info", "exclude")),
+            (excludes_file, self.excludes_file),
+        ):
+            if not exclude_file_matches(
+                recorded.hex() if recorded != NULL_SHA else None, path
+            ):
+                return None
+        count, offset = decode_varint(data, offset)
+        if not count:
+            return None
+
+        blocks = []
+
+        def read_block(parent):
+            nonlocal offset
+            untracked, offset = decode_varint(data, offset)
+            children, offset = decode_varint(data, offset)
+            end = data.index(b"\0", offset)
+            name = data[offset:end].decode("utf-8", "surrogateescape").rstrip("/")
+            offset = end + 1
+            for _ in range(untracked):
+                offset = data.index(b"\0", offset) + 1
+            path = f"{parent}{name}/" if name else parent
+            blocks.append((path, untracked))
+            for _ in range(children):
+                read_block(path)
+
+        read_block("")
+        valid, offset = decode_ewah(data, offset)
+        _, offset = decode_ewah(data, offset)
+        has_exclude, offset = decode_ewah(data, offset)
+        if len(valid) != len(blocks):
+            return None
+        stats = {}
+        for position in sorted(valid):
+            stats[position] = STAT_DATA.unpack_from(data, offset)
+            offset += STAT_DATA.size
+        excludes = {}
+        for position in sorted(has_exclude):
+            excludes[position] = data[offset : offset + 20].hex()
+            offset += 20
+
+        if not directories <= {path for path, _ in blocks}:
+            return None
+        for position, (path, untracked) in enumerate(blocks):
+            directory = os.path.join(self.worktree, path)
+            try:
+                st = os.stat(directory)
+            except FileNotFoundError:
+                return None
+            ctime_s, ctime_ns, mtime_s, mtime_ns, _, ino, _, _, size = stats[position]
+            if (mtime_s, mtime_ns, ctime_s, ctime_ns, ino, size) != (
+                int(st.st_mtime) & 0xFFFFFFFF,
+                st.st_mtime_ns % 10**9,
+                int(st.st_ctime) & 0xFFFFFFFF,
+                st.st_ctime_ns % 10**9,
+                st.st_ino & 0xFFFFFFFF,
+                st.st_size & 0xFFFFFFFF,
+            ):
+                return None
+            if not exclude_file_matches(
+                excludes.get(position), os.path.join(directory, per_dir)
+            ):
+                return None
+            if untracked:
+                return True
+        return False
+
+    def _untracked_from_git(self):
+        process = subprocess.Popen(
+            [
+                "git",
+                "ls-files",
+                "--others",
+                "--exclude-standard",
+                "--directory",
+                "--no-empty-directory",
+                "-z",
+            ],
+            cwd=self.worktree,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        # one byte is enough to know there's an untracked file
+        found = bool(process.stdout.read(1))
+        process.kill()
+        process.wait()
+        process.stdout.close()
+        return found
+
+    def has_untracked_files(self, entries, extensions):
+        if self.config.get("status.showuntrackedfiles") == "no":
+            return False
+        directories = {""}
+        for entry in entries:
+            directory = entry[0].rpartition("/")[0]
+            # parents are already known once a directory has been seen
+            while directory and directory + "/" not in directories:
+                directories.add(directory + "/")
+                directory = directory.rpartition("/")[0]
+        found = self._untracked_from_cache(extensions, directories)
+        if found is None:
+            found = self._untracked_from_git()
+        return found
+
+    def _git_status(self, index):
+        """Whether ``git status`` prints anything, or None if git fails.
+
+        With a CPU to spare, ``modified_file`` runs while git does, and answers first
+        when it finds a modified file early on. With one CPU it would only slow git down.
+        """
+        process = subprocess.Popen(
+            ["git", "--no-optional-locks", "status", "--porcelain"],
+            cwd=self.worktree,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            if usable_cpus() > 1 and self.modified_file(
+                index, lambda: process.poll() is not None
+            ):
+                return True
+            # one byte is enough to know the tree is dirty
+            if process.stdout.read(1):
+                return True
+            return False if process.wait() == 0 else None
+        finally:
+            process.kill()
+            process.wait()
+            process.stdout.close()
+
+    def is_dirty(self):
+        """Whether ``git status --short`` would print anything."""
+        index = self.read_index()
+        if index.count >= GIT_STATUS_ENTRIES:
+            dirty = self._git_status(index)
+            if dirty is not None:
+                return dirty
+        if self.modified_file(index):
+            return True
+        unknown = set(index.extensions) - KNOWN_EXTENSIONS
+        if unknown:
+            raise GitUnsupported(f"index extensions {sorted(unknown)}")
+        return bool(
+            self.has_staged_changes(index.extensions)
+            or self.has_untracked_files(index.entries, index.extensions)
+        )
@@ -3,10 +3,34 @@
 Provides utilities to build and push Docker images.
 """
 
+import concurrent.futures
+import json
+import os
+import re
+import time
+
 import invoke
 
 from colorama import Style
 
+from kubesae import digest, git, layers, registry, s3
+
+
+def read_git_state(path="."):
+    """Return the branch, short commit and dirty state, read from the .git directory."""
+    repository = git.Repository(path)
+    _, commit = repository.head()
+    return repository.branch(), repository.short_id(commit), repository.is_dirty()
+
+
+def current_branch(c):
+    """Return the checked out branch, cleaned for use in a tag ("HEAD" if detached)."""
+    try:
+        branch = git.Repository(".").branch()
+    except (git.GitUnsupported, OSError):
+        branch = c.run("git rev-parse --abbrev-ref HEAD", hide="out").stdout.strip()
+    return branch.replace("/", "-")
+
 
 @invoke.task()
 def generate_tag(c):
@@ -18,28 +42,145 @@ def generate_tag(c):
     """
     if not hasattr(c.config, "tag"):
         # gather build context
-        branch = c.run("git rev-parse --abbrev-ref HEAD", hide="out").stdout.strip()
+        try:
+            branch, commit, dirty = read_git_state()
+        except (git.GitUnsupported, OSError) as e:
+            print(Style.DIM + f"Using git ({e})")
+            branch = c.run("git rev-parse --abbrev-ref HEAD", hide="out").stdout.strip()
+            commit = c.run("git rev-parse --short HEAD", hide="out").stdout.strip()
+            dirty = c.run("git status --short").stdout.strip()
         branch = branch.replace("/", "-")  # clean branch name
-        commit = c.run("git rev-parse --short HEAD", hide="out").stdout.strip()
-        dirty = c.run("git status --short").stdout.strip()
         if dirty:
             dirty = "-dirty"
-        c.config.tag = f"{branch}-{commit}{dirty}"
+        c.config.tag = f"{branch}-{commit}{dirty or ''}"
         print(Style.DIM + f"Set config.tag to {c.config.tag}")
 
 
+def find_local_image(c, context_digest):
+    """Return the ID of a local image built from the same context, if any."""
+    result = c.run(
+        f"docker image ls -q --filter label={digest.LABEL}={context_digest}",
+        hide=True,
+        warn=True,
+    )
+    ids = result.stdout.split() if result.ok else []
+    return ids[0] if ids else None
+
+
+def find_remote_image(c, repository, context_digest):
+    """Return the registry reference of an image built from the same context, if any."""
+    reference = f"{repository}:context-{context_digest}"
+    result = c.run(
+        f"docker buildx imagetools inspect --format '{{{{json .Image}}}}' {reference}",
+        hide=True,
+        warn=True,
+    )
+    if not result.ok:
+        return None
+    images = json.loads(result.stdout)
+    if "config" in images:
+        images = {"": images}
+    # multi-platform images have a config per platform
+    for image in images.values():
+        labels = image.get("config", {}).get("Labels") or {}
+        if labels.get(digest.LABEL) == context_digest:
+            return reference
+    return None
+
+
+def build(
+    c,
+    app,
+    tag,
+    dockerfile="Dockerfile",
+    target=None,
+    repository=None,
+    reuse=True,
+    buildx=False,
+    hide=None,
+    archive=None,
+    depends_on=(),
+):
+    """Build ``<app>:<tag>`` and ``<app>:latest``, reusing an image from the same context.
+
+    Returns the context digest (None without ``reuse``) and the reference of an image in
+    ``repository`` that can be tagged instead of pushing this build, if any. With
+    ``archive``, the image is also saved there as an OCI image archive. ``depends_on``
+    are the context digests of the images this build uses, which are part of its digest
+    so it isn't reused when one of them changed.
+    """
+    label = ""
+    if reuse:
+        context_digest, hashed = digest.context_digest(
+            ".", dockerfile, target, depends_on=depends_on
+        )
+        print(
+            Style.DIM
+            + f"{app}: build context digest {context_digest[:12]} ({hashed} files read)"
+        )
+        if repository:
+            reference = find_remote_image(c, repository, context_digest)
+            if reference:
+                print(
+                    Style.DIM
+                    + f"Skipping build, {reference} has the same build context"
+                )
+                return context_digest, reference
+        image_id = find_local_image(c, context_digest)
+        if image_id:
+            print(
+                Style.DIM
+                + f"Tagging {app}:{tag} (reusing {image_id}, same build context)"
+            )
+            c.run(f"docker tag {image_id} {app}:latest", echo=True, hide=hide)
+            c.run(f"docker tag {image_id} {app}:{tag}", echo=True, hide=hide)
+            save_archive(c, app, tag, archive, hide)
+            return context_digest, None
+        label = f"--label {digest.LABEL}={context_digest}"
+    else:
+        context_digest = None
+    target = f"--target {target}" if target else ""
+    # build app image
+    print(Style.DIM + f"Tagging {app}:{tag}")
+    args = f"-t {app}:latest -t {app}:{tag} {label} {target} -f {dockerfile} ."
+    if buildx:
+        buildx_build(c, repository, args, hide=hide)
+    else:
+        c.run(f"docker build {args}", echo=True, hide=hide)
+    save_archive(c, app, tag, archive, hide)
+    return context_digest, None
+
+
+def save_archive(c, app, tag, archive, hide=None):
+    if archive:
+        os.makedirs(os.path.dirname(archive) or ".", exist_ok=True)
+        c.run(f"docker save -o {archive} {app}:{tag}", echo=True, hide=hide)
+
+
 @invoke.task(pre=[generate_tag])
-def build_image(c, tag=None, dockerfile=None, target=None):
+def build_image(c, tag=None, dockerfile=None, target=None, reuse=True, buildx=False):
     """
     Build Docker image using docker build. Tags with <tag> parameter
     and "latest".
 
+    The image is labeled with a digest of the Dockerfile, the target and the build
+    context. If an image with the same digest is in the repository, the build is skipped
+    and push_image tags it there instead of pushing. If one exists locally, it is tagged
+    instead of building.
+
     Params:
         tag: A user supplied tag for the image
         dockerfile: A non-standard Dockerfile location and/or name
         target: Set the target build stage to build
+        reuse: Reuse an image built from the same context, unless the config
+            "image_reuse" is false (default: True)
+        buildx: Build with docker buildx, using a layer cache in the repository
+            (default: False, or the config "image_buildx")
+
+    After the build, the image's layer sizes are printed and compared with the previous
+    build's (see check_image_size).
 
-    Usage: inv image.build --tag=<TAG> --dockerfile=<PATH_TO_DOCKERFILE>
+    Usage: inv image.build --tag=<TAG> --dockerfile=<PATH_TO_DOCKERFILE> [--no-reuse] [--buildx]
     """
     if tag is None:
         tag = c.config.tag
@@ -47,36 +188,452 @@ def build_image(c, tag=None, dockerfile=None, target=None):
         dockerfile = "Dockerfile"
     if not target and hasattr(c.config, "app_build_target"):
         target = c.config.app_build_target
-    target = f"--target {target}" if target else ""
-    # build app image
-    print(Style.DIM + f"Tagging {tag}")
-    c.run(
-        f"docker build -t {c.config.app}:latest -t {c.config.app}:{tag} {target} -f {dockerfile} .",
+    c.config.tag = tag
+    archive = None
+    if c.config.get("image_push_mode") == "oci-archive":
+        archive = os.path.join(
+            s3.default_cache_dir("images"), f"{c.config.app}-{tag}.tar"
+        )
+    c.config.context_digest, c.config.reused_image = build(
+        c,
+        c.config.app,
+        tag,
+        dockerfile,
+        target,
+        repository=c.config.get("repository"),
+        reuse=reuse and c.config.get("image_reuse", True),
+        buildx=buildx or c.config.get("image_buildx", False),
+        archive=archive,
+    )
+    c.config.image_archive = None if c.config.reused_image else archive
+    if not c.config.reused_image and c.config.get("image_size_report", True):
+        check_image_size(c, c.config.app, tag, dockerfile, target)
+
+
+def check_image_size(c, app, tag, dockerfile="Dockerfile", target=None):
+    """Print the image's layers by Dockerfile line, record its size for the tag, and warn
+    (or fail, with the config "image_size_fail") when it grew past the thresholds
+    compared with the previous build."""
+    image_layers = layers.image_layers(c, f"{app}:{tag}", dockerfile, target)
+    print(f"\n{'SIZE':>9} {'LINE':>5}  INSTRUCTION")
+    for size, line, instruction in image_layers:
+        if size:
+            print(
+                f"{layers.format_size(size):>9} {line or '-':>5}  {layers.shorten(instruction)}"
+            )
+    total = sum(size for size, _, _ in image_layers)
+    print(f"{layers.format_size(total):>9} total")
+    history = layers.SizeHistory(app)
+    previous = history.previous(tag)
+    history.add(tag, image_layers)
+    if not previous:
+        return []
+    regressions = layers.compare(
+        previous,
+        image_layers,
+        c.config.get("image_size_total_growth", "10%"),
+        c.config.get("image_size_layer_growth", "100MB"),
+    )
+    for regression in regressions:
+        print(Style.BRIGHT + regression)
+    if regressions and c.config.get("image_size_fail"):
+        raise invoke.exceptions.Exit(f"{app}:{tag} grew past the size thresholds.")
+    return regressions
+
+
+def cache_refs(c, repository):
+    """Return the registry cache refs to import from, and the one to export to.
+
+    Builds import the current branch's cache and then the main branch's, and export to
+    the current branch's. Nothing is exported when HEAD is detached.
+    """
+    names = [current_branch(c), c.config.get("image_cache_branch", "main")]
+    refs = []
+    for name in names:
+        # tags are limited to 128 characters
+        tag = f"buildcache-{name.replace('/', '-')}"[:128]
+        refs.append(f"{repository}:{tag}")
+    if names[0] == "HEAD":
+        return refs[1:], None
+    return list(dict.fromkeys(refs)), refs[0]
+
+
+def parse_build_progress(output):
+    """Summarize BuildKit's plain progress output by stage.
+
+    Returns ``{stage: {"steps": n, "cached": n, "seconds": s}}``, counting the steps of
+    the Dockerfile (not BuildKit's internal ones).
+    """
+    stages, steps = {}, {}
+    for line in output.splitlines():
+        match = re.match(r"#(\d+) \[(?:(\S+) )?\d+/\d+\] ", line)
+        if match:
+            stage = stages.setdefault(
+                match.group(2) or "default", {"steps": 0, "cached": 0, "seconds": 0.0}
+            )
+            if match.group(1) not in steps:
+                stage["steps"] += 1
+            steps[match.group(1)] = stage
+            continue
+        match = re.match(r"#(\d+) (CACHED|DONE (\d+(?:\.\d+)?)s)$", line)
+        if match and match.group(1) in steps:
+            if match.group(2) == "CACHED":
+                steps[match.group(1)]["cached"] += 1
+            else:
+                steps[match.group(1)]["seconds"] += float(match.group(3))
+    return stages
+
+
+def buildx_build(c, repository, args, hide=None):
+    """Build with docker buildx, with a layer cache in the repository.
+
+    Prints each stage's cache hits and build time from the build's progress output.
+    """
+    cache = ""
+    if repository:
+        cache_from, cache_to = cache_refs(c, repository)
+        cache = " ".join(f"--cache-from type=registry,ref={ref}" for ref in cache_from)
+        if cache_to:
+            cache += (
+                f" --cache-to type=registry,ref={cache_to},mode=max,"
+                "image-manifest=true,oci-mediatypes=true"
+            )
+    builder = c.config.get("image_buildx_builder")
+    builder = f"--builder {builder}" if builder else ""
+    start = time.perf_counter()
+    result = c.run(
+        f"docker buildx build {builder} --load --progress=plain {cache} {args}",
         echo=True,
+        hide=hide,
     )
-    c.config.tag = tag
+    elapsed = time.perf_counter() - start
+    stages = parse_build_progress(result.stderr)
+    for name, stage in stages.items():
+        print(
+            Style.DIM + f"{name}: {stage['cached']}/{stage['steps']} steps cached,"
+            f" {stage['seconds']:.1f}s"
+        )
+    steps = sum(stage["steps"] for stage in stages.values())
+    cached = sum(stage["cached"] for stage in stages.values())
+    hit_rate = f"{cached / steps:.0%}" if steps else "n/a"
+    print(Style.DIM + f"Built in {elapsed:.1f}s, cache hit rate {hit_rate}")
+    return stages
+
+
+def local_digests(c, app, tag):
+    """Return the manifest digests a local image was pushed or pulled with."""
+    result = c.run(
+        f"docker image inspect --format '{{{{json .RepoDigests}}}}' {app}:{tag}",
+        hide=True,
+        warn=True,
+    )
+    if not result.ok:
+        return set()
+    return {x.partition("@")[2] for x in json.loads(result.stdout or "null") or []}
+
 
+def push(
+    c,
+    app,
+    tag,
+    repository,
+    context_digest=None,
+    reused_image=None,
+    hide=None,
+    archive=None,
+):
+    """Push ``<app>:<tag>`` to ``repository``, or tag ``reused_image`` there instead.
 
-@invoke.task(pre=[build_image], default=True)
-def push_image(c, tag=None):
+    Nothing is uploaded when the repository's tag already has the image's manifest. With
+    ``archive`` (an OCI image archive), blobs are uploaded in-process without Docker.
+    Returns a short description of what was done.
+    """
+    push_tag = f"{repository}:{tag}"
+    if reused_image:
+        print(Style.DIM + f"Tagging {reused_image} as {tag} in {repository}")
+        c.run(
+            f"docker buildx imagetools create -t {push_tag} {reused_image}",
+            echo=True,
+            hide=hide,
+        )
+        return "tagged"
+    host, path, _ = registry.parse_reference(push_tag)
+    client = registry.get_client(host, c.config.get("image_insecure_registries") or ())
+    if archive:
+        image = registry.OCIArchive(archive)
+        try:
+            print(Style.DIM + f"Pushing {archive} to {push_tag}")
+            uploaded = registry.push_archive(client, image, path, tag)
+            if context_digest:
+                registry.push_archive(client, image, path, f"context-{context_digest}")
+        finally:
+            image.close()
+        return "up to date" if uploaded is None else f"pushed ({uploaded} blobs)"
+    try:
+        remote = client.manifest_digest(path, tag)
+    except registry.RegistryError as e:
+        print(Style.DIM + f"Couldn't check {push_tag} ({e})")
+        remote = None
+    if remote and remote in local_digests(c, app, tag):
+        print(Style.DIM + f"Skipping push, {push_tag} is up to date")
+        return "up to date"
+    print(Style.DIM + f"Pushing {tag} to {repository}")
+    c.run(f"docker tag {app}:{tag} {push_tag}", echo=True, hide=hide)
+    c.run(f"docker push {push_tag}", echo=True, hide=hide)
+    if context_digest:
+        context_tag = f"{repository}:context-{context_digest}"
+        c.run(f"docker tag {app}:{tag} {context_tag}", echo=True, hide=hide)
+        c.run(f"docker push {context_tag}", echo=True, hide=hide)
+    return "pushed"
+
+
+@invoke.task(pre=[build_image], default=True, iterable=["repository"])
+def push_image(c, tag=None, repository=None, archive=None):
     """Push Docker image to remote repository.
 
     push_image is the default task and will, without the tag parameter, generate a
     tag using the git hash and branch name. Then, build and push that image
     to the repository defined for this task.
 
+    The image is also pushed as context-<digest> (see build_image). If build_image found
+    an image with the same digest in the repository, it is tagged there instead.
+    Repositories whose tag already has the image are skipped, and several repositories
+    are pushed to concurrently.
+
+    Params:
+        tag: tag to apply. (Will be generated from git branch/commit
+        if not set).
+        repository: Repository to push to; repeat for several (default: the config
+            "repository" and "image_mirror_repositories")
+        archive: Push this OCI image archive in-process instead of using docker push
+            (default: the one build_image saved, with image_push_mode "oci-archive")
+
+    Usage: inv push --tag=<TAG> [--repository=<REPOSITORY> ...]
+    """
+    if tag is None:
+        tag = c.config.tag
+    repositories = repository or [c.config.repository] + list(
+        c.config.get("image_mirror_repositories") or []
+    )
+    archive = archive or c.config.get("image_archive")
+    hide = True if len(repositories) > 1 else None
+
+    def push_one(index, repository):
+        start = time.monotonic()
+        status = push(
+            c,
+            c.config.app,
+            tag,
+            repository,
+            # the context tag is looked up in the first repository
+            c.config.get("context_digest") if index == 0 else None,
+            c.config.get("reused_image"),
+            hide=hide,
+            archive=archive,
+        )
+        return status, time.monotonic() - start
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(repositories)
+    ) as executor:
+        futures = [executor.submit(push_one, *x) for x in enumerate(repositories)]
+    if len(repositories) == 1:
+        futures[0].result()
+        return
+    failed = False
+    print(f"\n{'REPOSITORY':<60} {'TIME':>8}  STATUS")
+    for repository, future in zip(repositories, futures):
+        try:
+            status, elapsed = future.result()
+        except Exception as e:
+            failed = True
+            print(f"{repository:<60} {'-':>8}  failed: {failure(e)}")
+            continue
+        print(f"{repository:<60} {elapsed:>7.1f}s  {status}")
+    if failed:
+        raise invoke.exceptions.Exit(code=1)
+
+
+def read_build_set(c):
+    """Return the images in the config "image_builds", with defaults filled in.
+
+    Images are ordered so each comes after the images it depends on. Raises Exit for
+    dependencies on unknown images, or on each other.
+    """
+    images = {}
+    for name, spec in (c.config.get("image_builds") or {}).items():
+        spec = dict(spec)
+        spec.setdefault("app", f"{c.config.app}-{name}")
+        if c.config.get("repository"):
+            spec.setdefault("repository", f"{c.config.repository}-{name}")
+        spec.setdefault("repository", None)
+        spec.setdefault("dockerfile", "Dockerfile")
+        spec.setdefault("target", None)
+        spec.setdefault("push", bool(spec["repository"]))
+        spec["depends_on"] = list(spec.get("depends_on") or [])
+        images[name] = spec
+    if not images:
+        raise invoke.exceptions.Exit("No images are configured in image_builds.")
+    # order the images so each comes after the ones it depends on
+    ordered, remaining = {}, dict(images)
+    while remaining:
+        ready = [
+            n for n, x in remaining.items() if set(x["depends_on"]) <= set(ordered)
+        ]
+        if not ready:
+            for name, spec in remaining.items():
+                unknown = set(spec["depends_on"]) - set(images)
+                if unknown:
+                    raise invoke.exceptions.Exit(
+                        f"{name} depends on unknown images: {', '.join(sorted(unknown))}"
+                    )
+            raise invoke.exceptions.Exit(
+                f"Circular dependencies between {', '.join(sorted(remaining))}"
+            )
+        for name in ready:
+            ordered[name] = remaining.pop(name)
+    return ordered
+
+
+def run_build_set(c, images, tag, workers, push_images, reuse, buildx):
+    """Build (and push) images concurrently, each once the images it depends on are built.
+
+    Returns ``{name: {"build": seconds, "push": seconds, "status": text, "failed": bool}}``,
+    where ``failed`` is set when the image, or one it depends on, failed to build or push.
+    """
+    report = {
+        name: {"build": None, "push": None, "status": "skipped", "failed": False}
+        for name in images
+    }
+    # context digests of the built images, which their dependents' digests include
+    digests = {}
+
+    def build_one(name):
+        spec = images[name]
+        start = time.monotonic()
+        result = build(
+            c,
+            spec["app"],
+            tag,
+            spec["dockerfile"],
+            spec["target"],
+            repository=spec["repository"],
+            reuse=reuse,
+            buildx=buildx,
+            hide=True,
+            depends_on=[digests[x] for x in spec["depends_on"]],
+        )
+        report[name]["build"] = time.monotonic() - start
+        return result
+
+    def push_one(name, context_digest, reused_image):
+        spec = images[name]
+        start = time.monotonic()
+        status = push(
+            c,
+            spec["app"],
+            tag,
+            spec["repository"],
+            context_digest,
+            reused_image,
+            hide=True,
+        )
+        report[name]["push"] = time.monotonic() - start
+        return status
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        built, failed, running = set(), set(), {}
+
+        def start_ready():
+            for name, spec in images.items():
+                if (
+                    name in built
+                    or name in failed
+                    or ("build", name) in running.values()
+                ):
+                    continue
+                if set(spec["depends_on"]) & failed:
+                    failed.add(name)
+                    report[name]["status"] = "skipped (a dependency failed)"
+                    report[name]["failed"] = True
+                elif set(spec["depends_on"]) <= built:
+                    running[executor.submit(build_one, name)] = ("build", name)
+
+        start_ready()
+        while running:
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                step, name = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    failed.add(name)
+                    report[name]["status"] = f"{step} failed: {failure(e)}"
+                    report[name]["failed"] = True
+                    continue
+                if step == "push":
+                    report[name]["status"] = result
+                    continue
+                built.add(name)
+                digests[name] = result[0]
+                report[name]["status"] = "reused" if result[1] else "built"
+                if push_images and images[name]["push"]:
+                    running[executor.submit(push_one, name, *result)] = ("push", name)
+            start_ready()
+    return report
+
+
+def failure(exception):
+    """Describe a failed build step in a line, e.g. the last line a command printed."""
+    result = getattr(exception, "result", None)
+    if result is not None:
+        output = (result.stderr or result.stdout or "").strip().splitlines()
+        return output[-1] if output else f"exit status {result.exited}"
+    return str(exception)
+
+
+@invoke.task(pre=[generate_tag])
+def build_set(c, tag=None, workers=4, push=False, reuse=True, buildx=False):
+    """
+    Build the images in the config "image_builds" concurrently, and optionally push them.
+
+    Each image is built once the images it depends on are built, so independent images
+    build at the same time. Prints how long each image took to build and push.
+
     Params:
         tag: tag to apply. (Will be generated from git branch/commit
         if not set).
+        workers: The most builds and pushes to run at once (default: 4)
+        push: Push each image once it is built
+        reuse: Reuse images built from the same context, as build_image does
+        buildx: Build with docker buildx (default: False, or the config "image_buildx")
 
-    Usage: inv push --tag=<TAG>
+    Usage: inv image.build-set [--push] [--workers=<N>]
     """
     if tag is None:
         tag = c.config.tag
-    print(Style.DIM + f"Pushing {tag} to {c.config.repository}")
-    push_tag = f"{c.config.repository}:{tag}"
-    c.run(f"docker tag {c.config.app}:{tag} {push_tag}", echo=True)
-    c.run(f"docker push {push_tag}", echo=True)
+    images = read_build_set(c)
+    start = time.monotonic()
+    report = run_build_set(
+        c,
+        images,
+        tag,
+        int(workers),
+        push,
+        reuse and c.config.get("image_reuse", True),
+        buildx or c.config.get("image_buildx", False),
+    )
+    print(f"\n{'IMAGE':<30} {'BUILD':>8} {'PUSH':>8}  STATUS")
+    for name, row in report.items():
+        times = [
+            f"{row[x]:.1f}s" if row[x] is not None else "-" for x in ("build", "push")
+        ]
+        print(f"{name:<30} {times[0]:>8} {times[1]:>8}  {row['status']}")
+    print(f"Finished in {time.monotonic() - start:.1f}s")
+    if any(row["failed"] for row in report.values()):
+        raise invoke.exceptions.Exit(code=1)
 
 
 @invoke.task()
@@ -103,5 +660,6 @@ image = invoke.Collection("image")
 image.add_task(generate_tag, "tag")
 image.add_task(build_image, "build")
 image.add_task(push_image, "push")
+image.add_task(build_set, "build-set")
 image.add_task(up, "up")
 image.add_task(stop, "stop")
@@ -1,23 +1,45 @@
+import json
 import os
+import sys
+import warnings
 
 import invoke
-import yaml
 
+from kubesae import kube
+from kubesae.ansible import vars as ansible_vars
 
-@invoke.task
+
+def resolve_ansible_var(hostvars, name):
+    """Return a variable, or an expression such as ``k8s_environment_variables.DEBUG``."""
+    if name in hostvars:
+        return hostvars[name]
+    if name.isidentifier():
+        raise ansible_vars.VarsError(f"{name} is not defined")
+    return hostvars.template(f"{{{{ {name} }}}}")
+
+
+@invoke.task(iterable=["var"])
 def print_ansible_vars(c, var=None, yaml=None, pty=True, hide=False):
     """A command to inspect any ansible variable by environment. If no variable is specified then it will
     print out the current k8s environment variables.
 
+    The variables are resolved in-process from the inventory, group_vars and host_vars, as
+    JSON. Variables that aren't defined are reported after the others, failing the task.
+
     Params:
         c (invoke.Context): The current invoke context
-        var (string, optional): The ansible variable you want to expose. Defaults to None.
-        yaml (string, optional): An ansible path. Defaults to None.
-        pty (bool, optional): If piping the output to another command you might need this to be False. Defaults to True.
-        hide (bool, optional): If you don't want the results to print to the console set to "out". Defaults to False.
+        var (string, optional): The ansible variables you want to expose: repeat the option or
+            separate them with commas. Defaults to None.
+        yaml (string, optional): An ansible path, relative to deploy/. Fails if the file
+            doesn't exist. Defaults to None.
+        pty (bool, optional): Deprecated, and has no effect since no command is run.
+        hide (bool or string, optional): True, "out" or "both" to not print the values, and
+            True, "err" or "both" to not print the undefined variables, like ``c.run``.
+            Defaults to False.
 
     Returns:
-        invoke.Result
+        dict: The variables' values. This used to be the invoke Result of the ansible
+        command.
 
     Usage:
         $ inv staging info.print-ansible-vars
@@ -29,42 +51,163 @@ def print_ansible_vars(c, var=None, yaml=None, pty=True, hide=False):
             Prints the "foo_bar_baz" value defined in the "foo_bar_baz"
             variable located at <PROJECT_ROOT>/deploy/host_vars/staging.yml
 
+        $ inv staging info.print-ansible-vars --var=foo,bar --var=k8s_environment_variables.DEBUG
+            Prints the "foo" and "bar" variables and the DEBUG environment variable.
+
         $ inv staging info.print-ansible-vars --var=foo_bar_baz --yaml="@group_vars/all.yaml"
             Prints the "foo_bar_baz" value defined in the "foo_bar_baz"
             variable located at <PROJECT_ROOT>/deploy/group_vars/all.yml
     """
-    expose_var = "k8s_environment_variables"
-    if var:
-        expose_var = var
+    if not pty:
+        warnings.warn(
+            "print_ansible_vars's pty argument is deprecated and has no effect",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+    if isinstance(var, str):
+        var = [var]
+    names = [name.strip() for x in var or [] for name in x.split(",") if name.strip()]
+    names = names or ["k8s_environment_variables"]
     yaml_file = (
-        f"@host_vars/{c.config.env}.yml"
+        f"host_vars/{c.config.env}.yml"
         if os.path.exists(f"deploy/host_vars/{c.config.env}.yml")
-        else f"@host_vars/{c.config.env}.yaml"
+        else f"host_vars/{c.config.env}.yaml"
     )
+    extra_files = (
+        [yaml_file] if os.path.exists(os.path.join("deploy", yaml_file)) else []
+    )
+    if yaml:
+        yaml = yaml.lstrip("@")
+        if not os.path.exists(os.path.join("deploy", yaml)):
+            raise invoke.exceptions.Exit(f"deploy/{yaml} not found.")
+        extra_files.append(yaml)
+    hostvars = ansible_vars.resolve_host_vars("deploy", c.config.env, extra_files)
+    values, errors = {}, []
+    for name in names:
+        try:
+            values[name] = resolve_ansible_var(hostvars, name)
+        except ansible_vars.VarsError as e:
+            errors.append(f"{name}: {e}")
+    if hide not in (True, "out", "stdout", "both"):
+        print(json.dumps(values, indent=4, default=str))
+    if errors:
+        if hide not in (True, "err", "stderr", "both"):
+            print("\n".join(errors), file=sys.stderr)
+        raise invoke.exceptions.Exit(code=1)
+    return values
+
+
+def pod_requests(pod):
+    """Return the (cpu, memory) a pod requests, counted the way the scheduler does.
 
-    cmd = f"ansible {c.config.env} -m debug -a var='{expose_var}' -e '{yaml_file}'"
-    with c.cd("deploy/"):
-        return c.run(cmd, pty=pty, hide=hide)
+    That is the larger of the summed app containers and the biggest init container,
+    plus any pod overhead.
+    """
+
+    def requests(container):
+        values = (container.get("resources") or {}).get("requests") or {}
+        return (
+            kube.parse_quantity(values.get("cpu", 0)),
+            kube.parse_quantity(values.get("memory", 0)),
+        )
+
+    spec = pod["spec"]
+    containers = [requests(x) for x in spec["containers"]]
+    init_containers = [requests(x) for x in spec.get("initContainers") or []]
+    overhead = requests({"resources": {"requests": spec.get("overhead")}})
+    return tuple(
+        max([sum(x[i] for x in containers)] + [x[i] for x in init_containers])
+        + overhead[i]
+        for i in range(2)
+    )
+
+
+def node_stats(node):
+    status = node["status"]
+    allocatable = status.get("allocatable") or status["capacity"]
+    return {
+        "pod_capacity": int(status["capacity"]["pods"]),
+        "cpu_allocatable": kube.parse_quantity(allocatable.get("cpu", 0)),
+        "memory_allocatable": kube.parse_quantity(allocatable.get("memory", 0)),
+        "pods": 0,
+        "cpu": 0.0,
+        "memory": 0.0,
+    }
+
+
+def percent(value, total):
+    return f"{100 * value / total:.0f}%" if total else "-"
 
 
 @invoke.task
-def pod_stats(c):
-    """Report total pods vs pod capacity in a cluster.
+def pod_stats(c, page_size=500):
+    """Report running pods, and their CPU and memory requests, vs capacity in a cluster.
 
-    Params: None
+    Nodes and running pods are listed a page at a time, so memory use stays flat
+    however large the cluster is.
+
+    Params:
+        page_size (int, optional): Objects fetched per API request. Defaults to 500.
 
     Usage: inv info.pod-stats
     """
-    nodes = yaml.safe_load(c.run("kubectl get nodes -o yaml", hide="out").stdout)
-    pod_capacity = sum(
-        [int(item["status"]["capacity"]["pods"]) for item in nodes["items"]]
-    )
-    pod_total = c.run(
-        "kubectl get pods --all-namespaces | grep Running | wc -l", hide="out"
-    ).stdout.strip()
+
+    def api_stats(client):
+        nodes = {
+            node["metadata"]["name"]: node_stats(node)
+            for node in client.paginate("/api/v1/nodes", limit=page_size)
+        }
+        pod_total = 0
+        pods = client.paginate(
+            "/api/v1/pods", limit=page_size, fieldSelector="status.phase=Running"
+        )
+        for pod in pods:
+            pod_total += 1
+            stats = nodes.get(pod["spec"].get("nodeName"))
+            if stats:
+                cpu, memory = pod_requests(pod)
+                stats["pods"] += 1
+                stats["cpu"] += cpu
+                stats["memory"] += memory
+        return nodes, pod_total, True
+
+    def kubectl_stats():
+        kubectl = kube.kubectl(c)
+        nodes = json.loads(c.run(f"{kubectl} get nodes -o json", hide="out").stdout)
+        pod_total = c.run(
+            f"{kubectl} get pods --all-namespaces --field-selector=status.phase=Running "
+            f"--chunk-size={page_size} --no-headers -o name | wc -l",
+            hide="out",
+        ).stdout.strip()
+        return (
+            {node["metadata"]["name"]: node_stats(node) for node in nodes["items"]},
+            int(pod_total),
+            False,
+        )
+
+    nodes, pod_total, per_node = kube.api_or_kubectl(c, api_stats, kubectl_stats)
+    if per_node:
+        print(f"{'NODE':<40} {'PODS':>9} {'CPU REQUESTS':>20} {'MEMORY REQUESTS':>24}")
+        for name, stats in sorted(nodes.items()):
+            pods = f"{stats['pods']}/{stats['pod_capacity']}"
+            cpu = f"{stats['cpu']:.2f}/{stats['cpu_allocatable']:.2f}"
+            cpu += f" ({percent(stats['cpu'], stats['cpu_allocatable'])})"
+            memory = f"{stats['memory'] / 2**30:.1f}/"
+            memory += f"{stats['memory_allocatable'] / 2**30:.1f}Gi"
+            memory += f" ({percent(stats['memory'], stats['memory_allocatable'])})"
+            print(f"{name:<40} {pods:>9} {cpu:>20} {memory:>24}")
+        print()
+        cpu = sum(x["cpu"] for x in nodes.values())
+        cpu_allocatable = sum(x["cpu_allocatable"] for x in nodes.values())
+        memory = sum(x["memory"] for x in nodes.values())
+        memory_allocatable = sum(x["memory_allocatable"] for x in nodes.values())
+        print(f"CPU requests: {cpu:.2f} of {cpu_allocatable:.2f} cores")
+        print(
+            f"Memory requests: {memory / 2**30:.1f} of {memory_allocatable / 2**30:.1f} Gi"
+        )
     print(f"Running pods: {pod_total}")
-    print(f"Maximum pods: {pod_capacity}")
-    print(f"Total nodes: {len(nodes['items'])}")
+    print(f"Maximum pods: {sum(x['pod_capacity'] for x in nodes.values())}")
+    print(f"Total nodes: {len(nodes)}")
 
 
 info = invoke.Collection("info")
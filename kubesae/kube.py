@@ -0,0 +1,937 @@
+"""Kubernetes API module.
+
+Provides a small in-process client for the Kubernetes API, shared by the tasks that
+talk to the cluster. The kubeconfig is read once per ``inv`` process, exec credential
+plugin tokens (e.g. ``aws eks get-token``) are cached until they expire, and HTTPS
+connections are pooled. Tasks fall back to ``kubectl`` when the cluster can't be
+reached this way.
+
+Config:
+
+    kube.api: Set to False to always use kubectl (default: True)
+    kube.kubeconfig: Path to a kubeconfig file (default: $KUBECONFIG or ~/.kube/config)
+    kube.context: The kubeconfig context to use (default: the current context), by
+        the API client and by kubectl alike
+"""
+
+import base64
+import datetime
+import json
+import os
+import shlex
+import socket
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import invoke
+
+from colorama import Style
+
+STDIN_CHANNEL = 0
+STDOUT_CHANNEL = 1
+STDERR_CHANNEL = 2
+ERROR_CHANNEL = 3
+
+# refresh exec plugin tokens this many seconds before they expire
+TOKEN_EXPIRY_MARGIN = 60
+# container waiting reasons meaning the image couldn't be pulled, or was pulled but
+# couldn't run (which doesn't matter when pre-pulling)
+PULL_FAILED_REASONS = (
+    "ErrImagePull",
+    "ImagePullBackOff",
+    "InvalidImageName",
+    "ErrImageNeverPull",
+)
+PULLED_REASONS = ("CrashLoopBackOff", "CreateContainerError", "RunContainerError")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class KubeUnavailable(Exception):
+    """The cluster can't be reached through the in-process client."""
+
+
+class KubeStreamError(invoke.exceptions.Exit):
+    """An exec stream broke off, so the command's outcome is unknown."""
+
+    def __str__(self):
+        return self.message
+
+
+class KubeApiError(invoke.exceptions.Exit):
+    """The Kubernetes API rejected a request."""
+
+    def __init__(self, status, reason, message=""):
+        self.status = status
+        self.reason = reason
+        super().__init__(f"Kubernetes API error: {status} {reason} {message}".strip())
+
+    def __str__(self):
+        return self.message
+
+    @classmethod
+    def from_response(cls, status, reason, data):
+        try:
+            message = json.loads(data).get("message", "")
+        except (ValueError, AttributeError):
+            message = data.decode(errors="replace")[:200] if data else ""
+        return cls(status, reason, message)
+
+
+def _resolve_path(base_dir, path):
+    return path if os.path.isabs(path) else os.path.join(base_dir, path)
+
+
+def kubeconfig_paths(kubeconfig=None):
+    """Return the kubeconfig files to read, in kubectl's order of precedence."""
+    if kubeconfig:
+        return [os.path.expanduser(kubeconfig)]
+    if os.environ.get("KUBECONFIG"):
+        return [p for p in os.environ["KUBECONFIG"].split(os.pathsep) if p]
+    return [os.path.expanduser("~/.kube/config")]
+
+
+def load_kubeconfig(paths, context=None):
+    """Merge the kubeconfig files and return the cluster and user for a context.
+
+    Like kubectl, the first file to define a name wins. Relative file references are
+    resolved against the directory of the kubeconfig that defined them.
+
+    Returns:
+        (cluster, user): Two (settings, base_dir) tuples.
+    """
+    import yaml
+
+    merged = {"clusters": {}, "users": {}, "contexts": {}}
+    current_context = None
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            try:
+                data = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise KubeUnavailable(f"can't parse {path}: {e}")
+        base_dir = os.path.dirname(os.path.abspath(path))
+        for kind, key in (
+            ("clusters", "cluster"),
+            ("users", "user"),
+            ("contexts", "context"),
+        ):
+            for item in data.get(kind) or []:
+                merged[kind].setdefault(item["name"], (item.get(key) or {}, base_dir))
+        current_context = current_context or data.get("current-context")
+    context = context or current_context
+    if not context:
+        raise KubeUnavailable("no current kubeconfig context")
+    if context not in merged["contexts"]:
+        raise KubeUnavailable(f"kubeconfig context {context} not found")
+    settings = merged["contexts"][context][0]
+    if settings.get("cluster") not in merged["clusters"]:
+        raise KubeUnavailable(
+            f"cluster {settings.get('cluster')} not found in kubeconfig"
+        )
+    return (
+        merged["clusters"][settings["cluster"]],
+        merged["users"].get(settings.get("user"), ({}, "")),
+    )
+
+
+def _load_client_cert(context, cert, key):
+    """Load PEM encoded client certificate and key data into an SSL context."""
+    with tempfile.TemporaryDirectory() as tmp:
+        cert_file = os.path.join(tmp, "cert.pem")
+        key_file = os.path.join(tmp, "key.pem")
+        with open(cert_file, "wb") as f:
+            f.write(cert)
+        with open(os.open(key_file, os.O_WRONLY | os.O_CREAT, 0o600), "wb") as f:
+            f.write(key)
+        context.load_cert_chain(cert_file, key_file)
+
+
+def build_ssl_context(cluster, user):
+    """Build the SSL context used for both pooled requests and exec streams."""
+    cluster, cluster_dir = cluster
+    user, user_dir = user
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cluster.get("insecure-skip-tls-verify"):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif cluster.get("certificate-authority-data"):
+        ca = base64.b64decode(cluster["certificate-authority-data"]).decode()
+        context.load_verify_locations(cadata=ca)
+    elif cluster.get("certificate-authority"):
+        context.load_verify_locations(
+            cafile=_resolve_path(cluster_dir, cluster["certificate-authority"])
+        )
+    else:
+        context.load_default_certs()
+    if user.get("client-certificate-data") and user.get("client-key-data"):
+        _load_client_cert(
+            context,
+            base64.b64decode(user["client-certificate-data"]),
+            base64.b64decode(user["client-key-data"]),
+        )
+    elif user.get("client-certificate") and user.get("client-key"):
+        context.load_cert_chain(
+            _resolve_path(user_dir, user["client-certificate"]),
+            _resolve_path(user_dir, user["client-key"]),
+        )
+    return context
+
+
+class Credentials:
+    """Authorization headers for a kubeconfig user.
+
+    Tokens from an exec credential plugin are cached until shortly before they expire,
+    so the plugin runs once per ``inv`` process rather than once per API call.
+    """
+
+    def __init__(self, user):
+        self.user, self.base_dir = user
+        self._token = None
+        self._expires = None
+        self._lock = threading.Lock()
+        if self.user.get("auth-provider"):
+            raise KubeUnavailable("auth-provider kubeconfig users are not supported")
+
+    def headers(self):
+        token = self.token()
+        if token:
+            return {"Authorization": f"Bearer {token}"}
+        if self.user.get("username"):
+            basic = f"{self.user['username']}:{self.user.get('password', '')}"
+            return {
+                "Authorization": f"Basic {base64.b64encode(basic.encode()).decode()}"
+            }
+        return {}
+
+    def token(self):
+        if self.user.get("token"):
+            return self.user["token"]
+        if self.user.get("tokenFile"):
+            with open(_resolve_path(self.base_dir, self.user["tokenFile"])) as f:
+                return f.read().strip()
+        if not self.user.get("exec"):
+            return None
+        with self._lock:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            if self._token is None or (self._expires and now >= self._expires):
+                self._token, self._expires = self._exec_plugin()
+            return self._token
+
+    def invalidate(self):
+        """Forget a cached exec plugin token, e.g. after the API returned 401."""
+        with self._lock:
+            self._token = None
+
+    def _exec_plugin(self):
+        spec = self.user["exec"]
+        command = spec["command"]
+        if os.sep in command:
+            command = _resolve_path(self.base_dir, command)
+        env = dict(os.environ)
+        env.update({item["name"]: item["value"] for item in spec.get("env") or []})
+        env["KUBERNETES_EXEC_INFO"] = json.dumps(
+            {
+                "apiVersion": spec.get("apiVersion"),
+                "kind": "ExecCredential",
+                "spec": {"interactive": False},
+            }
+        )
+        try:
+            output = subprocess.run(
+                [command] + list(spec.get("args") or []),
+                stdout=subprocess.PIPE,
+                env=env,
+                check=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise KubeUnavailable(f"credential plugin {spec['command']} failed: {e}")
+        status = json.loads(output).get("status") or {}
+        if not status.get("token"):
+            raise KubeUnavailable("only token based credential plugins are supported")
+        expires = None
+        if status.get("expirationTimestamp"):
+            expires = datetime.datetime.fromisoformat(
+                status["expirationTimestamp"].replace("Z", "+00:00")
+            ) - datetime.timedelta(seconds=TOKEN_EXPIRY_MARGIN)
+        return status["token"], expires
+
+
+def label_selector(selector):
+    """Convert a LabelSelector object (as found in a workload spec) to a query string."""
+    terms = [f"{k}={v}" for k, v in sorted((selector.get("matchLabels") or {}).items())]
+    for expression in selector.get("matchExpressions") or []:
+        key, operator = expression["key"], expression["operator"]
+        values = ",".join(expression.get("values") or [])
+        if operator == "In":
+            terms.append(f"{key} in ({values})")
+        elif operator == "NotIn":
+            terms.append(f"{key} notin ({values})")
+        elif operator == "Exists":
+            terms.append(key)
+        elif operator == "DoesNotExist":
+            terms.append(f"!{key}")
+    return ",".join(terms)
+
+
+QUANTITY_SUFFIXES = {
+    "Ki": 2**10,
+    "Mi": 2**20,
+    "Gi": 2**30,
+    "Ti": 2**40,
+    "Pi": 2**50,
+    "Ei": 2**60,
+    "n": 1e-9,
+    "u": 1e-6,
+    "m": 1e-3,
+    "k": 1e3,
+    "M": 1e6,
+    "G": 1e9,
+    "T": 1e12,
+    "P": 1e15,
+    "E": 1e18,
+}
+
+
+def parse_quantity(value):
+    """Convert a resource quantity such as "250m" or "512Mi" to a float."""
+    value = str(value).strip()
+    for suffix in ("Ki", "Mi", "Gi", "Ti", "Pi", "Ei"):
+        if value.endswith(suffix):
+            return float(value[:-2]) * QUANTITY_SUFFIXES[suffix]
+    if value and value[-1] in QUANTITY_SUFFIXES:
+        return float(value[:-1]) * QUANTITY_SUFFIXES[value[-1]]
+    return float(value)
+
+
+def exit_code(status):
+    """Return the process exit code from the exec error channel's Status object.
+
+    Returns None when there's no Status, i.e. the stream ended before the command did.
+    """
+    if status is None:
+        return None
+    if status.get("status") == "Success":
+        return 0
+    for cause in (status.get("details") or {}).get("causes") or []:
+        if cause.get("reason") == "ExitCode":
+            return int(cause["message"])
+    return 1
+
+
+def _mask(data, mask):
+    if not data:
+        return data
+    key = (mask * (len(data) // 4 + 1))[: len(data)]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(key, "big")).to_bytes(
+        len(data), "big"
+    )
+
+
+def _frame(opcode, payload):
+    """Encode a (masked, as required of clients) websocket frame."""
+    header = bytearray([0x80 | opcode])
+    if len(payload) < 126:
+        header.append(0x80 | len(payload))
+    elif len(payload) < 65536:
+        header.append(0x80 | 126)
+        header += struct.pack("!H", len(payload))
+    else:
+        header.append(0x80 | 127)
+        header += struct.pack("!Q", len(payload))
+    mask = os.urandom(4)
+    return bytes(header) + mask + _mask(payload, mask)
+
+
+def _read_exactly(rfile, size):
+    data = rfile.read(size)
+    if len(data) < size:
+        raise KubeStreamError("exec stream closed unexpectedly")
+    return data
+
+
+def _read_frame(rfile):
+    """Read one websocket frame, returning (fin, opcode, payload) or None at EOF."""
+    header = rfile.read(2)
+    if not header:
+        return None
+    if len(header) < 2:
+        header += _read_exactly(rfile, 1)
+    fin, opcode = header[0] & 0x80, header[0] & 0x0F
+    length = header[1] & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", _read_exactly(rfile, 2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", _read_exactly(rfile, 8))
+    mask = _read_exactly(rfile, 4) if header[1] & 0x80 else None
+    payload = _read_exactly(rfile, length)
+    if mask:
+        payload = _mask(payload, mask)
+    return fin, opcode, payload
+
+
+class KubeClient:
+    """A pooled HTTPS client for one kubeconfig cluster and user."""
+
+    def __init__(self, server, ssl_context, credentials, tls_server_name=None):
+        self.server = server.rstrip("/")
+        self.ssl_context = ssl_context
+        self.credentials = credentials
+        self.tls_server_name = tls_server_name
+        # per-thread count of successful requests, see api_or_kubectl
+        self.local = threading.local()
+        import urllib3
+
+        pool_kwargs = {}
+        if ssl_context.verify_mode == ssl.CERT_NONE:
+            pool_kwargs.update(cert_reqs="CERT_NONE", assert_hostname=False)
+        if tls_server_name:
+            pool_kwargs["server_hostname"] = tls_server_name
+        self.pool = urllib3.PoolManager(
+            maxsize=10,
+            ssl_context=ssl_context,
+            retries=False,
+            timeout=urllib3.Timeout(connect=10, read=60),
+            **pool_kwargs,
+        )
+
+    @classmethod
+    def from_kubeconfig(cls, paths, context=None):
+        cluster, user = load_kubeconfig(paths, context)
+        settings = cluster[0]
+        if not settings.get("server"):
+            raise KubeUnavailable("kubeconfig cluster has no server")
+        if settings.get("proxy-url"):
+            raise KubeUnavailable("kubeconfig proxy-url is not supported")
+        return cls(
+            settings["server"],
+            build_ssl_context(cluster, user),
+            Credentials(user),
+            settings.get("tls-server-name"),
+        )
+
+    def operations_started(self):
+        """Return how many changes and exec streams the calling thread has started.
+
+        A change is counted once its request has succeeded, an exec stream once its
+        websocket is open. Read-only requests aren't counted.
+        """
+        return getattr(self.local, "operations", 0)
+
+    def _operation_started(self):
+        self.local.operations = self.operations_started() + 1
+
+    def url(self, path, params=None):
+        query = urllib.parse.urlencode(params or {}, doseq=True)
+        return f"{self.server}{path}?{query}" if query else f"{self.server}{path}"
+
+    def request(
+        self, method, path, params=None, body=None, content_type=None, stream=False
+    ):
+        """Send an API request and return the urllib3 response.
+
+        When ``stream`` is set the body is not read, so it can be consumed incrementally.
+        A 401 response drops the cached token and retries once with a fresh one.
+        """
+        import urllib3
+
+        data = None
+        headers = {"Accept": "application/json"}
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = content_type or "application/json"
+        for attempt in range(2):
+            headers.update(self.credentials.headers())
+            try:
+                response = self.pool.request(
+                    method,
+                    self.url(path, params),
+                    body=data,
+                    headers=headers,
+                    preload_content=not stream,
+                    timeout=urllib3.Timeout(connect=10, read=None) if stream else None,
+                )
+            except urllib3.exceptions.HTTPError as e:
+                raise KubeUnavailable(str(e))
+            if (
+                response.status == 401
+                and attempt == 0
+                and self.credentials.user.get("exec")
+            ):
+                response.drain_conn()
+                self.credentials.invalidate()
+                continue
+            break
+        if response.status >= 400:
+            raise KubeApiError.from_response(
+                response.status, response.reason, response.data
+            )
+        if method != "GET":
+            self._operation_started()
+        return response
+
+    def get(self, path, **params):
+        return json.loads(self.request("GET", path, params).data)
+
+    def create(self, path, body):
+        return json.loads(self.request("POST", path, body=body).data)
+
+    def delete(self, path, **params):
+        return json.loads(self.request("DELETE", path, params).data)
+
+    def patch(self, path, body):
+        response = self.request(
+            "PATCH", path, body=body, content_type="application/merge-patch+json"
+        )
+        return json.loads(response.data)
+
+    def paginate(self, path, limit=500, **params):
+        """Yield the items of a list endpoint, fetching ``limit`` objects per request.
+
+        Only one page is held in memory at a time, so memory use doesn't grow with
+        the size of the cluster.
+        """
+        params["limit"] = limit
+        while True:
+            page = json.load(self.request("GET", path, dict(params), stream=True))
+            yield from page["items"]
+            params["continue"] = page["metadata"].get("continue")
+            if not params["continue"]:
+                return
+
+    def watch(self, path, timeout, **params):
+        """Yield (event type, object) from a watch stream until it ends or times out."""
+        params.update(watch="1", timeoutSeconds=max(1, int(timeout)))
+        params.setdefault("allowWatchBookmarks", "true")
+        response = self.request("GET", path, params, stream=True)
+        buffer = b""
+        try:
+            for chunk in response.stream(8192):
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event["type"] == "ERROR":
+                        status = event["object"]
+                        raise KubeApiError(
+                            status.get("code"),
+                            status.get("reason"),
+                            status.get("message"),
+                        )
+                    yield event["type"], event["object"]
+        finally:
+            response.release_conn()
+
+    def scale(self, namespace, kind, name, replicas):
+        """Set the replicas of a deployment or statefulset through its scale subresource."""
+        return self.patch(
+            f"/apis/apps/v1/namespaces/{namespace}/{kind}/{name}/scale",
+            {"spec": {"replicas": replicas}},
+        )
+
+    def find_pod(self, namespace, deployment):
+        """Pick a running pod of a deployment, as ``kubectl exec deploy/<name>`` does.
+
+        Returns:
+            (pod name, default container name)
+        """
+        spec = self.get(
+            f"/apis/apps/v1/namespaces/{namespace}/deployments/{deployment}"
+        )
+        pods = self.get(
+            f"/api/v1/namespaces/{namespace}/pods",
+            labelSelector=label_selector(spec["spec"]["selector"]),
+            fieldSelector="status.phase=Running",
+        )["items"]
+        pods = [p for p in pods if not p["metadata"].get("deletionTimestamp")]
+        if not pods:
+            raise KubeApiError(
+                404, "Not Found", f"no running pods for deployment {deployment}"
+            )
+
+        def ready(pod):
+            conditions = pod["status"].get("conditions") or []
+            return any(
+                x["type"] == "Ready" and x["status"] == "True" for x in conditions
+            )
+
+        pod = sorted(
+            pods, key=lambda p: (ready(p), p["metadata"]["creationTimestamp"])
+        )[-1]
+        annotations = pod["metadata"].get("annotations") or {}
+        container = annotations.get(
+            "kubectl.kubernetes.io/default-container",
+            pod["spec"]["containers"][0]["name"],
+        )
+        return pod["metadata"]["name"], container
+
+    def _websocket(self, path, params):
+        """Open a websocket to the API using the channel.k8s.io subprotocol."""
+        server = urllib.parse.urlsplit(self.server)
+        port = server.port or (443 if server.scheme == "https" else 80)
+        try:
+            sock = socket.create_connection((server.hostname, port), timeout=10)
+            if server.scheme == "https":
+                sock = self.ssl_context.wrap_socket(
+                    sock, server_hostname=self.tls_server_name or server.hostname
+                )
+        except OSError as e:
+            raise KubeUnavailable(str(e))
+        key = base64.b64encode(os.urandom(16)).decode()
+        query = urllib.parse.urlencode(params, doseq=True)
+        lines = [
+            f"GET {server.path.rstrip('/')}{path}?{query} HTTP/1.1",
+            f"Host: {server.netloc}",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            f"Sec-WebSocket-Key: {key}",
+            "Sec-WebSocket-Version: 13",
+            "Sec-WebSocket-Protocol: v4.channel.k8s.io",
+        ]
+        lines += [f"{k}: {v}" for k, v in self.credentials.headers().items()]
+        sock.sendall(("\r\n".join(lines) + "\r\n\r\n").encode())
+        rfile = sock.makefile("rb")
+        status = rfile.readline().decode().split(" ", 2)
+        headers = {}
+        for line in iter(rfile.readline, b"\r\n"):
+            if not line:
+                break
+            name, _, value = line.decode().partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if len(status) < 2 or status[1] != "101":
+            body = rfile.read(int(headers.get("content-length", 0)))
+            sock.close()
+            code = int(status[1]) if len(status) > 1 and status[1].isdigit() else 0
+            raise KubeApiError.from_response(code, status[-1].strip(), body)
+        # exec streams can stay quiet for a long time, e.g. while pg_dump runs
+        sock.settimeout(None)
+        self._operation_started()
+        return sock, rfile
+
+    def exec_stream(self, namespace, pod, command, container=None):
+        """Run a command in a pod, yielding (channel, data) as the output arrives."""
+        params = [("command", arg) for arg in command]
+        params += [("stdout", "true"), ("stderr", "true")]
+        if container:
+            params.append(("container", container))
+        sock, rfile = self._websocket(
+            f"/api/v1/namespaces/{namespace}/pods/{pod}/exec", params
+        )
+        try:
+            fragments = []
+            while True:
+                try:
+                    frame = _read_frame(rfile)
+                except OSError as e:
+                    raise KubeStreamError(f"exec stream failed: {e}")
+                if frame is None:
+                    break
+                fin, opcode, payload = frame
+                if opcode == 0x8:  # close
+                    break
+                if opcode == 0x9:  # ping
+                    sock.sendall(_frame(0xA, payload))
+                    continue
+                if opcode == 0xA:  # pong
+                    continue
+                fragments.append(payload)
+                if not fin:
+                    continue
+                message = fragments[0] if len(fragments) == 1 else b"".join(fragments)
+                fragments = []
+                if len(message) > 1:
+                    yield message[0], message[1:]
+        finally:
+            try:
+                sock.sendall(_frame(0x8, b""))
+            except OSError:
+                pass
+            sock.close()
+
+    def exec(self, namespace, pod, command, container=None):
+        """Run a command in a pod and return an invoke Result, like ``c.run`` would."""
+        stdout, stderr, status = [], [], None
+        for channel, data in self.exec_stream(namespace, pod, command, container):
+            if channel == STDOUT_CHANNEL:
+                stdout.append(data)
+            elif channel == STDERR_CHANNEL:
+                stderr.append(data)
+            elif channel == ERROR_CHANNEL:
+                status = json.loads(data)
+        if status is None:
+            raise KubeStreamError(f"exec stream of {pod} closed without an exit status")
+        return invoke.Result(
+            stdout=b"".join(stdout).decode(errors="replace"),
+            stderr=b"".join(stderr).decode(errors="replace"),
+            command=" ".join(command),
+            exited=exit_code(status),
+        )
+
+
+def rolled_out(workload, replicas):
+    """Whether a deployment or statefulset has settled at ``replicas`` ready pods."""
+    status = workload.get("status") or {}
+    if status.get("observedGeneration", 0) < workload["metadata"].get("generation", 0):
+        return False
+    if status.get("replicas", 0) != replicas:
+        return False
+    return replicas == 0 or status.get("readyReplicas", 0) == replicas
+
+
+def wait_for_rollout(client, namespace, kind, name, replicas, deadline):
+    """Watch a workload until it has ``replicas`` ready pods.
+
+    When scaling to zero, also wait for its terminating pods to be gone.
+
+    Params:
+        kind (str): "deployments" or "statefulsets"
+        deadline (float): A time.monotonic() value to give up at, raising TimeoutError.
+    """
+    path = f"/apis/apps/v1/namespaces/{namespace}/{kind}"
+    workload = client.get(f"{path}/{name}")
+    version = workload["metadata"]["resourceVersion"]
+    while not rolled_out(workload, replicas):
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f"{kind}/{name} did not reach {replicas} ready replicas")
+        try:
+            events = client.watch(
+                path,
+                deadline - time.monotonic(),
+                fieldSelector=f"metadata.name={name}",
+                resourceVersion=version,
+            )
+            for event, obj in events:
+                version = obj["metadata"]["resourceVersion"]
+                if event == "DELETED":
+                    raise KubeApiError(404, "Not Found", f"{kind}/{name} was deleted")
+                if event != "BOOKMARK":
+                    workload = obj
+                    if rolled_out(workload, replicas):
+                        break
+        except KubeApiError as e:
+            if e.status != 410:
+                raise
+            # our resourceVersion is too old to watch from, start over
+            workload = client.get(f"{path}/{name}")
+            version = workload["metadata"]["resourceVersion"]
+    if replicas == 0:
+        wait_for_pods_deleted(
+            client, namespace, label_selector(workload["spec"]["selector"]), deadline
+        )
+
+
+def wait_for_pods_deleted(client, namespace, selector, deadline):
+    """Watch the pods matching a label selector until they have all terminated."""
+    path = f"/api/v1/namespaces/{namespace}/pods"
+    while True:
+        pods = client.get(path, labelSelector=selector)
+        names = {pod["metadata"]["name"] for pod in pods["items"]}
+        version = pods["metadata"]["resourceVersion"]
+        try:
+            while names:
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"{len(names)} pods are still terminating")
+                events = client.watch(
+                    path,
+                    deadline - time.monotonic(),
+                    labelSelector=selector,
+                    resourceVersion=version,
+                )
+                for event, obj in events:
+                    version = obj["metadata"]["resourceVersion"]
+                    if event == "DELETED":
+                        names.discard(obj["metadata"]["name"])
+                    elif event == "ADDED":
+                        names.add(obj["metadata"]["name"])
+                    if not names:
+                        break
+            return
+        except KubeApiError as e:
+            if e.status != 410:
+                raise
+
+
+def prepull_daemonset(name, image, pause_image, pull_secrets=()):
+    """Return a DaemonSet that pulls ``image`` onto every node.
+
+    The image runs as a no-op init container, so its pods need no more than a pause
+    container's resources and tolerate any taint.
+    """
+    labels = {"app.kubernetes.io/name": name, "app.kubernetes.io/managed-by": "kubesae"}
+    resources = {"requests": {"cpu": "1m", "memory": "8Mi"}}
+    return {
+        "apiVersion": "apps/v1",
+        "kind": "DaemonSet",
+        "metadata": {"name": name, "labels": labels},
+        "spec": {
+            "selector": {"matchLabels": labels},
+            "template": {
+                "metadata": {"labels": labels},
+                "spec": {
+                    "initContainers": [
+                        {
+                            "name": "prepull",
+                            "image": image,
+                            "imagePullPolicy": "IfNotPresent",
+                            "command": ["sh", "-c", "exit 0"],
+                            "resources": resources,
+                        }
+                    ],
+                    "containers": [
+                        {"name": "pause", "image": pause_image, "resources": resources}
+                    ],
+                    "imagePullSecrets": [{"name": x} for x in pull_secrets],
+                    "tolerations": [{"operator": "Exists"}],
+                    "automountServiceAccountToken": False,
+                    "terminationGracePeriodSeconds": 0,
+                },
+            },
+        },
+    }
+
+
+def image_pull_state(pod):
+    """Return whether a prepull pod's image is "pulled", "failed" or still pulling (None),
+    and the error message if it failed."""
+    statuses = (pod.get("status") or {}).get("initContainerStatuses") or []
+    if not statuses:
+        return None, None
+    state = statuses[0].get("state") or {}
+    waiting = state.get("waiting") or {}
+    if (
+        statuses[0].get("imageID")
+        or "running" in state
+        or "terminated" in state
+        or waiting.get("reason") in PULLED_REASONS
+    ):
+        return "pulled", None
+    if waiting.get("reason") in PULL_FAILED_REASONS:
+        return "failed", waiting.get("message") or waiting["reason"]
+    return None, None
+
+
+def wait_for_prepull(client, namespace, name, deadline, start=None):
+    """Watch a prepull DaemonSet's pods until every node has pulled the image or failed to.
+
+    Params:
+        deadline (float): A time.monotonic() value to stop waiting at.
+        start (float): The time.monotonic() value pull times are measured from.
+
+    Returns:
+        {node: (seconds, error)}, with seconds None for nodes still pulling at the
+        deadline, and error None for nodes that pulled the image.
+    """
+    start = time.monotonic() if start is None else start
+    path = f"/api/v1/namespaces/{namespace}/pods"
+    selector = f"app.kubernetes.io/name={name}"
+    nodes = {}
+
+    def update(pod):
+        node = pod["spec"].get("nodeName")
+        if not node or (nodes.get(node) or (None,))[0] is not None:
+            return
+        state, error = image_pull_state(pod)
+        nodes[node] = (time.monotonic() - start if state else None, error)
+
+    def pulling():
+        return any(seconds is None for seconds, _ in nodes.values())
+
+    def settled():
+        if pulling():
+            return False
+        daemonset = client.get(
+            f"/apis/apps/v1/namespaces/{namespace}/daemonsets/{name}"
+        )
+        status = daemonset.get("status") or {}
+        # the controller must have seen the DaemonSet to know how many nodes it runs on
+        if status.get("observedGeneration", 0) < daemonset["metadata"]["generation"]:
+            return False
+        return len(nodes) >= status.get("desiredNumberScheduled", 0)
+
+    while True:
+        pods = client.get(path, labelSelector=selector)
+        for pod in pods["items"]:
+            update(pod)
+        version = pods["metadata"]["resourceVersion"]
+        try:
+            while not settled() and time.monotonic() < deadline:
+                # rewatch now and then to notice the DaemonSet's status changing
+                events = client.watch(
+                    path,
+                    min(deadline - time.monotonic(), 10),
+                    labelSelector=selector,
+                    resourceVersion=version,
+                )
+                for event, obj in events:
+                    version = obj["metadata"]["resourceVersion"]
+                    if event in ("ADDED", "MODIFIED"):
+                        update(obj)
+                        if not pulling():
+                            break
+            return nodes
+        except KubeApiError as e:
+            if e.status != 410:
+                raise
+
+
+def kubectl(c):
+    """Return the kubectl command to run, with the configured kube.context."""
+    context = (c.config.get("kube") or {}).get("context")
+    return f"kubectl --context {shlex.quote(context)}" if context else "kubectl"
+
+
+def get_client(c):
+    """Return the shared KubeClient for the context's kubeconfig, or None to use kubectl."""
+    settings = c.config.get("kube") or {}
+    if not settings.get("api", True):
+        return None
+    paths = kubeconfig_paths(settings.get("kubeconfig"))
+    key = (tuple(paths), settings.get("context"))
+    with _clients_lock:
+        if key not in _clients:
+            try:
+                _clients[key] = KubeClient.from_kubeconfig(
+                    paths, settings.get("context")
+                )
+            except (KubeUnavailable, OSError, ssl.SSLError) as e:
+                print(Style.DIM + f"Using kubectl ({e})")
+                _clients[key] = None
+        return _clients[key]
+
+
+def api_or_kubectl(c, api_call, command, **kwargs):
+    """Run ``api_call(client)`` against the Kubernetes API, or ``command`` with kubectl.
+
+    kubectl is used when the API client is disabled, the kubeconfig can't be used
+    in-process, or the cluster can't be reached. ``command`` is either a kubectl
+    command line or a function taking no arguments that runs kubectl itself.
+
+    Once ``api_call`` has changed something or opened an exec stream, the operation is
+    under way and isn't started again with kubectl: losing the connection raises
+    KubeStreamError instead. Read-only lookups before that don't count, so the
+    connection failing after them still falls back.
+    """
+    client = get_client(c)
+    if client is not None:
+        operations = client.operations_started()
+        try:
+            return api_call(client)
+        except KubeUnavailable as e:
+            if client.operations_started() != operations:
+                raise KubeStreamError(f"Kubernetes API connection lost: {e}") from e
+            print(
+                Style.DIM + f"Kubernetes API unavailable ({e}), falling back to kubectl"
+            )
+    if callable(command):
+        return command()
+    return c.run(command, **kwargs)
@@ -0,0 +1,199 @@
+"""Image layers module.
+
+Maps the layers of a built image to the Dockerfile instructions that made them, keeps
+a history of image sizes per tag, and compares a build with the previous one so that a
+layer that suddenly grows (e.g. a stray ``COPY``) is noticed before it slows deploys.
+"""
+
+import json
+import os
+import re
+import time
+
+from kubesae import s3
+
+# history entries kept per image
+HISTORY_LENGTH = 50
+SIZE_UNITS = {"": 1, "B": 1, "KB": 10**3, "MB": 10**6, "GB": 10**9}
+
+
+def parse_dockerfile(path, target=None):
+    """Return the instructions of the ``target`` stage (default: the last one) as
+    ``(line, keyword, arguments)`` tuples."""
+    with open(path) as f:
+        lines = f.read().splitlines()
+    instructions, current, start = [], "", None
+    for number, line in enumerate(lines, 1):
+        stripped = line.strip()
+        if not current and (not stripped or stripped.startswith("#")):
+            continue
+        if current and stripped.startswith("#"):
+            # comments may sit inside continued instructions
+            continue
+        if start is None:
+            start = number
+        if stripped.endswith("\\"):
+            current += stripped[:-1] + " "
+            continue
+        current += stripped
+        keyword, _, arguments = current.partition(" ")
+        instructions.append((start, keyword.upper(), arguments.strip()))
+        current, start = "", None
+    stages = [i for i, x in enumerate(instructions) if x[1] == "FROM"]
+    if not stages:
+        return instructions
+    start, end = stages[-1], len(instructions)
+    for index, next_index in zip(stages, stages[1:] + [len(instructions)]):
+        words = instructions[index][2].split()
+        if (
+            target
+            and len(words) >= 3
+            and words[-2].upper() == "AS"
+            and words[-1] == target
+        ):
+            start, end = index, next_index
+    return instructions[start:end]
+
+
+def normalize(keyword, arguments):
+    """Reduce an instruction's arguments to what image history records of them."""
+    arguments = re.sub(r"\s+# buildkit$", "", arguments.strip())
+    if keyword == "RUN":
+        arguments = re.sub(r"^\|\d+ (\S+=\S* )*", "", arguments)
+        arguments = re.sub(r"^/bin/sh -c ", "", arguments)
+    # the classic builder records COPY and ADD sources by content hash
+    arguments = re.sub(r"\b(file|dir|multi):[0-9a-f]{64}", r"\1", arguments)
+    words = [w for w in arguments.split() if not w.startswith("--")]
+    return " ".join(words)
+
+
+def parse_created_by(created_by):
+    """Split an image history entry's CreatedBy into its keyword and arguments."""
+    created_by = re.sub(r"^/bin/sh -c #\(nop\)\s+", "", created_by.strip())
+    if created_by.startswith("/bin/sh -c "):
+        return "RUN", created_by
+    keyword, _, arguments = created_by.partition(" ")
+    return keyword.upper(), arguments
+
+
+def map_layers(history, instructions):
+    """Match image history entries (oldest first) to Dockerfile instructions.
+
+    The last entries come from the final stage's instructions, so both are walked from
+    the end. Returns ``[(size, line or None, instruction)]``, oldest first; entries
+    without a line come from the base image.
+    """
+    pointer = len(instructions)
+    layers = []
+    for entry in reversed(history):
+        keyword, arguments = parse_created_by(entry["CreatedBy"])
+        line = None
+        for index in range(pointer - 1, 0, -1):
+            _, candidate_keyword, candidate_arguments = instructions[index]
+            if candidate_keyword != keyword:
+                continue
+            expected = normalize(keyword, candidate_arguments)
+            recorded = normalize(keyword, arguments)
+            # the classic builder records COPY sources as hashes, but keeps the destination
+            same_target = expected.split()[-1:] == recorded.split()[-1:]
+            if expected == recorded or (keyword in ("COPY", "ADD") and same_target):
+                line, pointer = instructions[index][0], index
+                break
+        instruction = f"{keyword} {normalize(keyword, arguments)}".strip()
+        layers.append((int(entry["Size"]), line, instruction))
+    return layers[::-1]
+
+
+def image_layers(c, image, dockerfile, target=None):
+    """Return the image's layers, mapped to the Dockerfile, from ``docker history``."""
+    result = c.run(
+        f"docker history --no-trunc --human=false --format '{{{{json .}}}}' {image}",
+        hide=True,
+    )
+    history = [json.loads(line) for line in result.stdout.splitlines() if line.strip()]
+    return map_layers(history[::-1], parse_dockerfile(dockerfile, target))
+
+
+def parse_threshold(value, reference):
+    """Return a threshold in bytes, from a size ("200MB") or a share of ``reference``
+    ("10%")."""
+    value = str(value).strip().upper()
+    if value.endswith("%"):
+        return reference * float(value[:-1]) / 100
+    match = re.match(r"^([\d.]+)\s*([KMG]?B?)$", value)
+    if not match:
+        raise ValueError(f"Invalid size threshold: {value}")
+    return float(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+def format_size(size):
+    for unit in ("GB", "MB", "KB"):
+        if abs(size) >= SIZE_UNITS[unit]:
+            return f"{size / SIZE_UNITS[unit]:.1f}{unit}"
+    return f"{size}B"
+
+
+def compare(previous, current, total_threshold, layer_threshold):
+    """Return the regressions of ``current`` layers against ``previous`` ones, as lines.
+
+    Layers are compared by instruction, so adding or moving instructions doesn't count
+    as growth. A new layer counts as grown from nothing.
+    """
+    regressions = []
+    previous_total = sum(size for size, _, _ in previous)
+    total = sum(size for size, _, _ in current)
+    limit = parse_threshold(total_threshold, previous_total)
+    if total - previous_total > limit:
+        regressions.append(
+            f"Image grew by {format_size(total - previous_total)} to {format_size(total)}"
+        )
+    before = {}
+    for size, _, instruction in previous:
+        before[instruction] = before.get(instruction, 0) + size
+    seen = {}
+    for size, line, instruction in current:
+        seen[instruction] = seen.get(instruction, 0) + size
+    for _, line, instruction in current:
+        if instruction not in seen:
+            continue
+        growth = seen.pop(instruction) - before.get(instruction, 0)
+        if growth > parse_threshold(layer_threshold, before.get(instruction, 0)):
+            where = f"line {line}" if line else "base image"
+            regressions.append(
+                f"Layer grew by {format_size(growth)} ({where}): {shorten(instruction)}"
+            )
+    return regressions
+
+
+def shorten(text, length=80):
+    return text if len(text) <= length else text[: length - 3] + "..."
+
+
+class SizeHistory:
+    """Image sizes by tag, for one image, kept in ~/.cache/kubesae/image-sizes."""
+
+    def __init__(self, app, path=None):
+        self.path = os.path.join(
+            path or s3.default_cache_dir("image-sizes"), f"{app}.json"
+        )
+        try:
+            with open(self.path) as f:
+                self.builds = json.load(f)
+        except (OSError, ValueError):
+            self.builds = []
+
+    def previous(self, tag):
+        """Return the layers of the latest build with a tag other than ``tag``."""
+        for build in reversed(self.builds):
+            if build["tag"] != tag:
+                return [tuple(layer) for layer in build["layers"]]
+        return None
+
+    def add(self, tag, layers):
+        self.builds = [b for b in self.builds if b["tag"] != tag]
+        self.builds.append({"tag": tag, "time": time.time(), "layers": layers})
+        self.builds = self.builds[-HISTORY_LENGTH:]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(self.builds, f)
+        os.replace(f"{self.path}.tmp", self.path)
@@ -1,5 +1,19 @@
+import hashlib
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
 import invoke
 
+from colorama import Style
+
+from kubesae import kube
+
 DEFAULT_DB_VAR = "DATABASE_URL"
 
 
@@ -10,7 +24,8 @@ def shell(c):
     Usage: inv <ENVIRONMENT> pod.shell
     """
     c.run(
-        f"kubectl exec -it deploy/{c.config.container_name} -n {c.config.namespace} -- bash"
+        f"{kube.kubectl(c)} exec -it deploy/{c.config.container_name} "
+        f"-n {c.config.namespace} -- bash"
     )
 
 
@@ -20,7 +35,7 @@ def clean_debian(c):
 
     Usage: inv pod.clean-debian
     """
-    c.run("kubectl delete pod debian", warn=True)
+    c.run(f"{kube.kubectl(c)} delete pod debian", warn=True)
 
 
 @invoke.task(pre=[clean_debian])
@@ -43,7 +58,27 @@ def debian(c, debian_flavor="bullseye"):
         print(f"{debian_flavor} not in the valid list: {debian_flavors}")
         return
     c.run(
-        f"kubectl run -it debian --image=debian:{debian_flavor}-slim --restart=Never -- bash"
+        f"{kube.kubectl(c)} run -it debian --image=debian:{debian_flavor}-slim "
+        "--restart=Never -- bash"
+    )
+
+
+def delete_pods(c, selector):
+    """Delete the pods matching a label selector in the configured namespace."""
+    namespace = c.config.namespace
+
+    def delete(client):
+        pods = client.delete(
+            f"/api/v1/namespaces/{namespace}/pods", labelSelector=selector
+        )
+        for item in pods.get("items") or []:
+            name = item["metadata"]["name"]
+            print(f'pod "{name}" deleted')
+        if not pods.get("items"):
+            print(f"No resources found in {namespace} namespace.")
+
+    kube.api_or_kubectl(
+        c, delete, f"{kube.kubectl(c)} delete pods -n {namespace} -l{selector}"
     )
 
 
@@ -53,7 +88,7 @@ def clean_collectstatic(c):
 
     Usage: inv pod.clean-collectstatic
     """
-    c.run(f"kubectl delete pods -n {c.config.namespace} -ljob-name=collectstatic")
+    delete_pods(c, "job-name=collectstatic")
 
 
 @invoke.task
@@ -62,7 +97,65 @@ def clean_migrations(c):
 
     Usage: inv <ENVIRONMENT> pod.clean-migrations
     """
-    c.run(f"kubectl delete pods -n {c.config.namespace} -ljob-name=migrate")
+    delete_pods(c, "job-name=migrate")
+
+
+# dump the environment as JSON, or NUL separated if there's no python in the image
+ENV_DUMP_SCRIPT = (
+    "python3 -c 'import json, os; print(json.dumps(dict(os.environ)))' 2>/dev/null"
+    " || python -c 'import json, os; print(json.dumps(dict(os.environ)))' 2>/dev/null"
+    " || env -0"
+)
+
+_namespace_env = {}
+_namespace_env_lock = threading.Lock()
+
+
+def parse_env_dump(output):
+    """Parse the output of ENV_DUMP_SCRIPT into a dict."""
+    if output.lstrip().startswith("{"):
+        return json.loads(output)
+    return dict(x.split("=", 1) for x in output.split("\0") if "=" in x)
+
+
+def fetch_namespace_vars(c, names=None, refresh=False):
+    """Return environment variables of the application container, from a single exec.
+
+    The whole environment is read once per deployment and remembered for the rest of the
+    ``inv`` run, so later lookups don't exec into the pod again.
+
+    Params:
+        names (list, optional): The variables to return, if not all of them. Variables
+            that aren't set are left out.
+        refresh (bool, optional): Read the environment again.
+
+    Returns:
+        dict: The variables' values.
+    """
+    namespace = c.config.namespace
+    kube_context = (c.config.get("kube") or {}).get("context")
+    key = (kube_context, namespace, c.config.container_name)
+
+    def api_env(client):
+        pod, container = client.find_pod(namespace, c.config.container_name)
+        result = client.exec(namespace, pod, ["sh", "-c", ENV_DUMP_SCRIPT], container)
+        if result.exited:
+            raise invoke.exceptions.UnexpectedExit(result)
+        return result
+
+    command = (
+        f"{kube.kubectl(c)} --namespace {namespace} exec -i "
+        f"deploy/{c.config.container_name} -- sh -c {shlex.quote(ENV_DUMP_SCRIPT)}"
+    )
+
+    with _namespace_env_lock:
+        if refresh or key not in _namespace_env:
+            result = kube.api_or_kubectl(c, api_env, command, hide=True)
+            _namespace_env[key] = parse_env_dump(result.stdout)
+        env = _namespace_env[key]
+    if names is None:
+        return dict(env)
+    return {name: env[name] for name in names if name in env}
 
 
 @invoke.task
@@ -70,6 +163,9 @@ def fetch_namespace_var(c, fetch_var, hide=False):
     """Takes a variable name that may be present on a running container. Queries the
     container for the value of that variable and returns it as a Result object.
 
+    Variables are read with ``fetch_namespace_vars``, so fetching several variables from
+    the same deployment execs into the pod only once.
+
     Params:
         fetch_var (str): An environment variable expected on the target container
         hide (bool, optional): Hides the stdout if True. Defaults to False.
@@ -78,45 +174,248 @@ def fetch_namespace_var(c, fetch_var, hide=False):
     Usage:
         inv <ENVIRONMENT> pod.fetch-namespace-var --fetch-var="<VARIABLE_NAME>"
     """
-    command = (
-        f"kubectl --namespace {c.config.namespace} exec -i "
-        f"deploy/{c.config.container_name} -- printenv {fetch_var}"
+    env = fetch_namespace_vars(c, [fetch_var])
+    command = f"printenv {fetch_var}"
+    if fetch_var not in env:
+        raise invoke.exceptions.UnexpectedExit(invoke.Result(command=command, exited=1))
+    result = invoke.Result(stdout=f"{env[fetch_var]}\n", command=command, exited=0)
+    if not hide:
+        print(result.stdout, end="")
+    return result
+
+
+def format_throughput(size, seconds):
+    """Describe a transfer of ``size`` bytes, e.g. "1230.5 MiB in 60.0s (20.5 MiB/s)"."""
+    rate = size / seconds / 2**20 if seconds else 0
+    return f"{size / 2**20:.1f} MiB in {seconds:.1f}s ({rate:.1f} MiB/s)"
+
+
+def extract_tar_stream(chunks, dest):
+    """Extract a tar stream, given as an iterable of bytes, into the ``dest`` directory.
+
+    Returns:
+        int: The number of bytes received.
+    """
+    os.makedirs(dest, exist_ok=True)
+    tar = subprocess.Popen(["tar", "-x", "-f", "-", "-C", dest], stdin=subprocess.PIPE)
+    received = 0
+    start = reported = time.monotonic()
+    try:
+        for chunk in chunks:
+            tar.stdin.write(chunk)
+            received += len(chunk)
+            if time.monotonic() - reported > 5:
+                reported = time.monotonic()
+                progress = format_throughput(received, reported - start)
+                print(Style.DIM + f"Received {progress}", file=sys.stderr)
+    finally:
+        tar.stdin.close()
+        tar.wait()
+    if tar.returncode:
+        raise invoke.exceptions.Exit(f"tar exited with status {tar.returncode}")
+    return received
+
+
+def dump_directory(c, db_var, dest, jobs, compress=None, scratch_dir="/tmp"):
+    """Run a parallel directory-format pg_dump in the pod and extract it into ``dest``.
+
+    pg_dump writes the dump to a scratch directory in the container, which is then
+    streamed back as a tar archive and removed.
+    """
+    namespace = c.config.namespace
+    compress = f"--compress={compress}" if compress else ""
+    script = (
+        "set -e; "
+        f'dir=$(mktemp -d "{scratch_dir}/kubesae-dump.XXXXXX"); '
+        "trap 'rm -rf \"$dir\"' EXIT; "
+        f'pg_dump -Fd -j {jobs} {compress} --no-owner --clean --dbname "${db_var}" '
+        '-f "$dir/dump" >&2; '
+        'tar -C "$dir/dump" -cf - .'
     )
-    return c.run(command, hide=hide)
+
+    def api_dump(client):
+        pod, container = client.find_pod(namespace, c.config.container_name)
+        status = {}
+
+        def chunks():
+            stream = client.exec_stream(namespace, pod, ["sh", "-c", script], container)
+            for channel, data in stream:
+                if channel == kube.STDOUT_CHANNEL:
+                    yield data
+                elif channel == kube.STDERR_CHANNEL:
+                    sys.stderr.write(data.decode(errors="replace"))
+                elif channel == kube.ERROR_CHANNEL:
+                    status["exited"] = kube.exit_code(json.loads(data))
+
+        received = extract_tar_stream(chunks(), dest)
+        if status.get("exited") is None:
+            raise kube.KubeStreamError(
+                f"exec stream of {pod} closed before pg_dump finished"
+            )
+        return status["exited"], received
+
+    def kubectl_dump():
+        # the API may have failed after tar had started extracting into dest
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        process = subprocess.Popen(
+            shlex.split(kube.kubectl(c))
+            + ["--namespace", namespace, "exec", "-i"]
+            + [f"deploy/{c.config.container_name}", "--", "sh", "-c", script],
+            stdout=subprocess.PIPE,
+        )
+        chunks = iter(lambda: process.stdout.read(2**20), b"")
+        received = extract_tar_stream(chunks, dest)
+        return process.wait(), received
+
+    start = time.monotonic()
+    exited, received = kube.api_or_kubectl(c, api_dump, kubectl_dump)
+    if exited:
+        raise invoke.exceptions.Exit(f"pg_dump failed with status {exited}")
+    print(f"Dumped {format_throughput(received, time.monotonic() - start)} to {dest}")
 
 
 @invoke.task()
-def get_db_dump(c, db_var=DEFAULT_DB_VAR, filename=None):
+def get_db_dump(
+    c, db_var=DEFAULT_DB_VAR, filename=None, jobs=0, compress=None, scratch_dir="/tmp"
+):
     """Get a database dump (into the filename).
 
+    By default a custom-format archive is written to a single file. With --jobs, a
+    directory-format dump is made with that many parallel pg_dump jobs in the pod,
+    streamed back as a tar archive and extracted into the filename directory.
+
     Params:
         db_var (str): The variable name that the database connection is stored in. DEFAULT: DATABASE_URL
-        filename (string, optional): A filename to store the dump. If None, will default to {namespace}_database.dump.
+        filename (string, optional): A filename to store the dump. If None, will default to {namespace}_database.dump,
+            or the directory {namespace}_database with --jobs.
+        jobs (int, optional): Dump in directory format with this many parallel jobs.
+        compress (str, optional): pg_dump --compress setting for --jobs, e.g. "6" or "zstd:3" (PostgreSQL 16+).
+        scratch_dir (str, optional): Where the pod writes the dump for --jobs. DEFAULT: /tmp
     Usage:
         inv <ENVIRONMENT> pod.get-db-dump --db-var="<DB_VAR_NAME>"
+        inv <ENVIRONMENT> pod.get-db-dump --jobs=4 --compress=6
     """
+    if jobs:
+        if not filename:
+            filename = f"{c.config.namespace}_database"
+        if os.path.exists(filename) and (
+            not os.path.isdir(filename) or os.listdir(filename)
+        ):
+            raise invoke.exceptions.Exit(f"{filename} already exists and is not empty.")
+        dump_directory(c, db_var, filename, jobs, compress, scratch_dir)
+        return
     if not filename:
         filename = f"{c.config.namespace}_database.dump"
     command = (
-        f"kubectl --namespace {c.config.namespace} exec -i "
+        f"{kube.kubectl(c)} --namespace {c.config.namespace} exec -i "
         f"deploy/{c.config.container_name} -- sh -c 'pg_dump -Fc --no-owner --clean "
         f"--dbname ${db_var}' > {filename}"
     )
     c.run(command)
 
 
+def find_pod(c):
+    """Return the name of a running pod of the configured deployment."""
+    namespace = c.config.namespace
+    return kube.api_or_kubectl(
+        c,
+        lambda client: client.find_pod(namespace, c.config.container_name)[0],
+        lambda: c.run(
+            f"{kube.kubectl(c)} --namespace {namespace} "
+            f"exec deploy/{c.config.container_name} "
+            "-- hostname",
+            hide="out",
+        ).stdout.strip(),
+    )
+
+
+def checksum_manifest(path):
+    """Return the size of a file or directory tree and its sha256sum-style manifest.
+
+    Paths in the manifest are relative to the parent of ``path``.
+    """
+    parent = os.path.dirname(os.path.abspath(path))
+    if os.path.isdir(path):
+        files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(path)
+            for name in names
+        )
+    else:
+        files = [path]
+    size, lines = 0, []
+    for file in files:
+        digest = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                digest.update(block)
+                size += len(block)
+        lines.append(f"{digest.hexdigest()}  {os.path.relpath(file, parent)}")
+    return size, "\n".join(lines) + "\n"
+
+
+def copy_to_pod(c, pod_name, path, remote_dir):
+    """Copy a file or directory into ``remote_dir`` on a pod and verify its checksums."""
+    exec_ = f"{kube.kubectl(c)} --namespace {c.config.namespace} exec -i {pod_name} --"
+    parent, name = os.path.split(os.path.abspath(path))
+    start = time.monotonic()
+    c.run(
+        f"tar -C {shlex.quote(parent)} -cf - {shlex.quote(name)} "
+        f"| {exec_} tar -xf - -C {remote_dir}"
+    )
+    size, manifest = checksum_manifest(path)
+    verify = f"cd {remote_dir} && printf %s {shlex.quote(manifest)} | sha256sum -c -"
+    c.run(f"{exec_} sh -c {shlex.quote(verify)}", hide="out")
+    print(f"Copied and verified {format_throughput(size, time.monotonic() - start)}")
+
+
+def restore_parallel(c, filename, db_var, jobs, scratch_dir="/tmp"):
+    """Copy a dump into a pod and restore it from there with parallel pg_restore jobs.
+
+    pg_restore needs a seekable archive for --jobs, so it can't read from stdin. The
+    copy is removed again once the restore has finished or failed.
+    """
+    pod_name = find_pod(c)
+    exec_ = f"{kube.kubectl(c)} --namespace {c.config.namespace} exec -i {pod_name} --"
+    remote_dir = c.run(
+        f'{exec_} mktemp -d "{scratch_dir}/kubesae-restore.XXXXXX"', hide="out"
+    ).stdout.strip()
+    try:
+        copy_to_pod(c, pod_name, filename, remote_dir)
+        archive = f"{remote_dir}/{os.path.basename(os.path.abspath(filename))}"
+        c.run(
+            f"{exec_} sh -c 'pg_restore -j {jobs} --no-privileges --no-owner --clean "
+            f'--if-exists --dbname "${db_var}" {archive}\''
+        )
+    finally:
+        c.run(f"{exec_} rm -rf {remote_dir}", warn=True)
+
+
 @invoke.task()
-def restore_db_from_dump(c, filename, db_var=DEFAULT_DB_VAR):
+def restore_db_from_dump(
+    c, filename, db_var=DEFAULT_DB_VAR, jobs=0, scratch_dir="/tmp"
+):
     """Load a database dump from a file.
 
+    By default the dump is fed to pg_restore over stdin. With --jobs, or when restoring a
+    directory-format dump, it is first copied into the pod (and its checksum verified) so
+    pg_restore can run that many parallel jobs, and removed again afterwards.
+
     Params:
         db_var (str): The variable the database connection is stored in. DEFAULT: DATABASE_URL
         filename (string): An filename of the dump to restore.
+        jobs (int, optional): Restore with this many parallel pg_restore jobs.
+        scratch_dir (str, optional): Where to copy the dump in the pod for --jobs. DEFAULT: /tmp
     Usage:
         inv <ENVIRONMENT> pod.restore-db-from-dump --db-var="<DB_VAR_NAME>" --filename="<PATH/TO/DBFILE>"
+        inv <ENVIRONMENT> pod.restore-db-from-dump --filename="<PATH/TO/DBFILE>" --jobs=4
     """
+    if jobs or os.path.isdir(filename):
+        restore_parallel(c, filename, db_var, jobs or 1, scratch_dir)
+        return
     command = (
-        f"kubectl --namespace {c.config.namespace} exec -i "
+        f"{kube.kubectl(c)} --namespace {c.config.namespace} exec -i "
         f"deploy/{c.config.container_name} -- sh -c '"
         f"pg_restore --no-privileges --no-owner --clean --if-exists --dbname ${db_var}' < {filename}"
     )
@@ -7,6 +7,7 @@ import invoke
 
 from colorama import Style
 
+from kubesae import s3, sync
 from kubesae.pod import fetch_namespace_var
 
 
@@ -60,6 +61,10 @@ def sync_media_tree(
     sibling=False,
     dry_run=False,
     delete=False,
+    workers=None,
+    relist=False,
+    target_provider="aws",
+    target_context=None,
 ):
     """Syncs a media bucket between two namespaces (e.g. `production` to `staging`, or `staging` to `local`).
 
@@ -78,6 +83,17 @@ def sync_media_tree(
         bucket_path (string, optional): If set, appends to the bucket the extra path information.
         sibling     (boolean, optional): If set, assumes that the target bucket is on the same S3 bucket but in a different location folder. Uses the `sync_to` for target path.
         delete       (boolean, optional): If set, deletes files on the target that do not exist on the source.
+        workers      (int, optional): The number of objects copied at once. Defaults to the aws.sync_workers config, or 32.
+        relist       (boolean, optional): If set, lists the target bucket again instead of using the manifest saved by the last sync.
+                                         Use it after the target bucket was changed by other means (objects deleted or overwritten),
+                                         which a sync otherwise only notices once the manifest is a week old.
+        target_provider (string, optional): "gcp" to sync to a Google Cloud Storage bucket, e.g. when migrating a project. DEFAULT: aws
+        target_context  (string, optional): The kubeconfig context of the target environment's cluster, if it isn't the current one.
+
+    Objects are compared by size and ETag (or modification time) and copied server-side
+    between buckets. The target bucket's listing is saved after each sync, so the next sync
+    only lists the source, and skips the folders that haven't changed since. Objects synced
+    to Google Cloud Storage are streamed through memory, without being written to disk.
 
     Usage:
         inv production aws.sync-media --dry-run:
@@ -94,11 +110,11 @@ def sync_media_tree(
             Will sync files from the production bucket to "<PROJECT_ROOT>/public/media"
 
         inv production aws.sync-media --sync-to="local" --local-target="./public/media/chandler-bing" --bucket-path="chandler-bing"
+
+        inv production aws.sync-media --sync-to="production" --target-provider="gcp" --target-context="gke-cluster"
+            Will sync files from the production S3 bucket to the bucket of the production namespace in the "gke-cluster" cluster.
     """
     sync_from = c.config.env
-    target_media_name = ""
-    dr = ""
-    dl = ""
     sibling_bucket = ""
 
     source_media_name = fetch_namespace_var(
@@ -108,17 +124,14 @@ def sync_media_tree(
     if bucket_path:
         source_media_name += f"/{bucket_path.strip('/')}"
 
-    if sync_from == sync_to:
+    if sync_from == sync_to and not (target_context or target_provider != "aws"):
         print("Source and Target environments are the same. Nothing to be done.")
         return
 
     if sync_to == "local":
-        target_media_name = local_target
+        target = sync.LocalStore(local_target)
     else:
-        cc = invoke.context.Context()
-        cc.config.env = sync_to
-        cc.config.namespace = f"{c.config.app}-{sync_to}"
-        cc.config.container_name = c.config.container_name
+        cc = sync.namespace_context(c, sync_to, target_context)
 
         if sibling:
             cc.config.env = c.config.env
@@ -128,16 +141,31 @@ def sync_media_tree(
         target_media_name = fetch_namespace_var(
             cc, fetch_var=f"{media_bucket}"
         ).stdout.strip()
-        target_media_name = f"s3://{target_media_name}{sibling_bucket}"
-
-    if dry_run:
-        dr = "--dryrun"
-    if delete:
-        dl = "--delete"
-
-    c.run(
-        f"aws s3 sync --acl {acl} s3://{source_media_name} {target_media_name} {dr} {dl}"
+        if target_provider == "gcp":
+            target = sync.GCSStore(
+                sync.get_gcs_client(), f"{target_media_name}{sibling_bucket}"
+            )
+        else:
+            target = sync.S3Store(
+                s3.get_client(), f"{target_media_name}{sibling_bucket}"
+            )
+
+    source = sync.S3Store(s3.get_client(), source_media_name)
+    print(Style.DIM + f"Syncing {source} to {target}")
+    stats = sync.sync(
+        source,
+        target,
+        workers=int(
+            workers
+            or c.config.get("aws", {}).get("sync_workers")
+            or sync.DEFAULT_WORKERS
+        ),
+        acl=acl,
+        delete=delete,
+        dry_run=dry_run,
+        relist=relist,
     )
+    sync.report(stats)
 
 
 aws = invoke.Collection("aws")
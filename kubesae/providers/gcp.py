@@ -5,6 +5,9 @@ Provides helpful utilities for working with kubernetes and the Google Container
 
 import invoke
 
+from colorama import Style
+
+from kubesae import s3, sync
 from kubesae.pod import fetch_namespace_var
 
 
@@ -57,6 +60,11 @@ def sync_media_tree(
     bucket_path="",
     dry_run=False,
     delete=False,
+    target_provider="gcp",
+    target_context=None,
+    acl="private",
+    workers=None,
+    relist=False,
 ):
     """Sync a gcloud media tree for a given environment/namespace to another.
 
@@ -68,6 +76,16 @@ def sync_media_tree(
         bucket_path (string, optional): If set, appends to the bucket the extra path information.
         dry_run      (boolean, optional): Outputs the result to stdout without applying the action
         delete       (boolean, optional): If set, deletes files on the target that do not exist on the source.
+        target_provider (string, optional): "aws" to sync to an S3 bucket, e.g. when migrating a project. DEFAULT: gcp
+        target_context  (string, optional): The kubeconfig context of the target environment's cluster, if it isn't the current one.
+        acl          (string, optional): The canned ACL of each object synced to S3. DEFAULT: private
+        workers      (int, optional): The number of objects synced to S3 at once. Defaults to the gcp.sync_workers config, or 32.
+        relist       (boolean, optional): If set, lists the S3 bucket again instead of using the manifest saved by the last sync.
+                                         Use it after the S3 bucket was changed by other means (objects deleted or overwritten),
+                                         which a sync otherwise only notices once the manifest is a week old.
+
+    Syncing to S3 happens in-process: objects are streamed from one provider to the other
+    through memory, and objects whose size and MD5 already match are skipped.
 
     Usage:
         inv production gcp.sync-media --dry-run:
@@ -84,6 +102,9 @@ def sync_media_tree(
             Will sync files from the production bucket to "<PROJECT_ROOT>/public/media"
 
         inv production gcp.sync-media --sync-to="local" --local-target="./public/media/chandler-bing" --bucket-path="chandler-bing"
+
+        inv production gcp.sync-media --sync-to="production" --target-provider="aws" --target-context="eks-cluster"
+            Will sync files from the production bucket to the S3 bucket of the production namespace in the "eks-cluster" cluster.
     """
     sync_from = c.config.env
     target_media_name = ""
@@ -97,21 +118,37 @@ def sync_media_tree(
     if bucket_path:
         source_media_name += f"/{bucket_path.strip('/')}"
 
-    if sync_from == sync_to:
+    if sync_from == sync_to and not (target_context or target_provider != "gcp"):
         print("Source and Target environments are the same. Nothing to be done.")
         return
 
     if sync_to == "local":
         target_media_name = local_target
     else:
-        cc = invoke.context.Context()
-        cc.config.env = sync_to
-        cc.config.namespace = f"{c.config.app}-{sync_to}"
-        cc.config.container_name = c.config.container_name
+        cc = sync.namespace_context(c, sync_to, target_context)
 
         target_media_name = fetch_namespace_var(
             cc, fetch_var=f"{media_bucket}"
         ).stdout.strip()
+        if target_provider == "aws":
+            target = sync.S3Store(s3.get_client(), target_media_name)
+            source = sync.GCSStore(sync.get_gcs_client(), source_media_name)
+            print(Style.DIM + f"Syncing {source} to {target}")
+            stats = sync.sync(
+                source,
+                target,
+                workers=int(
+                    workers
+                    or c.config.get("gcp", {}).get("sync_workers")
+                    or sync.DEFAULT_WORKERS
+                ),
+                acl=acl,
+                delete=delete,
+                dry_run=dry_run,
+                relist=relist,
+            )
+            sync.report(stats)
+            return
         target_media_name = f"gs://{target_media_name}"
 
     if dry_run:
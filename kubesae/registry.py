@@ -0,0 +1,332 @@
+"""Container registry module.
+
+Provides a small in-process client for the OCI distribution API (Docker Hub, ECR, GCR,
+``registry:2`` and so on), used by ``image.push`` to check what a registry already has
+and to push OCI image archives without a Docker daemon.
+
+Credentials come from the Docker config (``$DOCKER_CONFIG/config.json``): ``auths``
+entries, and ``credHelpers`` or ``credsStore`` credential helpers such as
+``docker-credential-ecr-login``. Registries on localhost, or listed in the config
+``image_insecure_registries``, are reached over plain HTTP.
+"""
+
+import base64
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import subprocess
+import tarfile
+import threading
+import urllib.parse
+
+import invoke
+
+DOCKER_HUB = "registry-1.docker.io"
+DOCKER_HUB_AUTH_KEY = "https://index.docker.io/v1/"
+INDEX_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+)
+MANIFEST_TYPES = INDEX_TYPES + (
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+)
+UPLOAD_WORKERS = 4
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class RegistryError(invoke.exceptions.Exit):
+    """The registry rejected a request."""
+
+    def __init__(self, status, reason, message=""):
+        self.status = status
+        super().__init__(f"Registry error: {status} {reason} {message}".strip())
+
+    def __str__(self):
+        return self.message
+
+
+def parse_reference(reference):
+    """Split ``[host/]repository[:tag][@digest]`` into ``(host, repository, tag or digest)``."""
+    name, _, digest = reference.partition("@")
+    tag = "latest"
+    if ":" in name.rsplit("/", 1)[-1]:
+        name, tag = name.rsplit(":", 1)
+    host, _, path = name.partition("/")
+    if not path or not ("." in host or ":" in host or host == "localhost"):
+        host, path = DOCKER_HUB, name
+        if "/" not in path:
+            path = f"library/{path}"
+    return host, path, digest or tag
+
+
+def parse_challenge(header):
+    """Parse a WWW-Authenticate header into its scheme and parameters."""
+    scheme, _, rest = header.partition(" ")
+    return scheme.lower(), dict(re.findall(r'(\w+)="([^"]*)"', rest))
+
+
+def docker_credentials(host):
+    """Return the ``(username, password)`` the Docker config has for a registry, if any."""
+    path = os.path.join(
+        os.environ.get("DOCKER_CONFIG") or os.path.expanduser("~/.docker"),
+        "config.json",
+    )
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return None
+    key = DOCKER_HUB_AUTH_KEY if host == DOCKER_HUB else host
+    helper = config.get("credHelpers", {}).get(key) or config.get("credsStore")
+    auth = config.get("auths", {}).get(key, {}).get("auth")
+    if auth:
+        username, _, password = base64.b64decode(auth).decode().partition(":")
+        return username, password
+    if helper:
+        try:
+            result = subprocess.run(
+                [f"docker-credential-{helper}", "get"],
+                input=key,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            credentials = json.loads(result.stdout)
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return None
+        return credentials["Username"], credentials["Secret"]
+    return None
+
+
+class RegistryClient:
+    """A pooled client for one registry, handling basic and bearer token auth."""
+
+    def __init__(self, host, insecure=False):
+        import urllib3
+
+        self.host = host
+        self.base = f"{'http' if insecure else 'https'}://{host}"
+        self.pool = urllib3.PoolManager(
+            maxsize=UPLOAD_WORKERS + 1,
+            retries=False,
+            timeout=urllib3.Timeout(connect=10, read=300),
+        )
+        self._credentials = None
+        self._tokens = {}
+        # the last authorization granted, tried first to save a challenge per request
+        self._authorization = None
+        self._lock = threading.Lock()
+
+    def credentials(self):
+        if self._credentials is None:
+            self._credentials = docker_credentials(self.host) or ()
+        return self._credentials
+
+    def authorization(self, challenge):
+        """Return the Authorization header answering a WWW-Authenticate challenge."""
+        import urllib3
+
+        scheme, params = parse_challenge(challenge)
+        credentials = self.credentials()
+        if scheme == "basic":
+            if not credentials:
+                return None
+            token = base64.b64encode(":".join(credentials).encode()).decode()
+            return f"Basic {token}"
+        key = (params.get("service"), params.get("scope"))
+        with self._lock:
+            if key not in self._tokens:
+                query = {k: v for k, v in zip(("service", "scope"), key) if v}
+                headers = {}
+                if credentials:
+                    headers = urllib3.make_headers(basic_auth=":".join(credentials))
+                response = self.pool.request(
+                    "GET",
+                    f"{params['realm']}?{urllib.parse.urlencode(query)}",
+                    headers=headers,
+                )
+                if response.status != 200:
+                    raise RegistryError(
+                        response.status, response.reason, "getting a token"
+                    )
+                body = json.loads(response.data)
+                self._tokens[key] = body.get("token") or body.get("access_token")
+            return f"Bearer {self._tokens[key]}"
+
+    def request(self, method, path, headers=None, body=None, ok=(200,), **kwargs):
+        """Send a request, answering an auth challenge once, and return the response.
+
+        ``path`` may be a full URL, as upload locations can be. Responses with a status
+        outside ``ok`` raise RegistryError.
+        """
+        import urllib3
+
+        url = path if "://" in path else f"{self.base}{path}"
+        headers = dict(headers or {})
+        authorization = self._authorization
+        for attempt in range(2):
+            if authorization:
+                headers["Authorization"] = authorization
+            if hasattr(body, "seek"):
+                body.seek(0)
+            try:
+                response = self.pool.request(
+                    method, url, headers=headers, body=body, redirect=False, **kwargs
+                )
+            except urllib3.exceptions.HTTPError as e:
+                raise RegistryError(0, "unreachable", str(e))
+            challenge = response.headers.get("WWW-Authenticate")
+            if response.status == 401 and attempt == 0 and challenge:
+                authorization = self.authorization(challenge)
+                if authorization:
+                    self._authorization = authorization
+                    continue
+            break
+        if response.status not in ok:
+            raise RegistryError(
+                response.status,
+                response.reason,
+                f"{method} {path}: {response.data[:200]!r}",
+            )
+        return response
+
+    def manifest_digest(self, repository, reference):
+        """Return the digest of a tag's manifest, or None if the tag doesn't exist."""
+        response = self.request(
+            "HEAD",
+            f"/v2/{repository}/manifests/{reference}",
+            headers={"Accept": ", ".join(MANIFEST_TYPES)},
+            ok=(200, 404),
+        )
+        if response.status == 404:
+            return None
+        return response.headers.get("Docker-Content-Digest")
+
+    def has_blob(self, repository, digest):
+        response = self.request(
+            "HEAD", f"/v2/{repository}/blobs/{digest}", ok=(200, 404)
+        )
+        return response.status == 200
+
+    def upload_blob(self, repository, digest, fileobj, size):
+        """Upload a blob in one request, unless the registry already has it."""
+        if self.has_blob(repository, digest):
+            return False
+        response = self.request("POST", f"/v2/{repository}/blobs/uploads/", ok=(202,))
+        location = urllib.parse.urljoin(f"{self.base}/", response.headers["Location"])
+        separator = "&" if "?" in location else "?"
+        self.request(
+            "PUT",
+            f"{location}{separator}digest={urllib.parse.quote(digest)}",
+            headers={
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(size),
+            },
+            body=fileobj,
+            ok=(201,),
+        )
+        return True
+
+    def put_manifest(self, repository, reference, media_type, data):
+        self.request(
+            "PUT",
+            f"/v2/{repository}/manifests/{reference}",
+            headers={"Content-Type": media_type},
+            body=data,
+            ok=(201,),
+        )
+
+
+def get_client(host, insecure_registries=()):
+    """Return the shared client for a registry host."""
+    insecure = (
+        host.split(":")[0] in ("localhost", "127.0.0.1") or host in insecure_registries
+    )
+    with _clients_lock:
+        if host not in _clients:
+            _clients[host] = RegistryClient(host, insecure)
+        return _clients[host]
+
+
+class OCIArchive:
+    """An OCI image layout in a tar file, as written by ``docker save`` (Docker 25+) or
+    ``docker buildx build --output type=oci``."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tar = tarfile.open(path)
+        self.members = {m.name.lstrip("./"): m for m in self.tar.getmembers()}
+        if "index.json" not in self.members:
+            raise invoke.exceptions.Exit(
+                f"{path} isn't an OCI image archive (it has no index.json)."
+            )
+        self.index = json.loads(self.read("index.json"))
+
+    def blob_member(self, digest):
+        algorithm, _, value = digest.partition(":")
+        return self.members[f"blobs/{algorithm}/{value}"]
+
+    def read(self, name):
+        return self.tar.extractfile(self.members[name]).read()
+
+    def read_blob(self, digest):
+        return self.tar.extractfile(self.blob_member(digest)).read()
+
+    def image(self):
+        """Return the descriptor of the archive's image (manifest or index)."""
+        manifests = self.index.get("manifests", [])
+        if len(manifests) != 1:
+            raise invoke.exceptions.Exit(
+                f"{self.path} has {len(manifests)} images, expected one."
+            )
+        return manifests[0]
+
+    def close(self):
+        self.tar.close()
+
+
+def push_archive(client, archive, repository, tag, workers=UPLOAD_WORKERS):
+    """Push an archive's image to ``repository:tag``, uploading only the blobs the
+    registry doesn't have.
+
+    Returns the number of blobs uploaded, or None when the tag already points at the
+    same manifest and nothing was pushed.
+    """
+    descriptor = archive.image()
+    if client.manifest_digest(repository, tag) == descriptor["digest"]:
+        return None
+    uploaded = 0
+
+    def upload(digest):
+        member = archive.blob_member(digest)
+        # each upload reads its own file handle, so uploads can run concurrently
+        with tarfile.open(archive.path) as tar:
+            fileobj = tar.extractfile(tar.getmember(member.name))
+            return client.upload_blob(repository, digest, fileobj, member.size)
+
+    def push_manifest(descriptor, reference):
+        nonlocal uploaded
+        data = archive.read_blob(descriptor["digest"])
+        if hashlib.sha256(data).hexdigest() != descriptor["digest"].partition(":")[2]:
+            raise invoke.exceptions.Exit(
+                f"{descriptor['digest']} is corrupt in {archive.path}"
+            )
+        manifest = json.loads(data)
+        media_type = descriptor.get("mediaType") or manifest.get("mediaType")
+        if media_type in INDEX_TYPES:
+            for child in manifest["manifests"]:
+                push_manifest(child, child["digest"])
+        else:
+            blobs = [manifest["config"]["digest"]]
+            blobs += [layer["digest"] for layer in manifest["layers"]]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                uploaded += sum(executor.map(upload, blobs))
+        client.put_manifest(repository, reference, media_type, data)
+
+    push_manifest(descriptor, tag)
+    return uploaded
@@ -0,0 +1,435 @@
+"""S3 module.
+
+Provides in-process S3 transfers used by the backup tasks.
+"""
+
+import base64
+import concurrent.futures
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PART_SIZE = 64 * 2**20
+DEFAULT_CACHE_SIZE = 10 * 2**30
+DEFAULT_LISTING_TTL = 300
+FULL_LISTING_INTERVAL = 24 * 3600
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class ChecksumMismatch(Exception):
+    """A downloaded file doesn't match the object's ETag or checksum."""
+
+
+def get_client(profile=None):
+    """Return a (thread-safe) S3 client for an AWS profile, shared for the process."""
+    with _clients_lock:
+        if profile not in _clients:
+            import boto3
+            import botocore.config
+
+            session = boto3.Session(profile_name=profile)
+            _clients[profile] = session.client(
+                "s3", config=botocore.config.Config(max_pool_connections=50)
+            )
+        return _clients[profile]
+
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(path, state):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _file_digest(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest
+
+
+def verify(s3, bucket, key, head, path, part_md5s):
+    """Check a downloaded file against the object's ETag, or its SHA256 checksum.
+
+    The ETag of an unencrypted (or SSE-S3) object is the MD5 of its content, or for
+    multipart uploads the MD5 of its part MD5s. Those are collected while downloading
+    when the download parts line up with the upload parts, so only single part
+    objects need to be read again.
+
+    Returns:
+        str: What the file was verified against, or None if there was nothing to check.
+    """
+    etag = head["ETag"].strip('"')
+    if head.get("ServerSideEncryption") != "aws:kms":
+        if "-" not in etag:
+            if _file_digest(path, "md5").hexdigest() != etag:
+                raise ChecksumMismatch(f"{path} does not match ETag {etag}")
+            return "etag"
+        if part_md5s:
+            combined = hashlib.md5(b"".join(bytes.fromhex(x) for x in part_md5s))
+            if f"{combined.hexdigest()}-{len(part_md5s)}" != etag:
+                raise ChecksumMismatch(f"{path} does not match ETag {etag}")
+            return "etag"
+    checksums = s3.head_object(Bucket=bucket, Key=key, ChecksumMode="ENABLED")
+    checksum = checksums.get("ChecksumSHA256")
+    if checksum and checksums.get("ChecksumType", "FULL_OBJECT") == "FULL_OBJECT":
+        digest = base64.b64encode(_file_digest(path, "sha256").digest()).decode()
+        if digest != checksum:
+            raise ChecksumMismatch(f"{path} does not match SHA256 checksum {checksum}")
+        return "sha256"
+    return None
+
+
+def download(
+    s3,
+    bucket,
+    key,
+    dest,
+    concurrency=DEFAULT_CONCURRENCY,
+    part_size=DEFAULT_PART_SIZE,
+    progress=None,
+    head=None,
+):
+    """Download an object with concurrent ranged GETs into a preallocated file.
+
+    Parts are written in place into ``<dest>.part``, and the parts already written are
+    recorded in ``<dest>.part.json``, so an interrupted download resumes where it left
+    off as long as the object hasn't changed. The file is verified before being moved
+    to ``dest``.
+
+    Params:
+        s3: A boto3 S3 client.
+        concurrency (int): The number of parts fetched at once.
+        part_size (int): Bytes per ranged GET, unless the object was uploaded in parts,
+            in which case its own part size is used so the ETag can be checked.
+        progress (callable, optional): Called with the number of bytes of each chunk
+            as it is written.
+        head (dict, optional): The object's HeadObject response, if already known.
+
+    Returns:
+        dict: ``size`` of the object, ``resumed`` bytes that were already downloaded and
+        what it was ``verified`` against ("etag", "sha256" or None).
+    """
+    head = head or s3.head_object(Bucket=bucket, Key=key)
+    size, etag = head["ContentLength"], head["ETag"]
+    parts_count = int(etag.strip('"').split("-")[1]) if "-" in etag else 0
+    if parts_count > 1:
+        part_size = s3.head_object(Bucket=bucket, Key=key, PartNumber=1)[
+            "ContentLength"
+        ]
+    elif parts_count == 1:
+        part_size = size or part_size
+    ranges = [
+        (index, start, min(start + part_size, size))
+        for index, start in enumerate(range(0, size, part_size))
+    ]
+    aligned = parts_count == len(ranges)
+
+    partial, state_file = f"{dest}.part", f"{dest}.part.json"
+    state = _load_state(state_file)
+    if not (
+        state
+        and os.path.exists(partial)
+        and state.get("etag") == etag
+        and state.get("size") == size
+        and state.get("part_size") == part_size
+    ):
+        state = {"etag": etag, "size": size, "part_size": part_size, "parts": {}}
+        with open(partial, "wb") as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, size)
+            except (AttributeError, OSError, ValueError):
+                # not supported by the platform or filesystem, or an empty object
+                f.truncate(size)
+        _save_state(state_file, state)
+    resumed = sum(
+        end - start for index, start, end in ranges if str(index) in state["parts"]
+    )
+
+    lock = threading.Lock()
+    fd = os.open(partial, os.O_RDWR)
+
+    def fetch(index, start, end):
+        body = s3.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}", IfMatch=etag
+        )["Body"]
+        digest = hashlib.md5()
+        offset = start
+        for chunk in body.iter_chunks(2**20):
+            os.pwrite(fd, chunk, offset)
+            digest.update(chunk)
+            offset += len(chunk)
+            if progress:
+                progress(len(chunk))
+        if offset != end:
+            raise IOError(
+                f"expected {end - start} bytes for part {index}, got {offset - start}"
+            )
+        # make sure the part is on disk before recording it as done
+        os.fsync(fd)
+        with lock:
+            state["parts"][str(index)] = digest.hexdigest()
+            _save_state(state_file, state)
+
+    try:
+        todo = [r for r in ranges if str(r[0]) not in state["parts"]]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(fetch, *r) for r in todo]:
+                future.result()
+    finally:
+        os.close(fd)
+
+    part_md5s = [state["parts"][str(i)] for i, _, _ in ranges] if aligned else None
+    try:
+        verified = verify(s3, bucket, key, head, partial, part_md5s)
+    except ChecksumMismatch:
+        os.remove(partial)
+        os.remove(state_file)
+        raise
+    os.replace(partial, dest)
+    os.remove(state_file)
+    return {"size": size, "resumed": resumed, "verified": verified}
+
+
+def default_cache_dir(name="backups"):
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "kubesae", name)
+
+
+def link_or_copy(source, dest):
+    """Hardlink ``source`` to ``dest``, or copy it when that isn't possible."""
+    if os.path.exists(dest) and os.path.samefile(source, dest):
+        return "linked"
+    tmp = f"{dest}.kubesae-tmp"
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    try:
+        os.link(source, tmp)
+        method = "linked"
+    except OSError:
+        # e.g. the cache is on another filesystem
+        shutil.copyfile(source, tmp)
+        method = "copied"
+    os.replace(tmp, dest)
+    return method
+
+
+class DownloadCache:
+    """A local cache of downloaded objects, shared by every project on the machine.
+
+    Entries are keyed by bucket, key and ETag, so a changed object is downloaded again.
+    The least recently used entries are removed to keep the cache within ``max_size``
+    bytes. File locks make it safe to share between users or CI runners on one volume.
+
+    Entries are read-only, and so are the files hardlinked to them: writing to one would
+    change the cached object too.
+    """
+
+    def __init__(self, path=None, max_size=DEFAULT_CACHE_SIZE):
+        self.path = path or default_cache_dir()
+        self.max_size = max_size
+
+    def entry(self, bucket, key, etag):
+        digest = hashlib.sha256(f"{bucket}/{key}@{etag}".encode()).hexdigest()
+        return os.path.join(self.path, "objects", digest)
+
+    @contextlib.contextmanager
+    def lock(self, name, blocking=True):
+        """Hold the lock ``name``, yielding whether it was acquired.
+
+        Without ``blocking``, yields False rather than waiting when it is held elsewhere.
+        """
+        path = os.path.join(self.path, f"{name}.lock")
+        while True:
+            f = open(path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                f.close()
+                yield False
+                return
+            # the lock file may have been removed by evict() while we waited for it
+            try:
+                current = os.stat(path)
+            except FileNotFoundError:
+                current = None
+            if current and os.path.samestat(current, os.fstat(f.fileno())):
+                break
+            f.close()
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
+
+    def used(self, entry):
+        # the last use is recorded beside the entry rather than in its mtime, which it
+        # shares with the files linked to it
+        with open(f"{entry}.used", "w"):
+            pass
+
+    def entries(self):
+        """Return (last used, size, path) of the complete entries, oldest first."""
+        objects = os.path.join(self.path, "objects")
+        result = []
+        for name in os.listdir(objects):
+            if "." in name:
+                continue
+            path = os.path.join(objects, name)
+            stat = os.stat(path)
+            try:
+                used = os.stat(f"{path}.used").st_mtime
+            except FileNotFoundError:
+                used = stat.st_mtime
+            result.append((used, stat.st_size, path))
+        return sorted(result)
+
+    def evict(self, size):
+        """Remove least recently used entries until ``size`` more bytes fit the budget.
+
+        Entries being fetched by another process are skipped.
+        """
+        with self.lock("cache"):
+            entries = self.entries()
+            total = sum(x[1] for x in entries)
+            for _, entry_size, path in entries:
+                if total + size <= self.max_size:
+                    break
+                name = os.path.basename(path)
+                with self.lock(name, blocking=False) as locked:
+                    if not locked:
+                        continue
+                    for file in (path, f"{path}.used"):
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(file)
+                    os.remove(os.path.join(self.path, f"{name}.lock"))
+                total -= entry_size
+            # and the locks of entries whose download failed
+            for name in os.listdir(self.path):
+                name, ext = os.path.splitext(name)
+                if ext != ".lock" or name == "cache":
+                    continue
+                if os.path.exists(os.path.join(self.path, "objects", name)):
+                    continue
+                with self.lock(name, blocking=False) as locked:
+                    if locked:
+                        os.remove(os.path.join(self.path, f"{name}.lock"))
+
+    def fetch(self, s3, bucket, key, dest, **kwargs):
+        """Place an object at ``dest``, from the cache if possible.
+
+        Objects are downloaded into the cache first and then hardlinked (or copied) to
+        ``dest``. Objects larger than the whole cache are downloaded straight to ``dest``.
+
+        Returns:
+            dict: ``download()``'s result, plus ``cached`` ("linked" or "copied") when
+            the object was already in the cache.
+        """
+        os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+        head = s3.head_object(Bucket=bucket, Key=key)
+        if head["ContentLength"] > self.max_size:
+            return download(s3, bucket, key, dest, head=head, **kwargs)
+        entry = self.entry(bucket, key, head["ETag"])
+        with self.lock(os.path.basename(entry)):
+            if os.path.exists(entry):
+                result = {"size": head["ContentLength"], "resumed": 0, "verified": None}
+                result["cached"] = link_or_copy(entry, dest)
+            else:
+                self.evict(head["ContentLength"])
+                result = download(s3, bucket, key, entry, head=head, **kwargs)
+                os.chmod(entry, 0o444)
+                link_or_copy(entry, dest)
+            self.used(entry)
+        return result
+
+
+def list_folders(s3, bucket):
+    """Return the top level "folders" of a bucket."""
+    paginator = s3.get_paginator("list_objects_v2")
+    return [
+        prefix["Prefix"]
+        for page in paginator.paginate(Bucket=bucket, Delimiter="/")
+        for prefix in page.get("CommonPrefixes", [])
+    ]
+
+
+class ListingIndex:
+    """An index of the objects in a bucket folder, cached on disk between runs.
+
+    Objects are kept as sorted ``[name, size, timestamp]`` lists, with names relative to
+    the folder. Once the cached listing is older than ``ttl`` seconds it is refreshed
+    incrementally: backups are named ``<schedule>-...`` with a sortable date, so only keys
+    after the newest one of each schedule are listed. A full listing, which also drops
+    expired objects and finds new schedules, is made once a day or on request.
+    """
+
+    def __init__(self, s3, bucket, folder, path=None, ttl=DEFAULT_LISTING_TTL):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = f"{folder.strip('/')}/" if folder else ""
+        self.ttl = ttl
+        digest = hashlib.sha256(f"{bucket}/{self.prefix}".encode()).hexdigest()
+        self.path = os.path.join(
+            path or default_cache_dir("listings"), f"{digest}.json"
+        )
+
+    def list_objects(self, prefix, start_after=None):
+        paginator = self.s3.get_paginator("list_objects_v2")
+        params = {"Bucket": self.bucket, "Prefix": prefix}
+        if start_after:
+            params["StartAfter"] = start_after
+        for page in paginator.paginate(**params):
+            for obj in page.get("Contents", []):
+                yield [
+                    obj["Key"][len(self.prefix) :],
+                    obj["Size"],
+                    int(obj["LastModified"].timestamp()),
+                ]
+
+    def refresh(self, full=False):
+        """List the folder, incrementally unless ``full`` or a full listing is due."""
+        now = time.time()
+        state = _load_state(self.path)
+        if full or not state or now - state["full"] > FULL_LISTING_INTERVAL:
+            state = {"full": now, "objects": list(self.list_objects(self.prefix))}
+        else:
+            newest = {}
+            for name, _, _ in state["objects"]:
+                schedule = name.split("-")[0]
+                newest[schedule] = max(newest.get(schedule, ""), name)
+            for schedule, name in newest.items():
+                state["objects"] += self.list_objects(
+                    f"{self.prefix}{schedule}-", f"{self.prefix}{name}"
+                )
+            state["objects"].sort()
+        state["updated"] = now
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        _save_state(self.path, state)
+        return state["objects"]
+
+    def objects(self, refresh=False):
+        """Return the objects in the folder, from the cache while it's fresh enough.
+
+        Params:
+            refresh (bool): Make a full listing, ignoring the cache.
+        """
+        state = _load_state(self.path)
+        if refresh or not state or time.time() - state["updated"] > self.ttl:
+            return self.refresh(full=refresh)
+        return state["objects"]
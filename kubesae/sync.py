@@ -0,0 +1,510 @@
+"""Sync module.
+
+Provides an in-process engine to sync a bucket (or a folder of one) to another bucket or
+a local directory, used by ``aws.sync-media`` and ``gcp.sync-media``. Buckets can be on
+S3 or Google Cloud Storage; syncing from one to the other streams objects through memory.
+
+Both sides are split into prefixes that are listed and compared concurrently, and the
+objects that differ are transferred by a pool of workers, server-side where possible.
+After a sync the target's listing is saved as a manifest, so a later sync doesn't list the
+target again, and skips the prefixes whose source listing hasn't changed at all. Changes
+made to the target by other means are only noticed once the manifest is older than
+MANIFEST_MAX_AGE, or when the sync is run with ``relist``.
+"""
+
+import base64
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import invoke
+
+from kubesae import s3
+
+DEFAULT_WORKERS = 32
+# objects streamed between providers are read and uploaded in chunks of this size
+STREAM_CHUNK_SIZE = 8 * 2**20
+# the largest object CopyObject can copy in one request
+MAX_COPY_SIZE = 5 * 2**30
+# list the target again when its manifest is older than this
+MANIFEST_MAX_AGE = 7 * 24 * 3600
+
+
+class S3Store:
+    """A bucket, or a folder of one.
+
+    Objects are listed as ``{name: [size, etag, timestamp]}``, with names relative to
+    the folder.
+    """
+
+    manifest = True
+
+    def __init__(self, client, location):
+        self.client = client
+        self.bucket, _, folder = location.partition("/")
+        self.root = f"{folder.strip('/')}/" if folder.strip("/") else ""
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.root}"
+
+    def url(self, name):
+        return f"s3://{self.bucket}/{self.root}{name}"
+
+    def children(self, prefix):
+        """Return whether there are objects directly in a prefix, and its sub-prefixes."""
+        paginator = self.client.get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=self.bucket, Prefix=self.root + prefix, Delimiter="/"
+        )
+        has_objects, prefixes = False, []
+        for page in pages:
+            has_objects = has_objects or bool(page.get("Contents"))
+            prefixes += [
+                x["Prefix"][len(self.root) :] for x in page.get("CommonPrefixes", [])
+            ]
+        return has_objects, prefixes
+
+    def list(self, prefix, recursive=True):
+        paginator = self.client.get_paginator("list_objects_v2")
+        params = {"Bucket": self.bucket, "Prefix": self.root + prefix}
+        if not recursive:
+            params["Delimiter"] = "/"
+        objects = {}
+        for page in paginator.paginate(**params):
+            for obj in page.get("Contents", []):
+                objects[obj["Key"][len(self.root) :]] = [
+                    obj["Size"],
+                    obj["ETag"].strip('"'),
+                    obj["LastModified"].timestamp(),
+                ]
+        return objects
+
+    def open(self, name):
+        return self.client.get_object(Bucket=self.bucket, Key=self.root + name)["Body"]
+
+    def download(self, name, path):
+        self.client.download_file(self.bucket, self.root + name, path)
+
+    def copy_from(self, source, name, entry, acl=None):
+        """Copy an object from another S3Store server-side, or stream it from elsewhere."""
+        extra = {"ACL": acl} if acl else {}
+        if not isinstance(source, S3Store):
+            import boto3.s3.transfer
+
+            # a multipart upload, holding at most a few chunks in memory
+            config = boto3.s3.transfer.TransferConfig(
+                multipart_threshold=STREAM_CHUNK_SIZE,
+                multipart_chunksize=STREAM_CHUNK_SIZE,
+                max_concurrency=2,
+            )
+            with contextlib.closing(source.open(name)) as body:
+                self.client.upload_fileobj(
+                    body, self.bucket, self.root + name, ExtraArgs=extra, Config=config
+                )
+            return [entry[0], None, time.time()]
+        copy_source = {"Bucket": source.bucket, "Key": source.root + name}
+        if entry[0] > MAX_COPY_SIZE:
+            self.client.copy(
+                copy_source, self.bucket, self.root + name, ExtraArgs=extra or None
+            )
+            return [entry[0], None, time.time()]
+        result = self.client.copy_object(
+            CopySource=copy_source, Bucket=self.bucket, Key=self.root + name, **extra
+        )["CopyObjectResult"]
+        return [entry[0], result["ETag"].strip('"'), result["LastModified"].timestamp()]
+
+    def delete(self, names):
+        errors = []
+        for start in range(0, len(names), 1000):
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [
+                        {"Key": self.root + x} for x in names[start : start + 1000]
+                    ],
+                    "Quiet": True,
+                },
+            )
+            errors += response.get("Errors", [])
+        if errors:
+            raise IOError(
+                f"failed to delete {len(errors)} objects: {errors[0]['Message']}"
+            )
+
+
+class LocalStore:
+    """A local directory, which objects are downloaded into.
+
+    Local files have no ETag, so they are compared by size and modification time, which
+    is set to the object's timestamp when it is downloaded.
+    """
+
+    manifest = False
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def url(self, name):
+        return os.path.join(self.path, name)
+
+    def children(self, prefix):
+        directory = os.path.join(self.path, prefix)
+        if not os.path.isdir(directory):
+            return False, []
+        has_objects, prefixes = False, []
+        for entry in os.scandir(directory):
+            if entry.is_dir():
+                prefixes.append(f"{prefix}{entry.name}/")
+            else:
+                has_objects = True
+        return has_objects, prefixes
+
+    def list(self, prefix, recursive=True):
+        objects = {}
+        directory = os.path.join(self.path, prefix)
+        if not os.path.isdir(directory):
+            return objects
+        for dirpath, dirnames, filenames in os.walk(directory):
+            if not recursive:
+                dirnames.clear()
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                name = os.path.relpath(path, self.path).replace(os.sep, "/")
+                objects[name] = [stat.st_size, None, stat.st_mtime]
+        return objects
+
+    def copy_from(self, source, name, entry, acl=None):
+        """Download an object."""
+        path = self.url(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        source.download(name, path)
+        os.utime(path, (entry[2], entry[2]))
+        return [entry[0], None, entry[2]]
+
+    def delete(self, names):
+        for name in names:
+            os.remove(self.url(name))
+
+
+def get_gcs_client():
+    try:
+        from google.cloud import storage
+    except ImportError:
+        raise invoke.exceptions.Exit(
+            "Syncing Google Cloud Storage buckets requires google-cloud-storage: "
+            "pip install invoke-kubesae[gcs]"
+        )
+    return storage.Client()
+
+
+class GCSStore:
+    """A Google Cloud Storage bucket, or a folder of one.
+
+    Objects are listed like an S3Store's, with their MD5 as the ETag so that objects
+    copied between providers can be compared. Composite objects have no MD5.
+    """
+
+    manifest = True
+
+    def __init__(self, client, location):
+        self.client = client
+        bucket, _, folder = location.partition("/")
+        self.bucket = client.bucket(bucket)
+        self.root = f"{folder.strip('/')}/" if folder.strip("/") else ""
+
+    def __str__(self):
+        return f"gs://{self.bucket.name}/{self.root}"
+
+    def url(self, name):
+        return f"gs://{self.bucket.name}/{self.root}{name}"
+
+    def children(self, prefix):
+        blobs = self.client.list_blobs(
+            self.bucket, prefix=self.root + prefix, delimiter="/"
+        )
+        has_objects = False
+        # the iterator collects the prefixes of each page as it goes
+        for _ in blobs:
+            has_objects = True
+        prefixes = [x[len(self.root) :] for x in sorted(blobs.prefixes)]
+        return has_objects, prefixes
+
+    def list(self, prefix, recursive=True):
+        blobs = self.client.list_blobs(
+            self.bucket,
+            prefix=self.root + prefix,
+            delimiter=None if recursive else "/",
+            fields="items(name,size,md5Hash,updated),prefixes,nextPageToken",
+        )
+        return {
+            blob.name[len(self.root) :]: [
+                int(blob.size),
+                base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else None,
+                blob.updated.timestamp(),
+            ]
+            for blob in blobs
+        }
+
+    def open(self, name):
+        blob = self.bucket.blob(self.root + name)
+        return blob.open("rb", chunk_size=STREAM_CHUNK_SIZE)
+
+    def download(self, name, path):
+        self.bucket.blob(self.root + name).download_to_filename(path)
+
+    def copy_from(self, source, name, entry, acl=None):
+        """Copy an object from another GCSStore server-side, or stream it from elsewhere.
+
+        Uniform bucket-level access is the norm on GCS, so ``acl`` is ignored.
+        """
+        blob = self.bucket.blob(self.root + name, chunk_size=STREAM_CHUNK_SIZE)
+        if isinstance(source, GCSStore):
+            token = None
+            while True:
+                token, _, _ = blob.rewrite(
+                    source.bucket.blob(source.root + name), token=token
+                )
+                if token is None:
+                    break
+        else:
+            # a resumable upload, sent a chunk at a time
+            with contextlib.closing(source.open(name)) as body:
+                blob.upload_from_file(body, size=entry[0])
+        return [entry[0], None, time.time()]
+
+    def delete(self, names):
+        for start in range(0, len(names), 100):
+            with self.client.batch():
+                for name in names[start : start + 100]:
+                    self.bucket.delete_blob(self.root + name)
+
+
+def namespace_context(c, env, kube_context=None):
+    """Return a context for another environment of the project, e.g. to find its bucket.
+
+    Params:
+        kube_context (str, optional): The kubeconfig context of that environment's
+            cluster, if it isn't the current one.
+    """
+    cc = invoke.context.Context()
+    cc.config.env = env
+    cc.config.namespace = f"{c.config.app}-{env}"
+    cc.config.container_name = c.config.container_name
+    cc.config.kube = dict(c.config.get("kube") or {})
+    if kube_context:
+        cc.config.kube["context"] = kube_context
+    return cc
+
+
+def report(stats):
+    """Print a summary of a sync, failing if any objects couldn't be synced."""
+    print(
+        f"{stats['copied']} copied ({stats['bytes'] / 2**20:.1f} MiB), "
+        f"{stats['deleted']} deleted, {stats['unchanged']} unchanged, "
+        f"{stats['failed']} failed"
+    )
+    if stats["failed"]:
+        raise invoke.exceptions.Exit(code=1)
+
+
+def differs(source, target):
+    """Whether a source object needs to be copied over a target ``[size, etag, timestamp]``.
+
+    ETags are only comparable for objects uploaded in one part, as multipart ETags
+    depend on the part size. Otherwise objects that are the same size are copied only if
+    the source is newer.
+    """
+    if target is None or source[0] != target[0]:
+        return True
+    if source[1] and target[1] and "-" not in source[1] + target[1]:
+        return source[1] != target[1]
+    return source[2] > target[2]
+
+
+def split_prefixes(stores):
+    """Split stores into the prefixes that can be listed and compared separately.
+
+    A folder with just one sub-folder is split on that sub-folder's contents instead.
+
+    Returns:
+        list: ``(prefix, recursive)`` pairs. The objects directly in the folder that was
+        split are listed without its sub-folders.
+    """
+    base = ""
+    while True:
+        has_objects, prefixes = False, set()
+        for store in stores:
+            store_has_objects, store_prefixes = store.children(base)
+            has_objects = has_objects or store_has_objects
+            prefixes.update(store_prefixes)
+        if len(prefixes) == 1 and not has_objects:
+            base = prefixes.pop()
+            continue
+        return ([(base, False)] if has_objects else []) + [
+            (prefix, True) for prefix in sorted(prefixes)
+        ]
+
+
+def fingerprint(objects):
+    digest = hashlib.sha256()
+    for name in sorted(objects):
+        size, etag, _ = objects[name]
+        digest.update(f"{name}\0{size}\0{etag}\n".encode())
+    return digest.hexdigest()
+
+
+class Manifest:
+    """The target's listing after the last sync, saved per prefix."""
+
+    def __init__(self, source, target, path=None):
+        digest = hashlib.sha256(f"{source} {target}".encode()).hexdigest()
+        self.path = os.path.join(path or s3.default_cache_dir("sync"), digest)
+
+    def _file(self, prefix):
+        return os.path.join(self.path, hashlib.sha256(prefix.encode()).hexdigest())
+
+    def load(self, prefix):
+        try:
+            with open(self._file(prefix)) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - state["time"] > MANIFEST_MAX_AGE:
+            return None
+        return state
+
+    def save(self, prefix, source_fingerprint, objects):
+        os.makedirs(self.path, exist_ok=True)
+        state = {"time": time.time(), "source": source_fingerprint, "objects": objects}
+        with open(f"{self._file(prefix)}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{self._file(prefix)}.tmp", self._file(prefix))
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def sync(
+    source,
+    target,
+    workers=DEFAULT_WORKERS,
+    acl=None,
+    delete=False,
+    dry_run=False,
+    relist=False,
+    manifest_dir=None,
+    log=print,
+):
+    """Make ``target`` match ``source``.
+
+    Params:
+        source (S3Store): Where to copy objects from.
+        target (S3Store or LocalStore): Where to copy them to.
+        workers (int): The number of prefixes listed, and objects copied, at once.
+        acl (str, optional): The canned ACL of objects copied to S3.
+        delete (bool): Delete objects in the target that aren't in the source.
+        dry_run (bool): Only log what would be done.
+        relist (bool): Discard the saved manifest and list the target again, to repair
+            changes made to the target by other means.
+        log (callable): Called with a line for each copy or delete.
+
+    Returns:
+        dict: The number of ``copied``, ``deleted``, ``unchanged`` and ``failed`` objects,
+        and the ``bytes`` copied.
+    """
+    manifest = Manifest(source, target, manifest_dir) if target.manifest else None
+    if manifest and relist:
+        manifest.clear()
+    stats = {"copied": 0, "deleted": 0, "unchanged": 0, "failed": 0, "bytes": 0}
+    lock = threading.Lock()
+
+    def count(**values):
+        with lock:
+            for key, value in values.items():
+                stats[key] += value
+
+    def copy(name, entry):
+        try:
+            result = target.copy_from(source, name, entry, acl)
+        except Exception as e:
+            count(failed=1)
+            log(f"copy failed: {source.url(name)} to {target.url(name)}: {e}")
+            return name, None
+        count(copied=1, bytes=entry[0])
+        log(f"copy: {source.url(name)} to {target.url(name)}")
+        return name, result
+
+    # a target inside the source folder (e.g. with --sibling) isn't part of the source
+    nested = None
+    if isinstance(target, S3Store) and target.bucket == source.bucket:
+        if target.root.startswith(source.root) and target.root != source.root:
+            nested = target.root[len(source.root) :]
+
+    def sync_prefix(prefix_name, recursive, executor):
+        objects = source.list(prefix_name, recursive)
+        if nested:
+            objects = {k: v for k, v in objects.items() if not k.startswith(nested)}
+        source_fingerprint = fingerprint(objects)
+        saved = manifest.load(prefix_name) if manifest else None
+        if saved and saved["source"] == source_fingerprint:
+            count(unchanged=len(objects))
+            return
+        target_objects = (
+            saved["objects"] if saved else target.list(prefix_name, recursive)
+        )
+        changed = [
+            (name, entry)
+            for name, entry in objects.items()
+            if differs(entry, target_objects.get(name))
+        ]
+        removed = sorted(set(target_objects) - set(objects)) if delete else []
+        count(unchanged=len(objects) - len(changed))
+        if dry_run:
+            for name, _ in changed:
+                log(f"(dryrun) copy: {source.url(name)} to {target.url(name)}")
+            for name in removed:
+                log(f"(dryrun) delete: {target.url(name)}")
+            return
+        futures = [executor.submit(copy, name, entry) for name, entry in changed]
+        if removed:
+            try:
+                target.delete(removed)
+            except Exception as e:
+                count(failed=len(removed))
+                log(f"delete failed: {e}")
+            else:
+                count(deleted=len(removed))
+                for name in removed:
+                    log(f"delete: {target.url(name)}")
+                    del target_objects[name]
+        in_sync = True
+        for future in futures:
+            name, result = future.result()
+            if result:
+                target_objects[name] = result
+            else:
+                in_sync = False
+        in_sync = in_sync and set(target_objects) == set(objects)
+        if manifest:
+            # unless the target now matches the source, compare the prefix again next time
+            manifest.save(
+                prefix_name, source_fingerprint if in_sync else None, target_objects
+            )
+
+    # with --delete, prefixes that are only in the target need comparing too
+    prefixes = split_prefixes([source, target] if delete else [source])
+    prefixes = [x for x in prefixes if not (nested and x[0].startswith(nested))]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as listers:
+            for future in [listers.submit(sync_prefix, *x, executor) for x in prefixes]:
+                future.result()
+    return stats
@@ -0,0 +1,253 @@
+"""Profiling module.
+
+Records how long every task and every command run with ``c.run`` takes, with its exit
+code, the bytes of output it produced and the number of subprocesses it started. When
+the ``inv`` run ends, the trace is written in the Chrome trace event format (open it in
+https://ui.perfetto.dev or chrome://tracing) and a summary of the slowest steps is
+printed.
+
+Profiling is enabled by running the ``profile`` task first, or by setting the
+KUBESAE_PROFILE environment variable to the trace's path. ``profile`` isn't part of a
+collection, so it's added to the project's namespace as a task of its own::
+
+    ns.add_task(profile)
+
+    inv profile staging image.tag image.build image.push deploy.deploy
+
+To profile every run, make ``profile`` a pre-task of the environment tasks.
+
+Config:
+
+    profile_output: Where to write the trace (default: kubesae-trace.json)
+"""
+
+import atexit
+import json
+import os
+import subprocess
+import threading
+import time
+
+import invoke
+
+SUMMARY_COMMANDS = 10
+DEFAULT_OUTPUT = "kubesae-trace.json"
+
+_profiler = None
+
+
+def shorten(text, length=80):
+    text = " ".join(str(text).split())
+    return text if len(text) <= length else text[: length - 3] + "..."
+
+
+class Profiler:
+    """Collects spans of tasks and commands, as Chrome trace "complete" events."""
+
+    def __init__(self, path):
+        self.path = path
+        self.start = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # tasks count the subprocesses started by their threads too
+        self.open_tasks = []
+        self.patched = []
+
+    def now(self):
+        return (time.perf_counter() - self.start) * 10**6
+
+    def stack(self):
+        if not hasattr(self.local, "spans"):
+            self.local.spans = []
+        return self.local.spans
+
+    def open(self, name, category):
+        span = {"name": name, "cat": category, "ts": self.now(), "subprocesses": 0}
+        self.stack().append(span)
+        if category == "task":
+            with self.lock:
+                self.open_tasks.append(span)
+        return span
+
+    def close(self, span, **args):
+        self.stack().remove(span)
+        with self.lock:
+            if span in self.open_tasks:
+                self.open_tasks.remove(span)
+            self.events.append(
+                {
+                    "name": span["name"],
+                    "cat": span["cat"],
+                    "ph": "X",
+                    "ts": span["ts"],
+                    "dur": self.now() - span["ts"],
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": dict(args, subprocesses=span["subprocesses"]),
+                }
+            )
+
+    def count_subprocess(self):
+        with self.lock:
+            spans = {id(x): x for x in self.stack() + self.open_tasks}
+            for span in spans.values():
+                span["subprocesses"] += 1
+
+    def patch(self, owner, name, wrapper):
+        original = getattr(owner, name)
+        setattr(owner, name, wrapper(original))
+        self.patched.append((owner, name, original))
+
+    def install(self):
+        """Wrap Context.run, Task.__call__, Popen and pty.fork so they're recorded."""
+        import pty
+
+        profiler = self
+
+        def wrap_run(run):
+            def profiled_run(context, command, **kwargs):
+                span = profiler.open(shorten(command), "run")
+                result = None
+                try:
+                    result = run(context, command, **kwargs)
+                    return result
+                except invoke.exceptions.UnexpectedExit as e:
+                    result = e.result
+                    raise
+                finally:
+                    output = 0
+                    if result is not None:
+                        output = sum(
+                            len((x or "").encode(errors="replace"))
+                            for x in (result.stdout, result.stderr)
+                        )
+                    profiler.close(
+                        span,
+                        exit_code=getattr(result, "exited", None),
+                        output_bytes=output,
+                    )
+
+            return profiled_run
+
+        def wrap_call(call):
+            def profiled_call(task, *args, **kwargs):
+                module = task.body.__module__.rsplit(".", 1)[-1]
+                span = profiler.open(f"{module}.{task.name}", "task")
+                exit_code = 0
+                try:
+                    return call(task, *args, **kwargs)
+                except invoke.exceptions.Exit as e:
+                    exit_code = e.code
+                    raise
+                except BaseException:
+                    exit_code = 1
+                    raise
+                finally:
+                    profiler.close(span, exit_code=exit_code)
+
+            return profiled_call
+
+        def wrap_popen(init):
+            def profiled_init(popen, *args, **kwargs):
+                profiler.count_subprocess()
+                return init(popen, *args, **kwargs)
+
+            return profiled_init
+
+        def wrap_fork(fork):
+            def profiled_fork():
+                profiler.count_subprocess()
+                return fork()
+
+            return profiled_fork
+
+        self.patch(invoke.Context, "run", wrap_run)
+        self.patch(invoke.Task, "__call__", wrap_call)
+        self.patch(subprocess.Popen, "__init__", wrap_popen)
+        # c.run(..., pty=True) forks with pty.fork rather than Popen
+        self.patch(pty, "fork", wrap_fork)
+
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+    def write(self):
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+        os.replace(f"{self.path}.tmp", self.path)
+
+    def summary(self):
+        """Return the text summary: time per task, then the slowest commands."""
+        tasks = {}
+        for event in self.events:
+            if event["cat"] == "task":
+                calls, duration, subprocesses = tasks.get(event["name"], (0, 0, 0))
+                tasks[event["name"]] = (
+                    calls + 1,
+                    duration + event["dur"],
+                    subprocesses + event["args"]["subprocesses"],
+                )
+        lines = [f"{'TASK':<50} {'CALLS':>5} {'TIME':>9} {'SUBPROCESSES':>12}"]
+        for name, (calls, duration, subprocesses) in sorted(
+            tasks.items(), key=lambda x: -x[1][1]
+        ):
+            lines.append(
+                f"{name:<50} {calls:>5} {duration / 10**6:>8.1f}s {subprocesses:>12}"
+            )
+        commands = sorted(
+            (x for x in self.events if x["cat"] == "run"), key=lambda x: -x["dur"]
+        )
+        lines.append(f"\n{'COMMAND':<70} {'EXIT':>4} {'OUTPUT':>9} {'TIME':>9}")
+        for event in commands[:SUMMARY_COMMANDS]:
+            args = event["args"]
+            exit_code = "-" if args["exit_code"] is None else args["exit_code"]
+            lines.append(
+                f"{shorten(event['name'], 70):<70} {exit_code:>4} "
+                f"{args['output_bytes']:>8}B {event['dur'] / 10**6:>8.1f}s"
+            )
+        total = (time.perf_counter() - self.start) * 10**6
+        lines.append(f"\nTotal {total / 10**6:.1f}s, trace written to {self.path}")
+        return "\n".join(lines)
+
+    def finish(self):
+        self.uninstall()
+        self.write()
+        print("\n" + self.summary())
+
+
+def enable(path):
+    """Start profiling tasks and commands, writing the trace to ``path`` at exit."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(os.path.abspath(path))
+        _profiler.install()
+        atexit.register(finish)
+    return _profiler
+
+
+def finish():
+    """Stop profiling, write the trace and print the summary."""
+    global _profiler
+    if _profiler is not None:
+        profiler, _profiler = _profiler, None
+        atexit.unregister(finish)
+        profiler.finish()
+
+
+@invoke.task
+def profile(c, output=None):
+    """Profile the tasks that follow, and the commands they run.
+
+    Config:
+        profile_output: Where to write the trace (default: kubesae-trace.json)
+
+    Params:
+        output: Where to write the trace, in the Chrome trace event format
+
+    Usage: inv profile staging image.build image.push deploy.deploy
+    """
+    path = output or c.config.get("profile_output", DEFAULT_OUTPUT)
+    enable(path)
+    print(f"Profiling, the trace will be written to {path}")
@@ -1,16 +1,55 @@
+import concurrent.futures
+import datetime
 import json
 import re
+import threading
+import time
 
 import invoke
 
+from colorama import Style
+
+from kubesae import kube, s3
+from kubesae.pod import format_throughput
+
 ANSIBLE_HEADER = re.compile(r"^.*\s=>\s")
 BASE_BACKUP_BUCKET = "caktus-hosting-services-backups"
 
 
-def process_backups(schedule_list, search_list):
-    result = {}
-    for schedule in schedule_list:
-        result[schedule] = len(re.findall(f"{schedule}-.*\\.pgdump", search_list))
+def classify_backups(schedules, objects):
+    """Sort backups into their schedules, in a single pass over a listing.
+
+    Backups are named ``<schedule>-<folder>-<date>.pgdump``. As schedule names may contain
+    dashes themselves, each name is matched against the longest schedule it starts with.
+
+    Params:
+        schedules (list): The schedule names.
+        objects (iterable): ``[name, size, timestamp]`` of each object.
+
+    Returns:
+        dict: ``count``, total ``bytes``, and ``oldest`` and ``newest`` timestamps (None
+        if there are no backups) for each schedule, in the order given.
+    """
+    result = {
+        schedule: {"count": 0, "bytes": 0, "oldest": None, "newest": None}
+        for schedule in schedules
+    }
+    for name, size, timestamp in objects:
+        if not name.endswith(".pgdump"):
+            continue
+        stats = None
+        end = name.find("-")
+        while end != -1:
+            stats = result.get(name[:end], stats)
+            end = name.find("-", end + 1)
+        if stats is None:
+            continue
+        stats["count"] += 1
+        stats["bytes"] += size
+        if stats["oldest"] is None or timestamp < stats["oldest"]:
+            stats["oldest"] = timestamp
+        if stats["newest"] is None or timestamp > stats["newest"]:
+            stats["newest"] = timestamp
     return result
 
 
@@ -24,9 +63,85 @@ def result_to_json(result: invoke.Result):
         )
 
 
+def backup_index(c, bucket, folder, profile, refresh=False):
+    """Return the ``[name, size, timestamp]`` of the backups in a folder of a bucket.
+
+    The listing is cached for the hosting_services_backup_listing_ttl config, in
+    seconds (default: 300), and then refreshed incrementally.
+    """
+    index = s3.ListingIndex(
+        s3.get_client(profile),
+        bucket,
+        folder,
+        ttl=c.config.get("hosting_services_backup_listing_ttl", s3.DEFAULT_LISTING_TTL),
+    )
+    return index.objects(refresh=refresh)
+
+
+def format_listing(objects):
+    """Format objects like ``aws s3 ls`` does."""
+    return "\n".join(
+        f"{datetime.datetime.fromtimestamp(timestamp):%Y-%m-%d %H:%M:%S} {size:>10} {name}"
+        for name, size, timestamp in objects
+    )
+
+
+def download_backup(bucket, key, dest, profile, concurrency, cache=None):
+    """Download a backup with the in-process S3 downloader, reporting progress.
+
+    With a ``cache`` (an ``s3.DownloadCache``), backups already in the cache are linked
+    or copied to ``dest`` instead.
+    """
+    print(Style.DIM + f"Downloading s3://{bucket}/{key} to {dest}")
+    lock = threading.Lock()
+    start = time.monotonic()
+    received = {"bytes": 0, "reported": start}
+
+    def progress(size):
+        with lock:
+            received["bytes"] += size
+            if time.monotonic() - received["reported"] > 5:
+                received["reported"] = time.monotonic()
+                report = format_throughput(
+                    received["bytes"], received["reported"] - start
+                )
+                print(Style.DIM + f"Received {report}")
+
+    fetch = cache.fetch if cache else s3.download
+    try:
+        result = fetch(
+            s3.get_client(profile),
+            bucket,
+            key,
+            dest,
+            concurrency=concurrency,
+            progress=progress,
+        )
+    except s3.ChecksumMismatch as e:
+        raise invoke.exceptions.Exit(f"Download failed verification: {e}")
+    if result.get("cached"):
+        print(f"Backup {result['cached']} to {dest} from the cache in {cache.path}")
+        return
+    if result["resumed"]:
+        print(Style.DIM + f"Resumed with {result['resumed']} bytes already downloaded")
+    report = format_throughput(received["bytes"], time.monotonic() - start)
+    verified = (
+        f"verified by {result['verified']}" if result["verified"] else "unverified"
+    )
+    print(f"Downloaded {report} to {dest} ({verified})")
+
+
 @invoke.task(name="get_db_backup")
 def get_backup_from_hosting(
-    c, latest="daily", profile="caktus", backup_name=None, list=False, dest=""
+    c,
+    latest="daily",
+    profile="caktus",
+    backup_name=None,
+    list=False,
+    dest="",
+    concurrency=None,
+    cache=True,
+    refresh=False,
 ):
     """Downloads a backup from the caktus hosting services bucket
 
@@ -38,6 +153,20 @@ def get_backup_from_hosting(
         backup_name(str, optional): A specific backup filename.
         list(bool, optional): If set, will list the contents of the bucket for the projects folder and exit.
         dest (str, optional): Output filename
+        concurrency (int, optional): The number of parts downloaded at once. Defaults to the
+            hosting_services_backup_concurrency config, or 8.
+        cache (bool, optional): Whether to use the local backup cache. Defaults to True.
+        refresh (bool, optional): List the bucket again rather than using the cached listing.
+
+    The download can be resumed by running the same command again if it is interrupted, and
+    is verified against the object's ETag or checksum when it completes.
+
+    Downloaded backups are kept in a local cache, shared by every project on the machine, so
+    fetching the same backup again hardlinks (or copies) it from there. The cache lives in
+    the hosting_services_backup_cache_dir config (default: ~/.cache/kubesae/backups) and the
+    least recently used backups are removed to keep it under the
+    hosting_services_backup_cache_size config, in bytes (default: 10 GiB). A hardlinked
+    backup is read-only, since it is the cache's copy; use --no-cache for a writable file.
 
     Usage:
         $ inv utils.get-db-backup
@@ -49,6 +178,9 @@ def get_backup_from_hosting(
         $ inv utils.get-db-backup --backup-name=yearly-2021.pgdump
             Will copy the backup file with the name "yearly-2021.pgdump" to the project root
 
+        $ inv utils.get-db-backup --no-cache
+            Will download the latest daily backup without using the local backup cache
+
         $ inv utils.get-db-backup --list
             Will list all of the backup files in the bucket for the project.
 
@@ -59,82 +191,91 @@ def get_backup_from_hosting(
     if c.config.get("hosting_services_backup_profile"):
         profile = c.config.hosting_services_backup_profile
     if c.config.get("hosting_services_backup_bucket"):
-        bucket = f"s3://{c.config.hosting_services_backup_bucket.strip('/')}"
+        bucket_name = c.config.hosting_services_backup_bucket.strip("/")
     else:
-        bucket = f"s3://{BASE_BACKUP_BUCKET.strip('/')}"
+        bucket_name = BASE_BACKUP_BUCKET.strip("/")
 
     if c.config.get("hosting_services_backup_folder"):
-        bucket_folder = f"{bucket}/{c.config.hosting_services_backup_folder.strip('/')}"
+        folder = c.config.hosting_services_backup_folder.strip("/")
     else:
         print(
             "A hosting services backup folder has not been defined in tasks.py for this project."
         )
         print("Here are a list of the currently defined backup folders:")
-        c.run(f"aws s3 ls {bucket} --profile {profile}")
+        for prefix in s3.list_folders(s3.get_client(profile), bucket_name):
+            print(f"{'PRE':>30} {prefix}")
         print(
             "If the project is not listed it will need to be set up with Hosting services, "
             "see: https://github.com/caktus/ansible-role-k8s-hosting-services"
         )
         return
 
+    if list or not backup_name:
+        objects = backup_index(c, bucket_name, folder, profile, refresh)
     if list:
-        c.run(f"aws s3 ls {bucket_folder}/ --profile {profile}")
+        print(format_listing(objects))
         return
 
     if not backup_name:
-        listing = c.run(
-            f"aws s3 ls {bucket_folder}/ --profile {profile}",
-            pty=False,
-            hide="out",
-        ).stdout.strip()
-
-        dates = [
-            re.search(r"\d{12}", x).group(0)
-            for x in listing.split("\n")
-            if re.search(f"^.*{latest}-.*", x)
-        ]
-        if dates:
-            backup_name = (
-                f"{latest}-{c.config.hosting_services_backup_folder}-{dates[-1]}.pgdump"
-            )
+        # backup names end with a sortable date, so the last one is the latest
+        names = [x[0] for x in objects if x[0].startswith(f"{latest}-")]
+        if names:
+            backup_name = names[-1]
 
     if not dest:
         dest = backup_name
     if not backup_name:
         print(f"No backup matching a latest of {latest} could be found.")
         return
-    c.run(f"aws s3 cp {bucket_folder}/{backup_name} ./{dest} --profile {profile}")
+    concurrency = int(
+        concurrency
+        or c.config.get("hosting_services_backup_concurrency")
+        or s3.DEFAULT_CONCURRENCY
+    )
+    if cache:
+        cache = s3.DownloadCache(
+            c.config.get("hosting_services_backup_cache_dir"),
+            int(
+                c.config.get("hosting_services_backup_cache_size")
+                or s3.DEFAULT_CACHE_SIZE
+            ),
+        )
+    download_backup(
+        bucket_name,
+        f"{folder}/{backup_name}",
+        dest,
+        profile,
+        concurrency,
+        cache or None,
+    )
 
 
 @invoke.task
 def list_backup_schedules(
-    c, bucket_identifier="caktus-hosting-services-backups", profile="caktus"
+    c,
+    bucket_identifier="caktus-hosting-services-backups",
+    profile="caktus",
+    refresh=False,
 ):
     """
     Lists the backup schedules found in a project's hosting bucket.
     :param c:
     :param bucket_identifier: The name of the bucket that holds the backups.
     :param profile:
+    :param refresh: List the bucket again rather than using the cached listing.
     :return:
     """
 
-    hosting_bucket = (
-        c.hosting_services_backup_folder
-        if c.config.hosting_services_backup_folder
-        else c.config.app
-    )
-    all_backups = c.run(
-        f"aws s3 ls s3://{bucket_identifier}/{hosting_bucket}/ --profile={profile}",
-        hide="out",
-    ).stdout.strip()
+    hosting_bucket = c.config.get("hosting_services_backup_folder") or c.config.app
+    objects = backup_index(c, bucket_identifier, hosting_bucket, profile, refresh)
 
     schedules = []
     print(f"Backup schedules found at {hosting_bucket}\n")
-    for backup in all_backups.split("\r\n"):
-        name = backup.split(" ")[-1].split("-")[0]
-        if name not in schedules:
-            schedules.append(name)
-            print(f"{name}")
+    for name, _, _ in objects:
+        schedule = name.split("-")[0]
+        if schedule not in schedules:
+            schedules.append(schedule)
+            print(f"{schedule}")
 
 
 @invoke.task
@@ -143,6 +284,7 @@ def count_backups(
     bucket_identifier="caktus-hosting-services-backups",
     profile="caktus",
     extra_schedules="",
+    refresh=False,
 ):
     """
     count_backups sorts the backups generated with caktus-hosting-services cronjob and prints the number found of each type.
@@ -151,32 +293,64 @@ def count_backups(
     :param bucket_identifier: The name of the bucket that holds the backups.
     :param profile: The profile with list access to the bucket.
     :param extra_schedules: A string passed in with a comma delimiting each additional schedule name.
+    :param refresh: List the bucket again rather than using the cached listing.
     """
     extended = []
     if extra_schedules:
         extended = [x for x in extra_schedules.split(",") if x != ""]
 
     schedules = ["daily", "weekly", "monthly", "yearly"] + extended
-    hosting_bucket = (
-        c.hosting_services_backup_folder
-        if c.config.hosting_services_backup_folder
-        else c.config.app
-    )
+    hosting_bucket = c.config.get("hosting_services_backup_folder") or c.config.app
+    objects = backup_index(c, bucket_identifier, hosting_bucket, profile, refresh)
 
-    all_backups = c.run(
-        f"aws s3 ls s3://{bucket_identifier}/{hosting_bucket}/ --profile={profile}",
-        hide="out",
-    ).stdout.strip()
-
-    sorted_backups = process_backups(schedules, all_backups)
+    sorted_backups = classify_backups(schedules, objects)
 
     print("Backups found:\n")
     for k, v in sorted_backups.items():
-        print(f"{v:03d}: {k}\n")
+        details = ""
+        if v["count"]:
+            oldest, newest = (
+                datetime.datetime.fromtimestamp(v[x]).strftime("%Y-%m-%d")
+                for x in ("oldest", "newest")
+            )
+            details = f" ({v['bytes'] / 2**30:.1f} GiB, {oldest} to {newest})"
+        print(f"{v['count']:03d}: {k}{details}\n")
+
+
+def scale_workload(c, kind, name, replicas):
+    """Scale a deployment or statefulset in the configured namespace."""
+    namespace = c.config.namespace
+
+    def scale(client):
+        client.scale(namespace, f"{kind}s", name, replicas)
+        print(f"{kind}.apps/{name} scaled")
+
+    kube.api_or_kubectl(
+        c,
+        scale,
+        f"{kube.kubectl(c)} scale -n {namespace} {kind}/{name} --replicas={replicas}",
+    )
+
+
+def wait_for_workload(c, kind, name, replicas, deadline):
+    """Wait until a workload has ``replicas`` ready pods, or none left when scaling to 0.
+
+    Uses the API's watch stream to be notified of changes rather than polling.
+    """
+    namespace = c.config.namespace
+    timeout = max(1, int(deadline - time.monotonic()))
+    kube.api_or_kubectl(
+        c,
+        lambda client: kube.wait_for_rollout(
+            client, namespace, f"{kind}s", name, replicas, deadline
+        ),
+        f"{kube.kubectl(c)} rollout status -n {namespace} {kind}/{name} "
+        f"--timeout={timeout}s",
+    )
 
 
 @invoke.task
-def scale_app(c, down=False, celery=False, container_count=2):
+def scale_app(c, down=False, celery=False, container_count=2, wait=False, timeout=300):
     """A utility to simplify scaling namespace app pods and optionally celery pods.
 
     Developed primarily to assist with backup verifications. Following the instructions in
@@ -185,6 +359,10 @@ def scale_app(c, down=False, celery=False, container_count=2):
     If the namespace is using a standard django-k8s celery deployment, you can specify --celery in the command to
     scale the celery worker and beat appropriately.
 
+    The workloads are scaled concurrently. With --wait, the task returns once every
+    workload has its target number of ready pods (or, scaling down, once all of its pods
+    have terminated), failing after --timeout seconds.
+
     Usage:
         inv staging utils.scale-app --down  # Scales the containers to 0.
         inv staging utils.scale-app --down --celery  # Scales the containers, celery-worker, and celery-beat to 0.
@@ -192,38 +370,58 @@ def scale_app(c, down=False, celery=False, container_count=2):
         inv staging utils.scale-app --celery  # Scales the containers to 2, and celery-worker/celery-beat to 1.
         inv staging utils.scale-app --container-count 4  # Scales the containers to 4.
         inv staging utils.scale-app --container-count 4 --celery  # Scales the containers to 4, and celery-worker/celery-beat to 1.
+        inv staging utils.scale-app --down --wait --timeout 120  # Scales the containers to 0 and waits for them to stop.
     """
 
     if down:
         print(f"Scaling the deployment {c.config.container_name} DOWN to 0 replicas.")
-        c.run(
-            f"kubectl scale -n {c.config.namespace} deploy/{c.config.container_name} --replicas=0"
-        )
+        workloads = [("deployment", c.config.container_name, 0)]
         if celery:
             # celery needs to scale the celery-worker deployment and the celery-beat stateful-set
             print("Scaling celery worker and beat DOWN to 0 replicas")
-            c.run(
-                f"kubectl scale -n {c.config.namespace} deploy/celery-worker --replicas=0"
-            )
-            c.run(
-                f"kubectl scale -n {c.config.namespace} statefulsets celery-beat --replicas=0"
-            )
+            workloads += [
+                ("deployment", "celery-worker", 0),
+                ("statefulset", "celery-beat", 0),
+            ]
     else:
         print(
             f"Scaling the deployment {c.config.container_name} UP to {container_count} replicas."
         )
-        c.run(
-            f"kubectl scale -n {c.config.namespace} deploy/{c.config.container_name} --replicas={container_count}"
-        )
+        workloads = [("deployment", c.config.container_name, container_count)]
         if celery:
             # celery needs to scale the celery-worker deployment and the celery-beat stateful-set
             print("Scaling celery worker and beat to 1 replica.")
-            c.run(
-                f"kubectl scale -n {c.config.namespace} deploy/celery-worker --replicas=1"
-            )
-            c.run(
-                f"kubectl scale -n {c.config.namespace} statefulsets celery-beat --replicas=1"
-            )
+            workloads += [
+                ("deployment", "celery-worker", 1),
+                ("statefulset", "celery-beat", 1),
+            ]
+
+    start = time.monotonic()
+
+    def scale(kind, name, replicas):
+        scale_workload(c, kind, name, replicas)
+        scaled = time.monotonic() - start
+        if wait:
+            wait_for_workload(c, kind, name, replicas, start + timeout)
+        return scaled, time.monotonic() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(workloads)) as executor:
+        futures = [(w, executor.submit(scale, *w)) for w in workloads]
+
+    failed = False
+    print(f"\n{'WORKLOAD':<40} {'REPLICAS':>8} {'SCALED':>8} {'READY':>8}")
+    for (kind, name, replicas), future in futures:
+        workload = f"{kind}/{name}"
+        try:
+            scaled, ready = future.result()
+        except Exception as e:
+            failed = True
+            print(f"{workload:<40} {replicas:>8} failed: {e}")
+            continue
+        ready = f"{ready:.1f}s" if wait else "-"
+        print(f"{workload:<40} {replicas:>8} {scaled:>7.1f}s {ready:>8}")
+    if failed:
+        raise invoke.exceptions.Exit(code=1)
 
 
 utils = invoke.Collection("utils")
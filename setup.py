@@ -18,7 +18,10 @@ setup(
         "invoke>=1.4",
         "colorama>=0.4",
         "ansible>=2.9",
+        "PyYAML>=5.1",
+        "urllib3>=1.26",
     ],
+    extras_require={"gcs": ["google-cloud-storage>=2.0"]},
     python_requires=">=3.5",
     classifiers=[
         "Development Status :: 5 - Production/Stable",
@@ -0,0 +1,46 @@
+"""Benchmarks for sorting large bucket listings into backup schedules.
+
+Run with ``pytest --benchmark tests/benchmarks -s`` to see the timings.
+"""
+import random
+import time
+
+import pytest
+
+from kubesae.utils import classify_backups
+
+pytestmark = pytest.mark.benchmark
+
+SCHEDULES = ["daily", "weekly", "monthly", "yearly", "every-hour", "every2hours"]
+SIZES = [10**3, 10**4, 10**5, 10**6]
+
+
+def listing(size):
+    rng = random.Random(size)
+    return [
+        [
+            f"{rng.choice(SCHEDULES)}-app-{202001010000 + index}.pgdump",
+            rng.randrange(2**20, 2**30),
+            1577836800 + index * 60,
+        ]
+        for index in range(size)
+    ]
+
+
+def best_time(function, *args, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_classify_backups__scales_linearly():
+    per_key = {}
+    for size in SIZES:
+        objects = listing(size)
+        per_key[size] = best_time(classify_backups, SCHEDULES, objects) / size
+        print(f"\n{size:>9} keys: {per_key[size] * size * 1000:8.1f} ms")
+    # allow for noise and cache effects, but not for quadratic growth
+    assert per_key[SIZES[-1]] < 3 * per_key[SIZES[1]]
@@ -0,0 +1,87 @@
+"""Benchmarks for deciding whether the working tree is dirty.
+
+Run with ``pytest --benchmark tests/benchmarks -s`` to see the timings.
+"""
+import os
+import subprocess
+import time
+
+import pytest
+
+from kubesae import git
+
+pytestmark = pytest.mark.benchmark
+
+FILES = 20000
+
+
+def run(repo, *args):
+    return subprocess.run(
+        ["git", *args], cwd=repo, check=True, capture_output=True, text=True
+    ).stdout
+
+
+@pytest.fixture(scope="module")
+def repo(tmp_path_factory):
+    path = tmp_path_factory.mktemp("bench")
+    for index in range(FILES):
+        folder = path / f"pkg{index // 200:03d}"
+        folder.mkdir(exist_ok=True)
+        (folder / f"module{index}.py").write_text(f"VALUE = {index}\n")
+    env = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="Bench",
+        GIT_AUTHOR_EMAIL="bench@example.com",
+        GIT_COMMITTER_NAME="Bench",
+        GIT_COMMITTER_EMAIL="bench@example.com",
+    )
+    subprocess.run(["git", "init", "-q"], cwd=path, check=True)
+    subprocess.run(
+        ["git", "config", "core.untrackedCache", "true"], cwd=path, check=True
+    )
+    subprocess.run(["git", "add", "."], cwd=path, check=True)
+    subprocess.run(
+        ["git", "commit", "-q", "-m", "bench"], cwd=path, check=True, env=env
+    )
+    time.sleep(0.01)
+    run(path, "update-index", "--refresh")
+    run(path, "status", "--short")
+    return path
+
+
+def best_time(function, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def compare(path):
+    subprocess_time, expected = best_time(lambda: bool(run(path, "status", "--short")))
+    direct_time, dirty = best_time(lambda: git.Repository(str(path)).is_dirty())
+    print(
+        f"\n{FILES} files: git status {subprocess_time * 1000:.1f} ms,"
+        f" is_dirty {direct_time * 1000:.1f} ms"
+    )
+    assert dirty == expected
+    return subprocess_time, direct_time
+
+
+def test_is_dirty__clean_tree(repo):
+    subprocess_time, direct_time = compare(repo)
+    # git status answers for a large index, so confirming a clean tree costs the same
+    # (give or take timing noise)
+    assert direct_time < subprocess_time * 1.1
+
+
+def test_is_dirty__modified_file(repo):
+    (repo / "pkg000" / "module0.py").write_text("VALUE = -1\n")
+    subprocess_time, direct_time = compare(repo)
+    if git.usable_cpus() > 1:
+        # stops at the first modified path instead of walking the whole tree
+        assert direct_time < subprocess_time
+    else:
+        # only git runs, as the scan would slow it down
+        assert direct_time < subprocess_time * 1.1
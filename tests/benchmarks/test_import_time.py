@@ -0,0 +1,39 @@
+"""Benchmark for how long importing kubesae takes, which every ``inv`` run pays.
+
+Run with ``pytest --benchmark tests/benchmarks -s`` to see the timings.
+"""
+import subprocess
+import sys
+
+import pytest
+
+pytestmark = pytest.mark.benchmark
+
+# seconds kubesae may add to importing invoke itself
+BUDGET = 0.15
+
+
+def import_times(module):
+    """Return the cumulative import time of each module, in seconds, from -X importtime."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times.setdefault(name.strip(), int(cumulative) / 10**6)
+    return times
+
+
+def test_import_time():
+    durations = []
+    for _ in range(3):
+        times = import_times("kubesae")
+        durations.append(times["kubesae"] - times.get("invoke", 0))
+    print(f"\nimporting kubesae takes {min(durations) * 1000:.0f}ms on top of invoke")
+    assert min(durations) < BUDGET
@@ -5,6 +5,35 @@ import pytest
 from invoke.context import Context
 
 
+def pytest_addoption(parser):
+    parser.addoption("--benchmark", action="store_true", help="Run the benchmarks too.")
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmark"):
+        return
+    skip = pytest.mark.skip(reason="needs --benchmark to run")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    """A boto3 S3 client for a moto mocked S3 with a "backups" bucket."""
+    import boto3
+
+    from moto import mock_aws
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="backups")
+        yield client
+
+
 @pytest.fixture
 def c():
     context = Context()
@@ -0,0 +1,163 @@
+import importlib
+import os
+import textwrap
+
+import pytest
+
+vars = importlib.import_module("kubesae.ansible.vars")
+
+INVENTORY = """
+[k8s]
+staging k8s_replicas=2
+production
+
+[web:children]
+k8s
+
+[k8s:vars]
+ansible_connection=local
+k8s_from_inventory=yes
+"""
+
+
+def write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(textwrap.dedent(text))
+
+
+@pytest.fixture(autouse=True)
+def files():
+    vars._files.clear()
+    yield
+    vars._files.clear()
+
+
+@pytest.fixture
+def deploy(tmp_path, monkeypatch):
+    for name in ("ANSIBLE_CONFIG", "ANSIBLE_INVENTORY", "ANSIBLE_VAULT_PASSWORD_FILE"):
+        monkeypatch.delenv(name, raising=False)
+    path = tmp_path / "deploy"
+    write(path / "inventory", INVENTORY)
+    write(
+        path / "group_vars" / "all.yml",
+        """
+        app_name: myproject
+        k8s_namespace: "{{ app_name }}-{{ env_name }}"
+        k8s_replicas: 1
+        k8s_from_group: all
+        """,
+    )
+    write(path / "group_vars" / "k8s.yml", "k8s_from_group: k8s\n")
+    write(path / "group_vars" / "web" / "main.yml", "k8s_from_group: web\n")
+    write(
+        path / "host_vars" / "staging.yml",
+        """
+        env_name: staging
+        k8s_hosts: ["{{ k8s_namespace }}.example.com"]
+        k8s_port: "{{ 8000 }}"
+        k8s_raw: !unsafe "{{ not templated }}"
+        """,
+    )
+    return path
+
+
+def test_precedence(deploy):
+    hostvars = vars.resolve_host_vars(str(deploy), "staging")
+    assert hostvars["app_name"] == "myproject"
+    # inline host vars beat group_vars files
+    assert hostvars["k8s_replicas"] == 2
+    assert hostvars["k8s_from_inventory"] == "yes"
+    # k8s is deeper than web, which is deeper than all
+    assert hostvars["k8s_from_group"] == "k8s"
+    assert hostvars["group_names"] == ["web", "k8s"]
+
+
+def test_templating(deploy):
+    hostvars = vars.resolve_host_vars(str(deploy), "staging")
+    assert hostvars["k8s_namespace"] == "myproject-staging"
+    assert hostvars["k8s_hosts"] == ["myproject-staging.example.com"]
+    assert hostvars["k8s_port"] == 8000
+    assert hostvars["k8s_raw"] == "{{ not templated }}"
+
+
+def test_undefined(deploy):
+    hostvars = vars.resolve_host_vars(str(deploy), "production")
+    with pytest.raises(vars.VarsError, match="env_name"):
+        hostvars["k8s_namespace"]
+    with pytest.raises(KeyError):
+        hostvars["missing"]
+
+
+def test_extra_files(deploy):
+    write(deploy / "extra.yml", "k8s_replicas: 5\n")
+    hostvars = vars.resolve_host_vars(str(deploy), "staging", ["extra.yml"])
+    assert hostvars["k8s_replicas"] == 5
+
+
+def test_yaml_inventory(deploy, monkeypatch):
+    write(
+        deploy / "hosts.yml",
+        """
+        all:
+          vars:
+            k8s_from_inventory: all
+          children:
+            k8s:
+              hosts:
+                staging:
+                  k8s_replicas: 3
+        """,
+    )
+    monkeypatch.setenv("ANSIBLE_INVENTORY", "hosts.yml")
+    hostvars = vars.resolve_host_vars(str(deploy), "staging")
+    assert hostvars["k8s_replicas"] == 3
+    assert hostvars["k8s_from_inventory"] == "all"
+    assert hostvars["k8s_from_group"] == "k8s"
+
+
+def test_files_are_cached(deploy, monkeypatch):
+    vars.resolve_host_vars(str(deploy), "staging")["k8s_namespace"]
+    loads = []
+    monkeypatch.setattr(vars, "parse_yaml", lambda *args: loads.append(args) or {})
+    assert vars.resolve_host_vars(str(deploy), "staging")["k8s_namespace"] == (
+        "myproject-staging"
+    )
+    assert loads == []
+    write(deploy / "group_vars" / "k8s.yml", "k8s_from_group: changed\n")
+    os.utime(deploy / "group_vars" / "k8s.yml", ns=(0, 0))
+    vars.resolve_host_vars(str(deploy), "staging")["k8s_from_group"]
+    assert len(loads) == 1
+
+
+def test_vault(deploy, tmp_path, monkeypatch):
+    from ansible.parsing.vault import VaultLib, VaultSecret
+
+    vault = VaultLib([("default", VaultSecret(b"secret"))])
+    encrypted = vault.encrypt("hunter2").decode()
+    write(
+        deploy / "host_vars" / "production.yml",
+        "db_password: !vault |\n"
+        + textwrap.indent(encrypted, "  ")
+        + "\nenv_name: production\n",
+    )
+    write(deploy / "ansible.cfg", "[defaults]\nvault_password_file = .vault\n")
+    hostvars = vars.resolve_host_vars(str(deploy), "production")
+    # reading other variables doesn't need the password
+    assert hostvars["k8s_namespace"] == "myproject-production"
+    with pytest.raises(vars.VarsError, match="vault password"):
+        hostvars["db_password"]
+    write(deploy / ".vault", "secret\n")
+    hostvars = vars.resolve_host_vars(str(deploy), "production")
+    assert hostvars["db_password"] == "hunter2"
+
+
+def test_play_vars(c, deploy):
+    vars.play_vars(c, path=str(deploy))
+    assert sorted(c.hostvars) == ["production", "staging"]
+    assert c.hostvars["staging"]["k8s_namespace"] == "myproject-staging"
+
+
+def test_ansible_filters(deploy):
+    write(deploy / "host_vars" / "staging.yml", 'k8s_json: "{{ [1] | to_json }}"\n')
+    hostvars = vars.resolve_host_vars(str(deploy), "staging")
+    assert hostvars["k8s_json"] == [1]
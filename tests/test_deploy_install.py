@@ -0,0 +1,93 @@
+import importlib
+import os
+
+from unittest import mock
+
+import invoke
+import pytest
+
+deploy = importlib.import_module("kubesae.ansible.deploy")
+
+REQUIREMENTS = """
+- src: https://github.com/caktus/ansible-role-django-k8s
+  name: caktus.django-k8s
+  version: v1.0.0
+- src: https://github.com/caktus/ansible-role-k8s-web-cluster
+  name: caktus.k8s-web-cluster
+  version: v1.0.0
+"""
+
+
+@pytest.fixture
+def project(c, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "deploy").mkdir()
+    (tmp_path / "deploy" / "requirements.yml").write_text(REQUIREMENTS)
+    c.run.return_value = mock.Mock(failed=False)
+    return tmp_path
+
+
+def install_role(project, name, version):
+    meta = project / "deploy" / "roles" / name / "meta"
+    meta.mkdir(parents=True, exist_ok=True)
+    (meta / ".galaxy_install_info").write_text(f"version: {version}\n")
+
+
+def commands(c):
+    return [call.args[0] for call in c.run.call_args_list]
+
+
+def test_install_requirements__installs_roles_concurrently(c, project):
+    deploy.install_requirements(c)
+    assert len(c.run.call_args_list) == 3
+    assert all(
+        x.startswith("ansible-galaxy install -f --no-deps -r ") for x in commands(c)[:2]
+    )
+    # shared dependencies are installed once the roles are in place
+    assert commands(c)[2] == "ansible-galaxy install -r 'requirements.yml' -p roles/"
+    assert os.path.exists(project / "deploy" / "roles" / deploy.REQUIREMENTS_STAMP)
+
+
+def test_install_requirements__skips_when_unchanged(c, project):
+    install_role(project, "caktus.django-k8s", "v1.0.0")
+    deploy.install_requirements(c)
+    c.run.reset_mock()
+    deploy.install_requirements(c)
+    c.run.assert_not_called()
+    deploy.install_requirements(c, force=True)
+    assert c.run.call_count == 3
+
+
+def test_install_requirements__requirements_changed(c, project):
+    deploy.install_requirements(c)
+    c.run.reset_mock()
+    (project / "deploy" / "requirements.yml").write_text(
+        REQUIREMENTS.replace("v1.0.0", "v1.1.0")
+    )
+    deploy.install_requirements(c)
+    assert c.run.call_count == 3
+
+
+def test_install_requirements__roles_changed(c, project):
+    install_role(project, "caktus.django-k8s", "v1.0.0")
+    deploy.install_requirements(c)
+    c.run.reset_mock()
+    install_role(project, "caktus.django-k8s", "v0.9.0")
+    deploy.install_requirements(c)
+    assert c.run.call_count == 3
+
+
+def test_install_requirements__collections(c, project):
+    (project / "deploy" / "requirements.yml").write_text(
+        "roles:\n  - src: caktus.django-k8s\ncollections:\n  - name: kubernetes.core\n"
+    )
+    deploy.install_requirements(c)
+    assert commands(c) == ["ansible-galaxy install -f -r 'requirements.yml' -p roles/"]
+
+
+def test_install_requirements__failure(c, project, capsys):
+    c.run.return_value = mock.Mock(failed=True, stderr="no such role")
+    with pytest.raises(invoke.exceptions.Exit):
+        deploy.install_requirements(c)
+    assert "no such role" in capsys.readouterr().out
+    assert not os.path.exists(project / "deploy" / "roles" / deploy.REQUIREMENTS_STAMP)
@@ -0,0 +1,78 @@
+import importlib
+import io
+import threading
+
+from unittest import mock
+
+import invoke
+import pytest
+
+deploy = importlib.import_module("kubesae.ansible.deploy")
+
+
+@pytest.fixture
+def deployed(c, monkeypatch):
+    """Replace ansible_deploy, recording the context and arguments of each call."""
+    c.config.tag = "abc"
+    calls = {}
+
+    def ansible_deploy(context, env, **kwargs):
+        calls[env] = (context, kwargs)
+        context.config.run.out_stream.write(f"deploying {env}\nno newline")
+        if env == "broken":
+            raise invoke.exceptions.UnexpectedExit(mock.Mock(exited=2))
+
+    monkeypatch.setattr(deploy, "ansible_deploy", ansible_deploy)
+    return calls
+
+
+def test_prefixed_writer():
+    out = io.StringIO()
+    writer = deploy.PrefixedWriter("[staging] ", out, threading.Lock())
+    writer.write("one\ntw")
+    writer.flush()
+    assert out.getvalue() == "[staging] one\n"
+    writer.write("o\nthree")
+    writer.close()
+    assert out.getvalue() == "[staging] one\n[staging] two\n[staging] three\n"
+
+
+def test_deploy_many(c, deployed, capsys):
+    c.config.deploy_environments = {"client-b": {"namespace": "client-b"}}
+    deploy.deploy_many(c, env=["client-a,client-b", "client-c"])
+    assert sorted(deployed) == ["client-a", "client-b", "client-c"]
+    context, kwargs = deployed["client-b"]
+    assert context is not c
+    assert context.config.env == "client-b"
+    assert context.config.namespace == "client-b"
+    assert kwargs["tag"] == "abc"
+    out = capsys.readouterr().out
+    assert "[client-a] deploying client-a\n" in out
+    assert "[client-a] no newline\n" in out
+    assert "client-c" in out.splitlines()[-2]
+
+
+def test_deploy_many__group(c, deployed, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("ANSIBLE_INVENTORY", raising=False)
+    monkeypatch.delenv("ANSIBLE_CONFIG", raising=False)
+    (tmp_path / "deploy").mkdir()
+    (tmp_path / "deploy" / "inventory").write_text(
+        "[clients:children]\neast\nwest\n[east]\nclient-a\n[west]\nclient-b\n"
+        "[staging]\nstaging\n"
+    )
+    deploy.deploy_many(c, group="clients")
+    assert sorted(deployed) == ["client-a", "client-b"]
+
+
+def test_deploy_many__failure_doesnt_stop_others(c, deployed, capsys):
+    with pytest.raises(invoke.exceptions.Exit):
+        deploy.deploy_many(c, env=["broken", "client-a"], workers=1)
+    assert sorted(deployed) == ["broken", "client-a"]
+    out = capsys.readouterr().out
+    assert "exit code 2" in out
+
+
+def test_deploy_many__no_envs(c, deployed):
+    with pytest.raises(invoke.exceptions.Exit):
+        deploy.deploy_many(c)
@@ -0,0 +1,171 @@
+import importlib
+import time
+
+from unittest import mock
+
+import invoke
+import pytest
+
+from kubesae import kube
+
+deploy = importlib.import_module("kubesae.ansible.deploy")
+
+
+@pytest.fixture
+def client(c, monkeypatch):
+    c.config.namespace = "myproject-staging"
+    c.config.repository = "registry.example.com/myproject"
+    client = mock.Mock()
+    monkeypatch.setattr(kube, "get_client", lambda c: client)
+    return client
+
+
+def pod(node, version="1", waiting=None, image_id=""):
+    status = {"imageID": image_id, "state": {}}
+    if waiting:
+        status["state"]["waiting"] = {"reason": waiting, "message": f"{waiting}!"}
+    elif image_id:
+        status["state"]["terminated"] = {"exitCode": 0}
+    return {
+        "metadata": {"name": f"prepull-{node}", "resourceVersion": version},
+        "spec": {"nodeName": node},
+        "status": {"initContainerStatuses": [status]},
+    }
+
+
+def daemonset(desired, generation=1, observed=1):
+    return {
+        "metadata": {"generation": generation},
+        "status": {"observedGeneration": observed, "desiredNumberScheduled": desired},
+    }
+
+
+def pods(*items):
+    return {"metadata": {"resourceVersion": "1"}, "items": list(items)}
+
+
+def test_image_pull_state():
+    assert kube.image_pull_state(pod("a", image_id="sha256:1")) == ("pulled", None)
+    assert kube.image_pull_state(pod("a", waiting="PodInitializing")) == (None, None)
+    assert kube.image_pull_state(pod("a", waiting="CrashLoopBackOff")) == (
+        "pulled",
+        None,
+    )
+    assert kube.image_pull_state(pod("a", waiting="ImagePullBackOff")) == (
+        "failed",
+        "ImagePullBackOff!",
+    )
+    assert kube.image_pull_state({"status": {}}) == (None, None)
+
+
+def test_prepull_daemonset():
+    spec = kube.prepull_daemonset("prepull", "myproject:abc", "pause", ["regcred"])
+    template = spec["spec"]["template"]
+    assert spec["spec"]["selector"]["matchLabels"] == template["metadata"]["labels"]
+    assert template["spec"]["initContainers"][0]["image"] == "myproject:abc"
+    assert template["spec"]["imagePullSecrets"] == [{"name": "regcred"}]
+
+
+def test_wait_for_prepull__watches_until_every_node_pulled():
+    client = mock.Mock()
+    client.get.side_effect = lambda path, **params: (
+        pods(pod("a", waiting="PodInitializing"))
+        if path.endswith("/pods")
+        else daemonset(2)
+    )
+    client.watch.return_value = iter(
+        [
+            ("ADDED", pod("b", "2", waiting="PodInitializing")),
+            ("MODIFIED", pod("a", "3", image_id="sha256:1")),
+            ("MODIFIED", pod("b", "4", image_id="sha256:1")),
+        ]
+    )
+    nodes = kube.wait_for_prepull(client, "ns", "prepull", time.monotonic() + 10)
+    assert sorted(nodes) == ["a", "b"]
+    assert all(
+        seconds is not None and error is None for seconds, error in nodes.values()
+    )
+    assert client.watch.call_args.kwargs["labelSelector"] == (
+        "app.kubernetes.io/name=prepull"
+    )
+
+
+def test_wait_for_prepull__waits_for_daemonset_status():
+    client = mock.Mock()
+    statuses = iter([daemonset(0, observed=0), daemonset(1)])
+    client.get.side_effect = lambda path, **params: (
+        pods(pod("a", image_id="sha256:1"))
+        if path.endswith("/pods")
+        else next(statuses)
+    )
+    client.watch.return_value = iter([])
+    nodes = kube.wait_for_prepull(client, "ns", "prepull", time.monotonic() + 10)
+    assert list(nodes) == ["a"]
+    assert client.watch.call_count == 1
+
+
+def test_wait_for_prepull__deadline():
+    client = mock.Mock()
+    client.get.return_value = pods(pod("a", waiting="PodInitializing"))
+    nodes = kube.wait_for_prepull(client, "ns", "prepull", time.monotonic())
+    assert nodes == {"a": (None, None)}
+    client.watch.assert_not_called()
+
+
+def test_prepull_image(c, client, capsys):
+    client.get.side_effect = lambda path, **params: (
+        pods(pod("node-1", image_id="sha256:1"))
+        if path.endswith("/pods")
+        else daemonset(1)
+    )
+    deploy.prepull_image(c, "myproject:abc")
+    path, body = client.create.call_args.args
+    assert path == "/apis/apps/v1/namespaces/myproject-staging/daemonsets"
+    name = body["metadata"]["name"]
+    client.delete.assert_called_once_with(
+        f"{path}/{name}", propagationPolicy="Background"
+    )
+    assert "node-1" in capsys.readouterr().out
+
+
+def test_prepull_image__existing_daemonset(c, client):
+    client.create.side_effect = kube.KubeApiError(409, "Conflict")
+    client.get.side_effect = lambda path, **params: (
+        pods() if path.endswith("/pods") else daemonset(0)
+    )
+    deploy.prepull_image(c, "myproject:abc")
+    client.delete.assert_called_once()
+
+
+def test_prepull_image__pull_failed(c, client, capsys):
+    client.get.side_effect = lambda path, **params: (
+        pods(pod("node-1", waiting="ErrImagePull"))
+        if path.endswith("/pods")
+        else daemonset(1)
+    )
+    with pytest.raises(invoke.exceptions.Exit):
+        deploy.prepull_image(c, "myproject:abc")
+    client.delete.assert_called_once()
+    assert "failed: ErrImagePull!" in capsys.readouterr().out
+
+
+def test_prepull_image__kubectl(c, monkeypatch):
+    c.config.namespace = "myproject-staging"
+    monkeypatch.setattr(kube, "get_client", lambda c: None)
+    deploy.prepull_image(c, "myproject:abc", timeout=60)
+    commands = [call.args[0] for call in c.run.call_args_list]
+    assert commands[0] == "kubectl apply -n myproject-staging -f -"
+    assert commands[1].startswith(
+        "kubectl rollout status -n myproject-staging daemonset/"
+    )
+    assert commands[1].endswith("--timeout=60s")
+    assert commands[2].startswith("kubectl delete")
+
+
+def test_ansible_deploy__prepull(c, client, monkeypatch):
+    c.config.env = "staging"
+    prepull_image = mock.Mock()
+    monkeypatch.setattr(deploy, "prepull_image", prepull_image)
+    deploy.ansible_deploy(c, tag="abc", prepull=True)
+    prepull_image.assert_called_once_with(c, "registry.example.com/myproject:abc", 300)
+    assert "k8s_container_image_tag=abc" in c.run.call_args.args[0]
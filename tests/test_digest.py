@@ -0,0 +1,106 @@
+import os
+import time
+
+import pytest
+
+from kubesae import digest
+
+
+@pytest.fixture
+def context(tmp_path):
+    path = tmp_path / "app"
+    (path / "src" / "static").mkdir(parents=True)
+    (path / "node_modules" / "pkg").mkdir(parents=True)
+    (path / "Dockerfile").write_text("FROM python:3.11\n")
+    (path / "src" / "app.py").write_text("print('hello')\n")
+    (path / "src" / "static" / "app.css").write_text("body {}\n")
+    (path / "node_modules" / "pkg" / "index.js").write_text("module.exports = 1\n")
+    (path / ".dockerignore").write_text("# comment\nnode_modules\n*.pyc\n")
+    old = time.time() - 60
+    for root, _, files in os.walk(path):
+        for name in files:
+            os.utime(os.path.join(root, name), (old, old))
+    return path
+
+
+def compute(path, **kwargs):
+    return digest.context_digest(
+        str(path),
+        str(path / "Dockerfile"),
+        cache_dir=str(path.parent / "cache"),
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize(
+    "pattern,name,ignored",
+    [
+        ("node_modules", "node_modules/pkg/index.js", True),
+        ("*.pyc", "app.pyc", True),
+        ("*.pyc", "src/app.pyc", False),
+        ("**/*.pyc", "src/deep/app.pyc", True),
+        ("**/*.pyc", "app.pyc", True),
+        ("src/?.py", "src/a.py", True),
+        ("src/?.py", "src/ab.py", False),
+        ("[^a]*.txt", "b.txt", True),
+        ("[^a]*.txt", "a.txt", False),
+        ("/docs/", "docs/index.rst", True),
+    ],
+)
+def test_is_ignored(pattern, name, ignored):
+    patterns = [(digest.compile_pattern(pattern.strip("/")), False)]
+    assert digest.is_ignored(patterns, name) == ignored
+
+
+def test_is_ignored__exceptions(tmp_path):
+    ignore_file = tmp_path / ".dockerignore"
+    ignore_file.write_text("*.md\n!README.md\nREADME*.md\n!README-keep.md\n")
+    patterns = digest.read_ignore_file(str(ignore_file))
+    assert digest.is_ignored(patterns, "CHANGES.md")
+    assert digest.is_ignored(patterns, "README.md")
+    assert not digest.is_ignored(patterns, "README-keep.md")
+    assert not digest.is_ignored(patterns, "setup.py")
+
+
+def test_context_digest__ignored_files_dont_count(context):
+    first, hashed = compute(context)
+    assert hashed == 4  # Dockerfile, .dockerignore, app.py and app.css
+    (context / "node_modules" / "pkg" / "index.js").write_text("changed\n")
+    (context / "app.pyc").write_bytes(b"\0")
+    assert compute(context)[0] == first
+
+
+def test_context_digest__changes(context):
+    first, _ = compute(context)
+    assert compute(context, target="deploy")[0] != first
+    (context / "src" / "app.py").write_text("print('bye')\n")
+    second, _ = compute(context)
+    assert second != first
+    os.chmod(context / "src" / "app.py", 0o755)
+    assert compute(context)[0] != second
+
+
+def test_context_digest__dependencies(context):
+    first, _ = compute(context, depends_on=["a" * 64])
+    assert compute(context)[0] != first
+    assert compute(context, depends_on=["b" * 64])[0] != first
+
+
+def test_context_digest__caches_file_hashes(context):
+    first, _ = compute(context)
+    assert compute(context) == (first, 0)
+    (context / "src" / "app.py").write_text("print('bye')\n")
+    _, hashed = compute(context)
+    # app.py is hashed again, and isn't cached while it may still be changing
+    assert hashed == 1
+    assert compute(context)[1] == 1
+
+
+def test_context_digest__per_dockerfile_ignore_file(context):
+    first, _ = compute(context)
+    (context / "Dockerfile.dockerignore").write_text("node_modules\nsrc/static\n")
+    assert compute(context)[0] != first
+    (context / "src" / "static" / "app.css").write_text("changed\n")
+    second, _ = compute(context)
+    (context / "src" / "static" / "app.css").write_text("changed again\n")
+    assert compute(context)[0] == second
@@ -0,0 +1,299 @@
+import importlib
+import os
+import subprocess
+import time
+
+from unittest import mock
+
+import pytest
+
+from kubesae import git
+
+
+def run(repo, *args):
+    return subprocess.run(
+        ["git", *args], cwd=repo, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path / "home"))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "home" / ".config"))
+    monkeypatch.setenv("GIT_AUTHOR_NAME", "Test")
+    monkeypatch.setenv("GIT_AUTHOR_EMAIL", "test@example.com")
+    monkeypatch.setenv("GIT_COMMITTER_NAME", "Test")
+    monkeypatch.setenv("GIT_COMMITTER_EMAIL", "test@example.com")
+    path = tmp_path / "repo"
+    (path / "src" / "app").mkdir(parents=True)
+    (path / "README").write_text("readme\n")
+    (path / "src" / "app" / "main.py").write_text("print('hello')\n")
+    (path / ".gitignore").write_text("*.pyc\n")
+    os.symlink("README", path / "link")
+    run(path, "init", "-q", "-b", "main")
+    run(path, "add", ".")
+    run(path, "commit", "-q", "-m", "initial")
+    # let the index be older than the files, so it isn't racily clean
+    time.sleep(0.01)
+    run(path, "update-index", "--refresh")
+    return path
+
+
+def assert_matches_git(path):
+    expected = bool(run(path, "status", "--short"))
+    assert git.Repository(str(path)).is_dirty() == expected
+    return expected
+
+
+def test_branch_and_commit(repo):
+    repository = git.Repository(str(repo / "src"))
+    assert repository.branch() == "main"
+    commit = run(repo, "rev-parse", "HEAD")
+    assert repository.head() == ("refs/heads/main", commit)
+    assert repository.short_id(commit) == run(repo, "rev-parse", "--short", "HEAD")
+
+
+def test_packed_refs_and_objects(repo):
+    run(repo, "checkout", "-q", "-b", "feature/x")
+    run(repo, "gc", "-q")
+    assert not os.path.exists(repo / ".git" / "refs" / "heads" / "main")
+    repository = git.Repository(str(repo))
+    assert repository.branch() == "feature/x"
+    _, commit = repository.head()
+    assert repository.short_id(commit) == run(repo, "rev-parse", "--short", "HEAD")
+    assert repository.read_object(commit)[0] == "commit"
+    assert not assert_matches_git(repo)
+
+
+def test_detached_head(repo):
+    run(repo, "checkout", "-q", "--detach")
+    assert git.Repository(str(repo)).branch() == "HEAD"
+
+
+def test_ambiguous_branch(repo):
+    run(repo, "tag", "main")
+    with pytest.raises(git.GitUnsupported):
+        git.Repository(str(repo)).branch()
+
+
+def test_clean(repo):
+    assert not assert_matches_git(repo)
+
+
+def test_touched_but_unchanged(repo):
+    os.utime(repo / "README", (1, 1))
+    assert not assert_matches_git(repo)
+
+
+def test_modified(repo):
+    (repo / "src" / "app" / "main.py").write_text("print('HELLO')\n")
+    assert assert_matches_git(repo)
+
+
+def test_deleted(repo):
+    os.remove(repo / "README")
+    assert assert_matches_git(repo)
+
+
+def test_mode_changed(repo):
+    os.chmod(repo / "README", 0o755)
+    assert assert_matches_git(repo)
+
+
+def test_staged(repo):
+    (repo / "README").write_text("changed\n")
+    run(repo, "add", "README")
+    assert assert_matches_git(repo)
+
+
+def test_staged_then_reverted_in_worktree(repo):
+    (repo / "README").write_text("changed\n")
+    run(repo, "add", "README")
+    (repo / "README").write_text("readme\n")
+    assert assert_matches_git(repo)
+
+
+def test_untracked(repo):
+    (repo / "src" / "new.py").write_text("")
+    assert assert_matches_git(repo)
+
+
+def test_ignored(repo):
+    (repo / "src" / "app" / "main.pyc").write_text("")
+    assert not assert_matches_git(repo)
+
+
+@pytest.mark.parametrize("version", ["2", "3", "4"])
+def test_index_versions(repo, version):
+    run(repo, "update-index", "--index-version", version)
+    assert not assert_matches_git(repo)
+    (repo / "src" / "app" / "main.py").write_text("print('HELLO')\n")
+    assert assert_matches_git(repo)
+
+
+def test_untracked_cache(repo, monkeypatch):
+    run(repo, "config", "core.untrackedCache", "true")
+    run(repo, "update-index", "--untracked-cache")
+    run(repo, "status")
+    untracked_from_git = pytest.fail
+    monkeypatch.setattr(git.Repository, "_untracked_from_git", untracked_from_git)
+    assert not assert_matches_git(repo)
+    (repo / "src" / "app" / "new.py").write_text("")
+    run(repo, "status")
+    assert assert_matches_git(repo)
+
+
+def test_untracked_cache__stale(repo, monkeypatch):
+    run(repo, "config", "core.untrackedCache", "true")
+    run(repo, "update-index", "--untracked-cache")
+    run(repo, "status")
+    (repo / "src" / "app" / "new.py").write_text("")
+    calls = []
+    original = git.Repository._untracked_from_git
+    monkeypatch.setattr(
+        git.Repository,
+        "_untracked_from_git",
+        lambda self: calls.append(1) or original(self),
+    )
+    # before git status brings the untracked cache up to date
+    assert git.Repository(str(repo)).is_dirty()
+    assert calls
+
+
+def test_untracked_cache__moved_worktree(repo, tmp_path):
+    run(repo, "config", "core.untrackedCache", "true")
+    run(repo, "update-index", "--untracked-cache")
+    run(repo, "status")
+    moved = tmp_path / "moved"
+    os.rename(repo, moved)
+    repository = git.Repository(str(moved))
+    # the cache was written for the old location, so it isn't trusted
+    assert (
+        repository._untracked_from_cache(repository.read_index().extensions, {""})
+        is None
+    )
+
+
+def test_large_file_size_is_masked(repo, monkeypatch):
+    os.utime(repo / "README", (1, 1))
+    lstat_all = git.lstat_all
+
+    def large_lstat_all(paths):
+        results = lstat_all(paths)
+        for position, path in enumerate(paths):
+            if path.endswith("README"):
+                fields = list(results[position])
+                # the index stores sizes modulo 2**32
+                fields[6] += 2**32
+                results[position] = os.stat_result(fields)
+        return results
+
+    monkeypatch.setattr(git, "lstat_all", large_lstat_all)
+    repository = git.Repository(str(repo))
+    assert repository.modified_file(repository.read_index()) is None
+
+
+def test_config_include(repo):
+    (repo / ".git" / "config").write_text(
+        (repo / ".git" / "config").read_text() + '[includeIf "gitdir:~/work/"]\n'
+        "    path = ~/.gitconfig-work\n"
+    )
+    with pytest.raises(git.GitUnsupported, match="includeIf"):
+        git.Repository(str(repo))
+
+
+def test_unknown_index_extension(repo, monkeypatch):
+    monkeypatch.setattr(
+        git.Index, "extensions", {"TREE": b"", "link": b""}, raising=True
+    )
+    with pytest.raises(git.GitUnsupported, match="link"):
+        git.Repository(str(repo)).is_dirty()
+
+
+def test_line_endings(repo):
+    (repo / ".gitattributes").write_text("*.txt text eol=crlf\n")
+    (repo / "notes.txt").write_bytes(b"a\r\nb\r\n")
+    run(repo, "add", ".")
+    run(repo, "commit", "-q", "-m", "attributes")
+    os.utime(repo / "notes.txt", (1, 1))
+    assert not assert_matches_git(repo)
+
+
+def test_generate_tag__reads_git_directly(repo, monkeypatch):
+    from invoke import Context
+
+    image = importlib.import_module("kubesae.image")
+    monkeypatch.chdir(repo)
+    run(repo, "checkout", "-q", "-b", "feature/x")
+    (repo / "README").write_text("changed\n")
+    c = Context()
+    c.run = mock.Mock()
+    image.generate_tag(c)
+    commit = run(repo, "rev-parse", "--short", "HEAD")
+    assert c.config.tag == f"feature-x-{commit}-dirty"
+    c.run.assert_not_called()
+
+
+def test_generate_tag__falls_back_to_git(repo, monkeypatch):
+    from invoke import Context
+
+    image = importlib.import_module("kubesae.image")
+    monkeypatch.chdir(repo)
+    run(repo, "config", "core.abbrev", "12")
+    c = Context()
+    c.run = mock.Mock(
+        side_effect=[
+            mock.Mock(stdout="feature/y\n"),
+            mock.Mock(stdout="abcdef123456\n"),
+            mock.Mock(stdout=""),
+        ]
+    )
+    image.generate_tag(c)
+    assert c.config.tag == "feature-y-abcdef123456"
+    assert c.run.call_count == 3
+
+
+@pytest.mark.parametrize("cpus", [1, 2])
+def test_large_index__git_status(repo, monkeypatch, cpus):
+    monkeypatch.setattr(git, "GIT_STATUS_ENTRIES", 1)
+    monkeypatch.setattr(git, "usable_cpus", lambda: cpus)
+    assert not assert_matches_git(repo)
+    (repo / "src" / "app" / "new.py").write_text("")
+    assert assert_matches_git(repo)
+    os.remove(repo / "src" / "app" / "new.py")
+    (repo / "README").write_text("changed\n")
+    assert assert_matches_git(repo)
+
+
+def test_large_index__git_fails(repo, monkeypatch):
+    monkeypatch.setattr(git, "GIT_STATUS_ENTRIES", 1)
+    popen = subprocess.Popen
+
+    failed = []
+
+    def failing_status(args, **kwargs):
+        if "status" in args:
+            failed.append(args)
+            args = args + ["--no-such-option"]
+        return popen(args, **kwargs)
+
+    repository = git.Repository(str(repo))
+    monkeypatch.setattr(subprocess, "Popen", failing_status)
+    assert not repository.is_dirty()
+    (repo / "README").write_text("changed\n")
+    assert repository.is_dirty()
+    monkeypatch.undo()
+    assert failed
+
+
+def test_preload_stats__keeps_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(git, "PRELOAD_CHUNK", 2)
+    paths = []
+    for index in range(7):
+        path = tmp_path / f"file{index}"
+        path.write_text("x" * index)
+        paths.append(str(path))
+    paths.insert(3, str(tmp_path / "missing"))
+    stats = list(git.preload_stats(paths, threads=3))
+    assert stats[3] is None
+    assert [st.st_size for st in stats if st] == list(range(7))
@@ -0,0 +1,182 @@
+import importlib
+import json
+
+from unittest import mock
+
+import pytest
+
+from kubesae import digest, registry
+
+image = importlib.import_module("kubesae.image")
+
+DIGEST = "ab" * 32
+
+
+@pytest.fixture
+def c(c, monkeypatch):
+    c.config.app = "myapp"
+    c.config.tag = "main-1234567"
+    c.config.repository = "registry.example.com/myapp"
+    c.config.image_size_report = False
+    monkeypatch.setattr(digest, "context_digest", mock.Mock(return_value=(DIGEST, 3)))
+    client = mock.Mock()
+    client.manifest_digest.return_value = None
+    monkeypatch.setattr(registry, "get_client", mock.Mock(return_value=client))
+    return c
+
+
+def commands(c):
+    return [call.args[0] for call in c.run.call_args_list]
+
+
+def result(stdout="", ok=True):
+    return mock.Mock(stdout=stdout, ok=ok)
+
+
+def remote_image(labels):
+    return result(json.dumps({"config": {"Labels": labels}}))
+
+
+def test_build__labels_new_image_and_pushes_context_tag(c):
+    c.run.side_effect = [result(ok=False), result(""), result()]
+    image.build_image(c)
+    build = commands(c)[-1]
+    assert build.startswith("docker build -t myapp:latest -t myapp:main-1234567")
+    assert f"--label {digest.LABEL}={DIGEST}" in build
+    c.run.reset_mock(side_effect=True)
+    image.push_image(c, repository=[])
+    assert commands(c) == [
+        "docker tag myapp:main-1234567 registry.example.com/myapp:main-1234567",
+        "docker push registry.example.com/myapp:main-1234567",
+        f"docker tag myapp:main-1234567 registry.example.com/myapp:context-{DIGEST}",
+        f"docker push registry.example.com/myapp:context-{DIGEST}",
+    ]
+
+
+def test_build__reuses_image_in_registry(c):
+    c.run.return_value = remote_image({digest.LABEL: DIGEST})
+    image.build_image(c)
+    assert len(commands(c)) == 1
+    assert commands(c)[0].startswith("docker buildx imagetools inspect")
+    c.run.reset_mock()
+    image.push_image(c, repository=[])
+    assert commands(c) == [
+        "docker buildx imagetools create -t registry.example.com/myapp:main-1234567"
+        f" registry.example.com/myapp:context-{DIGEST}"
+    ]
+
+
+def test_build__label_must_match(c):
+    c.run.side_effect = [remote_image({digest.LABEL: "other"}), result(""), result()]
+    image.build_image(c)
+    assert commands(c)[-1].startswith("docker build")
+
+
+def test_build__retags_local_image(c):
+    c.run.side_effect = [result(ok=False), result("0123abcd\n"), result(), result()]
+    image.build_image(c)
+    assert commands(c)[2:] == [
+        "docker tag 0123abcd myapp:latest",
+        "docker tag 0123abcd myapp:main-1234567",
+    ]
+
+
+def test_build__no_reuse(c):
+    image.build_image(c, reuse=False)
+    assert len(commands(c)) == 1
+    assert digest.LABEL not in commands(c)[0]
+    assert not digest.context_digest.called
+
+
+PROGRESS = """\
+#1 [internal] load build definition from Dockerfile
+#1 transferring dockerfile: 612B done
+#1 DONE 0.0s
+#4 [builder 1/3] FROM docker.io/library/python:3.11
+#4 DONE 0.1s
+#5 [builder 2/3] RUN pip install -r requirements.txt
+#5 CACHED
+#6 [builder 3/3] RUN npm ci
+#6 0.512 added 812 packages
+#6 DONE 41.5s
+#7 [deploy 1/2] COPY --from=builder /venv /venv
+#7 CACHED
+#8 [deploy 2/2] COPY . /code
+#8 DONE 1.2s
+#9 exporting cache to registry
+#9 DONE 3.0s
+"""
+
+
+def test_parse_build_progress():
+    assert image.parse_build_progress(PROGRESS) == {
+        "builder": {"steps": 3, "cached": 1, "seconds": 41.6},
+        "deploy": {"steps": 2, "cached": 1, "seconds": 1.2},
+    }
+
+
+@pytest.mark.parametrize(
+    "branch,cache_from,cache_to",
+    [
+        (
+            "feature-x",
+            ["buildcache-feature-x", "buildcache-main"],
+            "buildcache-feature-x",
+        ),
+        ("main", ["buildcache-main"], "buildcache-main"),
+        ("HEAD", ["buildcache-main"], None),
+    ],
+)
+def test_cache_refs(c, monkeypatch, branch, cache_from, cache_to):
+    monkeypatch.setattr(image, "current_branch", lambda c: branch)
+    refs, ref = image.cache_refs(c, c.config.repository)
+    assert refs == [f"registry.example.com/myapp:{x}" for x in cache_from]
+    assert ref == (cache_to and f"registry.example.com/myapp:{cache_to}")
+
+
+def test_build__buildx(c, monkeypatch):
+    monkeypatch.setattr(image, "current_branch", lambda c: "feature-x")
+    c.config.image_buildx = True
+    c.run.side_effect = [result(ok=False), result(""), mock.Mock(stderr=PROGRESS)]
+    image.build_image(c)
+    build = commands(c)[-1]
+    assert build.startswith("docker buildx build  --load --progress=plain")
+    assert (
+        "--cache-from type=registry,ref=registry.example.com/myapp:buildcache-main"
+        in build
+    )
+    assert (
+        "--cache-to type=registry,ref=registry.example.com/myapp:buildcache-feature-x,"
+        in build
+    )
+    assert "-t myapp:main-1234567" in build
+
+
+def test_push__skips_up_to_date_repository(c):
+    registry.get_client().manifest_digest.return_value = "sha256:abc"
+    c.run.return_value = result('["registry.example.com/myapp@sha256:abc"]')
+    image.push_image(c, repository=[])
+    assert commands(c) == [
+        "docker image inspect --format '{{json .RepoDigests}}' myapp:main-1234567"
+    ]
+
+
+def test_push__pushes_changed_image(c):
+    registry.get_client().manifest_digest.return_value = "sha256:old"
+    c.run.return_value = result('["registry.example.com/myapp@sha256:new"]')
+    image.push_image(c, repository=[])
+    assert "docker push registry.example.com/myapp:main-1234567" in commands(c)
+
+
+def test_push__mirrors_concurrently(c, capsys):
+    c.config.image_mirror_repositories = ["mirror.example.com/myapp"]
+    c.run.return_value = result("[]")
+    image.push_image(c, repository=[])
+    assert "docker push registry.example.com/myapp:main-1234567" in commands(c)
+    assert "docker push mirror.example.com/myapp:main-1234567" in commands(c)
+    out = capsys.readouterr().out
+    assert "mirror.example.com/myapp" in out and "pushed" in out
+    c.run.reset_mock()
+    image.push_image(c, repository=["other.example.com/myapp"])
+    assert "docker push other.example.com/myapp:main-1234567" in commands(c)
+    assert "docker push mirror.example.com/myapp:main-1234567" not in commands(c)
@@ -0,0 +1,147 @@
+import importlib
+import threading
+
+from unittest import mock
+
+import invoke
+import pytest
+
+image = importlib.import_module("kubesae.image")
+
+
+@pytest.fixture
+def c(c):
+    c.config.app = "myapp"
+    c.config.tag = "main-1234567"
+    c.config.repository = "registry.example.com/myapp"
+    c.config.image_builds = {
+        "web": {
+            "target": "deploy",
+            "app": "myapp",
+            "repository": "registry.example.com/myapp",
+        },
+        "celery": {"target": "celery", "depends_on": ["web"]},
+        "docs": {"dockerfile": "docs/Dockerfile"},
+        "test": {
+            "dockerfile": "test_files/Dockerfile.test",
+            "depends_on": ["web"],
+            "push": False,
+        },
+    }
+    return c
+
+
+def test_read_build_set__defaults_and_order(c):
+    images = image.read_build_set(c)
+    assert list(images) == ["web", "docs", "celery", "test"]
+    assert images["celery"] == {
+        "target": "celery",
+        "app": "myapp-celery",
+        "repository": "registry.example.com/myapp-celery",
+        "dockerfile": "Dockerfile",
+        "push": True,
+        "depends_on": ["web"],
+    }
+    assert images["web"]["app"] == "myapp"
+    assert images["test"]["push"] is False
+
+
+@pytest.mark.parametrize(
+    "builds,message",
+    [
+        ({"a": {"depends_on": ["b"]}}, "a depends on unknown images: b"),
+        ({"a": {"depends_on": ["b"]}, "b": {"depends_on": ["a"]}}, "Circular"),
+        ({}, "No images"),
+    ],
+)
+def test_read_build_set__invalid(c, builds, message):
+    c.config.image_builds = builds
+    with pytest.raises(invoke.exceptions.Exit, match=message):
+        image.read_build_set(c)
+
+
+def test_run_build_set__runs_independent_builds_concurrently(c, monkeypatch):
+    started = {name: threading.Event() for name in ("myapp", "myapp-docs")}
+    order = []
+
+    def build(c, app, tag, dockerfile, target, **kwargs):
+        order.append(app)
+        if app in started:
+            started[app].set()
+            # web and docs don't depend on each other, so both run at once
+            other = "myapp-docs" if app == "myapp" else "myapp"
+            assert started[other].wait(5)
+        return "digest", None
+
+    push = mock.Mock(return_value="pushed")
+    monkeypatch.setattr(image, "build", build)
+    monkeypatch.setattr(image, "push", push)
+    report = image.run_build_set(c, image.read_build_set(c), "t1", 4, True, True, False)
+    assert set(order[:2]) == {"myapp", "myapp-docs"}
+    assert set(order[2:]) == {"myapp-celery", "myapp-test"}
+    assert {name: row["status"] for name, row in report.items()} == {
+        "web": "pushed",
+        "docs": "pushed",
+        "celery": "pushed",
+        "test": "built",
+    }
+    pushed = sorted(call.args[1] for call in push.call_args_list)
+    assert pushed == ["myapp", "myapp-celery", "myapp-docs"]
+
+
+def test_run_build_set__dependents_digests_include_dependencies(c, monkeypatch):
+    calls = {}
+
+    def build(c, app, tag, dockerfile, target, **kwargs):
+        calls[app] = kwargs["depends_on"]
+        return f"{app}-digest", None
+
+    monkeypatch.setattr(image, "build", build)
+    image.run_build_set(c, image.read_build_set(c), "t1", 2, False, True, False)
+    assert calls["myapp"] == calls["myapp-docs"] == []
+    assert calls["myapp-celery"] == calls["myapp-test"] == ["myapp-digest"]
+
+
+def test_build__dependency_changed(c, monkeypatch):
+    context_digest = mock.Mock(return_value=("d1", 0))
+    monkeypatch.setattr(image.digest, "context_digest", context_digest)
+    monkeypatch.setattr(image, "find_local_image", mock.Mock(return_value=None))
+    image.build(c, "myapp-celery", "t1", depends_on=["web-digest"])
+    assert context_digest.call_args.kwargs["depends_on"] == ["web-digest"]
+
+
+def test_run_build_set__skips_dependents_of_failed_builds(c, monkeypatch):
+    def build(c, app, *args, **kwargs):
+        if app == "myapp":
+            raise invoke.exceptions.UnexpectedExit(
+                invoke.Result(
+                    stderr="step 3/5 failed\nERROR: no space left\n", exited=1
+                )
+            )
+        return None, None
+
+    monkeypatch.setattr(image, "build", build)
+    report = image.run_build_set(
+        c, image.read_build_set(c), "t1", 2, False, True, False
+    )
+    assert report["web"]["status"] == "build failed: ERROR: no space left"
+    assert report["celery"]["status"] == "skipped (a dependency failed)"
+    assert report["docs"]["status"] == "built"
+
+
+def test_build_set__exits_on_failure(c, monkeypatch, capsys):
+    monkeypatch.setattr(image, "build", mock.Mock(side_effect=RuntimeError("boom")))
+    with pytest.raises(invoke.exceptions.Exit):
+        image.build_set(c)
+    out = capsys.readouterr().out
+    assert "web" in out and "build failed: boom" in out
+
+
+@pytest.mark.parametrize("result", ["tagged", "up to date", "pushed (3 blobs)"])
+def test_build_set__push_results_succeed(c, monkeypatch, capsys, result):
+    monkeypatch.setattr(image, "build", mock.Mock(return_value=("digest", None)))
+    monkeypatch.setattr(image, "push", mock.Mock(return_value=result))
+    image.build_set(c, push=True)
+    # the push succeeded, so build_set doesn't exit with an error
+    rows = [x for x in capsys.readouterr().out.splitlines() if x.startswith("web ")]
+    assert rows[0].endswith(f"  {result}")
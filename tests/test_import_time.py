@@ -0,0 +1,22 @@
+import json
+import subprocess
+import sys
+
+# only imported by the tasks that need them (yaml isn't listed: invoke imports it)
+HEAVY_MODULES = ("ansible", "boto3", "botocore", "google", "jinja2", "urllib3")
+
+
+def test_import_skips_heavy_modules():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import json, sys, kubesae; print(json.dumps(sorted(sys.modules)))",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    modules = json.loads(result.stdout)
+    loaded = [x for x in modules if x.split(".")[0] in HEAVY_MODULES]
+    assert loaded == []
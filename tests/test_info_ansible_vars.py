@@ -0,0 +1,91 @@
+import json
+import textwrap
+
+import invoke
+import pytest
+
+from kubesae.ansible import vars
+from kubesae.info import print_ansible_vars
+
+
+@pytest.fixture
+def project(c, tmp_path, monkeypatch):
+    for name in ("ANSIBLE_CONFIG", "ANSIBLE_INVENTORY", "ANSIBLE_VAULT_PASSWORD_FILE"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.chdir(tmp_path)
+    vars._files.clear()
+    deploy = tmp_path / "deploy"
+    (deploy / "host_vars").mkdir(parents=True)
+    (deploy / "group_vars").mkdir()
+    (deploy / "inventory").write_text("[k8s]\nstaging\n")
+    (deploy / "group_vars" / "all.yaml").write_text("app_name: myproject\n")
+    (deploy / "host_vars" / "staging.yaml").write_text(
+        textwrap.dedent(
+            """
+            k8s_namespace: "{{ app_name }}-staging"
+            k8s_environment_variables:
+              DEBUG: "False"
+              DOMAIN: "{{ k8s_namespace }}.example.com"
+            """
+        )
+    )
+    c.config.env = "staging"
+    yield deploy
+    vars._files.clear()
+
+
+def test_print_ansible_vars__default(c, project, capsys):
+    values = print_ansible_vars(c)
+    assert values == {
+        "k8s_environment_variables": {
+            "DEBUG": "False",
+            "DOMAIN": "myproject-staging.example.com",
+        }
+    }
+    assert json.loads(capsys.readouterr().out) == values
+    c.run.assert_not_called()
+
+
+def test_print_ansible_vars__several(c, project, capsys):
+    values = print_ansible_vars(
+        c, var=["app_name,k8s_namespace", "k8s_environment_variables.DOMAIN"]
+    )
+    assert values == {
+        "app_name": "myproject",
+        "k8s_namespace": "myproject-staging",
+        "k8s_environment_variables.DOMAIN": "myproject-staging.example.com",
+    }
+
+
+def test_print_ansible_vars__yaml(c, project):
+    (project / "group_vars" / "extra.yaml").write_text("app_name: other\n")
+    values = print_ansible_vars(c, var="k8s_namespace", yaml="@group_vars/extra.yaml")
+    assert values == {"k8s_namespace": "other-staging"}
+
+
+def test_print_ansible_vars__undefined(c, project, capsys):
+    with pytest.raises(invoke.exceptions.Exit):
+        print_ansible_vars(c, var=["app_name", "missing"])
+    out, err = capsys.readouterr()
+    assert json.loads(out) == {"app_name": "myproject"}
+    assert "missing" in err
+
+
+def test_print_ansible_vars__missing_yaml(c, project):
+    with pytest.raises(invoke.exceptions.Exit, match="group_vars/missing.yaml"):
+        print_ansible_vars(c, yaml="@group_vars/missing.yaml")
+
+
+def test_print_ansible_vars__hide(c, project, capsys):
+    with pytest.raises(invoke.exceptions.Exit):
+        print_ansible_vars(c, var=["app_name", "missing"], hide="out")
+    out, err = capsys.readouterr()
+    assert out == ""
+    assert "missing" in err
+    assert print_ansible_vars(c, var="app_name", hide=True) == {"app_name": "myproject"}
+    assert capsys.readouterr() == ("", "")
+
+
+def test_print_ansible_vars__pty_deprecated(c, project):
+    with pytest.warns(DeprecationWarning, match="pty"):
+        print_ansible_vars(c, var="app_name", pty=False)
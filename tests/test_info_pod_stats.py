@@ -0,0 +1,96 @@
+import io
+import json
+
+from unittest import mock
+
+import pytest
+
+from kubesae import kube
+from kubesae.info import pod_requests, pod_stats
+
+
+def make_pod(node, containers, init_containers=()):
+    def container(cpu, memory):
+        return {"resources": {"requests": {"cpu": cpu, "memory": memory}}}
+
+    return {
+        "spec": {
+            "nodeName": node,
+            "containers": [container(*x) for x in containers],
+            "initContainers": [container(*x) for x in init_containers],
+        }
+    }
+
+
+def make_node(name, cpu="4", memory="16Gi", pods="110"):
+    return {
+        "metadata": {"name": name},
+        "status": {
+            "capacity": {"pods": pods},
+            "allocatable": {"cpu": cpu, "memory": memory, "pods": pods},
+        },
+    }
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [("250m", 0.25), ("2", 2), ("512Mi", 512 * 2**20), ("1G", 1e9), ("1e3", 1000)],
+)
+def test_parse_quantity(value, expected):
+    assert kube.parse_quantity(value) == expected
+
+
+def test_pod_requests__sums_containers():
+    pod = make_pod("n1", [("100m", "64Mi"), ("150m", "64Mi")])
+    assert pod_requests(pod) == (0.25, 128 * 2**20)
+
+
+def test_pod_requests__init_container_max():
+    pod = make_pod("n1", [("100m", "64Mi")], init_containers=[("1", "32Mi")])
+    assert pod_requests(pod) == (1, 64 * 2**20)
+
+
+def test_paginate_follows_continue():
+    pages = [
+        {"items": [1, 2], "metadata": {"continue": "abc"}},
+        {"items": [3], "metadata": {}},
+    ]
+    client = kube.KubeClient.__new__(kube.KubeClient)
+    client.request = mock.Mock(
+        side_effect=[io.BytesIO(json.dumps(page).encode()) for page in pages]
+    )
+    assert list(client.paginate("/api/v1/pods", limit=2)) == [1, 2, 3]
+    assert client.request.call_args_list[1].args[2] == {"limit": 2, "continue": "abc"}
+
+
+def test_pod_stats__api(c, capsys):
+    client = mock.Mock()
+    client.paginate.side_effect = [
+        iter([make_node("n1"), make_node("n2")]),
+        iter(
+            [
+                make_pod("n1", [("500m", "1Gi")]),
+                make_pod("n1", [("500m", "1Gi")]),
+                make_pod("n2", [("1", "2Gi")]),
+            ]
+        ),
+    ]
+    with mock.patch.object(kube, "get_client", return_value=client):
+        pod_stats(c)
+    assert client.paginate.call_args.kwargs["fieldSelector"] == "status.phase=Running"
+    out = capsys.readouterr().out
+    assert "n1" in out and "2/110" in out and "1.00/4.00 (25%)" in out
+    assert "Running pods: 3" in out
+    assert "Maximum pods: 220" in out
+    assert "Total nodes: 2" in out
+
+
+def test_pod_stats__kubectl(c, capsys):
+    c.config.kube = {"api": False}
+    nodes = json.dumps({"items": [make_node("n1")]})
+    c.run.side_effect = [mock.Mock(stdout=nodes), mock.Mock(stdout="7\n")]
+    pod_stats(c)
+    assert "status.phase=Running" in c.run.call_args.args[0]
+    out = capsys.readouterr().out
+    assert "Running pods: 7" in out
+    assert "Maximum pods: 110" in out
@@ -0,0 +1,210 @@
+import datetime
+import io
+import json
+import threading
+
+from unittest import mock
+
+import pytest
+import yaml
+
+from kubesae import kube
+
+
+@pytest.fixture(autouse=True)
+def clients():
+    kube._clients.clear()
+    yield kube._clients
+    kube._clients.clear()
+
+
+@pytest.fixture
+def kubeconfig(tmp_path):
+    config = {
+        "current-context": "staging",
+        "contexts": [
+            {"name": "staging", "context": {"cluster": "eks", "user": "eks-user"}},
+            {"name": "other", "context": {"cluster": "eks", "user": "token-user"}},
+        ],
+        "clusters": [
+            {
+                "name": "eks",
+                "cluster": {
+                    "server": "https://k8s.example.com",
+                    "certificate-authority": "ca.crt",
+                },
+            }
+        ],
+        "users": [
+            {
+                "name": "eks-user",
+                "user": {
+                    "exec": {
+                        "apiVersion": "client.authentication.k8s.io/v1beta1",
+                        "command": "aws",
+                        "args": ["eks", "get-token"],
+                    }
+                },
+            },
+            {"name": "token-user", "user": {"token": "abc"}},
+        ],
+    }
+    path = tmp_path / "config"
+    path.write_text(yaml.safe_dump(config))
+    return path
+
+
+def exec_credential(token, expires_in):
+    expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=expires_in
+    )
+    status = {
+        "token": token,
+        "expirationTimestamp": expires.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+    return mock.Mock(stdout=json.dumps({"status": status}).encode())
+
+
+def test_load_kubeconfig__current_context(kubeconfig):
+    (cluster, cluster_dir), (user, _) = kube.load_kubeconfig([str(kubeconfig)])
+    assert cluster["server"] == "https://k8s.example.com"
+    assert cluster_dir == str(kubeconfig.parent)
+    assert user["exec"]["command"] == "aws"
+
+
+def test_load_kubeconfig__named_context(kubeconfig):
+    _, (user, _) = kube.load_kubeconfig([str(kubeconfig)], context="other")
+    assert user == {"token": "abc"}
+
+
+def test_load_kubeconfig__missing(tmp_path):
+    with pytest.raises(kube.KubeUnavailable):
+        kube.load_kubeconfig([str(tmp_path / "nope")])
+
+
+def test_exec_token_is_cached(kubeconfig):
+    _, user = kube.load_kubeconfig([str(kubeconfig)])
+    credentials = kube.Credentials(user)
+    with mock.patch("subprocess.run", return_value=exec_credential("t1", 900)) as run:
+        assert credentials.headers() == {"Authorization": "Bearer t1"}
+        assert credentials.headers() == {"Authorization": "Bearer t1"}
+    assert run.call_count == 1
+    assert run.call_args.args[0] == ["aws", "eks", "get-token"]
+
+
+def test_exec_token_refreshed_when_expired(kubeconfig):
+    _, user = kube.load_kubeconfig([str(kubeconfig)])
+    credentials = kube.Credentials(user)
+    with mock.patch("subprocess.run", return_value=exec_credential("t1", 30)) as run:
+        credentials.token()
+        credentials.token()
+    assert run.call_count == 2
+
+
+def test_api_or_kubectl__disabled(c):
+    c.config.kube = {"api": False}
+    api_call = mock.Mock()
+    kube.api_or_kubectl(c, api_call, "kubectl get pods", hide="out")
+    api_call.assert_not_called()
+    c.run.assert_called_once_with("kubectl get pods", hide="out")
+
+
+def test_api_or_kubectl__no_kubeconfig(c, tmp_path):
+    c.config.kube = {"kubeconfig": str(tmp_path / "missing")}
+    kube.api_or_kubectl(c, mock.Mock(), "kubectl get pods")
+    c.run.assert_called_once_with("kubectl get pods")
+
+
+def test_api_or_kubectl__unavailable(c):
+    client = mock.Mock()
+    with mock.patch.object(kube, "get_client", return_value=client):
+        kube.api_or_kubectl(
+            c, mock.Mock(side_effect=kube.KubeUnavailable), "kubectl get pods"
+        )
+    c.run.assert_called_once_with("kubectl get pods")
+
+
+def test_api_or_kubectl__unavailable_mid_operation(c):
+    client = kube.KubeClient.__new__(kube.KubeClient)
+    client.local = threading.local()
+
+    def api_call(client):
+        client._operation_started()
+        raise kube.KubeUnavailable("connection reset")
+
+    with mock.patch.object(kube, "get_client", return_value=client):
+        with pytest.raises(kube.KubeStreamError, match="connection reset"):
+            kube.api_or_kubectl(c, api_call, "kubectl get pods")
+    c.run.assert_not_called()
+
+
+def test_exec__truncated_frame():
+    client = exec_client((kube.STDOUT_CHANNEL, b"partial"))
+    client._websocket.return_value[1].truncate(5)
+    with pytest.raises(kube.KubeStreamError, match="closed unexpectedly"):
+        client.exec("ns", "web-1", ["pg_dump"])
+
+
+def test_kubectl(c):
+    assert kube.kubectl(c) == "kubectl"
+    c.config.kube = {"context": "arn:aws:eks:us-east-1:1:cluster/my cluster"}
+    assert kube.kubectl(c) == (
+        "kubectl --context 'arn:aws:eks:us-east-1:1:cluster/my cluster'"
+    )
+
+
+def test_label_selector():
+    selector = {
+        "matchLabels": {"app": "web", "tier": "front"},
+        "matchExpressions": [
+            {"key": "env", "operator": "In", "values": ["a", "b"]},
+            {"key": "canary", "operator": "DoesNotExist"},
+        ],
+    }
+    assert kube.label_selector(selector) == "app=web,tier=front,env in (a,b),!canary"
+
+
+def test_exit_code():
+    assert kube.exit_code({"status": "Success"}) == 0
+    status = {
+        "status": "Failure",
+        "details": {"causes": [{"reason": "ExitCode", "message": "3"}]},
+    }
+    assert kube.exit_code(status) == 3
+    assert kube.exit_code(None) is None
+
+
+def exec_client(*messages):
+    """A KubeClient whose exec websocket sends ``messages`` and then closes."""
+    client = kube.KubeClient.__new__(kube.KubeClient)
+    client.local = threading.local()
+    frames = b"".join(
+        kube._frame(0x2, bytes([channel]) + data) for channel, data in messages
+    )
+    client._websocket = mock.Mock(return_value=(mock.Mock(), io.BytesIO(frames)))
+    return client
+
+
+def test_exec():
+    status = {
+        "status": "Failure",
+        "details": {"causes": [{"reason": "ExitCode", "message": "2"}]},
+    }
+    client = exec_client(
+        (kube.STDOUT_CHANNEL, b"out"), (kube.ERROR_CHANNEL, json.dumps(status).encode())
+    )
+    result = client.exec("ns", "web-1", ["false"])
+    assert (result.stdout, result.exited) == ("out", 2)
+
+
+def test_exec__closed_without_status():
+    client = exec_client((kube.STDOUT_CHANNEL, b"partial"))
+    with pytest.raises(kube.KubeStreamError, match="without an exit status"):
+        client.exec("ns", "web-1", ["pg_dump"])
+
+
+@pytest.mark.parametrize("size", [0, 5, 200, 70000])
+def test_websocket_frame_roundtrip(size):
+    payload = bytes(range(256)) * (size // 256) + bytes(size % 256)
+    fin, opcode, data = kube._read_frame(io.BytesIO(kube._frame(0x2, payload)))
+    assert (fin, opcode, data) == (0x80, 0x2, payload)
@@ -0,0 +1,149 @@
+import importlib
+import json
+
+from unittest import mock
+
+import invoke
+import pytest
+
+from kubesae import layers
+
+image = importlib.import_module("kubesae.image")
+
+DOCKERFILE = """\
+FROM python:3.11 AS builder
+RUN pip install --no-cache-dir \\
+    # pinned in requirements
+    -r requirements.txt
+
+FROM python:3.11-slim AS deploy
+WORKDIR /code
+COPY --from=builder /venv /venv
+RUN apt-get update && \\
+    apt-get install -y libpq5
+COPY . /code
+CMD ["gunicorn"]
+"""
+
+
+def history(*sizes):
+    """``docker history`` output for DOCKERFILE's deploy stage, newest first."""
+    entries = [
+        ("ADD file:" + "a" * 64 + " in / ", 80 * 10**6),
+        ('CMD ["bash"]', 0),
+        ("WORKDIR /code", 0),
+        ("COPY /venv /venv # buildkit", sizes[0]),
+        (
+            "RUN /bin/sh -c apt-get update &&     apt-get install -y libpq5 # buildkit",
+            sizes[1],
+        ),
+        ("COPY . /code # buildkit", sizes[2]),
+        ('CMD ["gunicorn"]', 0),
+    ]
+    lines = [json.dumps({"CreatedBy": x, "Size": str(size)}) for x, size in entries]
+    return "\n".join(reversed(lines))
+
+
+@pytest.fixture
+def dockerfile(tmp_path):
+    path = tmp_path / "Dockerfile"
+    path.write_text(DOCKERFILE)
+    return str(path)
+
+
+def test_parse_dockerfile(dockerfile):
+    assert [x[:2] for x in layers.parse_dockerfile(dockerfile)] == [
+        (6, "FROM"),
+        (7, "WORKDIR"),
+        (8, "COPY"),
+        (9, "RUN"),
+        (11, "COPY"),
+        (12, "CMD"),
+    ]
+    assert layers.parse_dockerfile(dockerfile, "builder")[1] == (
+        2,
+        "RUN",
+        "pip install --no-cache-dir  -r requirements.txt",
+    )
+
+
+def test_image_layers__maps_history_to_lines(c, dockerfile):
+    c.run.return_value = mock.Mock(stdout=history(50 * 10**6, 20 * 10**6, 10**6))
+    result = layers.image_layers(c, "myapp:t1", dockerfile)
+    assert [(size, line) for size, line, _ in result] == [
+        (80 * 10**6, None),
+        (0, None),
+        (0, 7),
+        (50 * 10**6, 8),
+        (20 * 10**6, 9),
+        (10**6, 11),
+        (0, 12),
+    ]
+    assert result[0][2] == "ADD file in /"
+
+
+def test_image_layers__classic_builder(c, dockerfile):
+    output = "\n".join(
+        json.dumps({"CreatedBy": x, "Size": "1000"})
+        for x in [
+            '/bin/sh -c #(nop)  CMD ["gunicorn"]',
+            "/bin/sh -c #(nop) COPY dir:" + "b" * 64 + " in /code ",
+            "/bin/sh -c apt-get update &&     apt-get install -y libpq5",
+        ]
+    )
+    c.run.return_value = mock.Mock(stdout=output)
+    result = layers.image_layers(c, "myapp:t1", dockerfile)
+    assert [line for _, line, _ in result] == [9, 11, 12]
+
+
+@pytest.mark.parametrize(
+    "value,reference,expected",
+    [
+        ("10%", 500, 50),
+        ("200MB", 0, 200 * 10**6),
+        ("1.5GB", 0, 1.5 * 10**9),
+        (1024, 0, 1024),
+    ],
+)
+def test_parse_threshold(value, reference, expected):
+    assert layers.parse_threshold(value, reference) == expected
+
+
+def test_compare():
+    previous = [(100, None, "ADD file in /"), (50, 3, "COPY . /code")]
+    assert layers.compare(previous, previous, "10%", "20") == []
+    grown = [(100, None, "ADD file in /"), (500, 4, "COPY . /code"), (30, 5, "RUN x")]
+    assert layers.compare(previous, grown, "10%", "20") == [
+        "Image grew by 480B to 630B",
+        "Layer grew by 450B (line 4): COPY . /code",
+        "Layer grew by 30B (line 5): RUN x",
+    ]
+
+
+def test_check_image_size(c, dockerfile, tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    c.run.return_value = mock.Mock(stdout=history(50 * 10**6, 20 * 10**6, 10**6))
+    assert image.check_image_size(c, "myapp", "t1", dockerfile) == []
+    out = capsys.readouterr().out
+    assert "50.0MB     8  COPY /venv /venv" in out
+    assert "151.0MB total" in out
+    # a stray COPY adds a gigabyte
+    c.run.return_value = mock.Mock(stdout=history(50 * 10**6, 20 * 10**6, 10**9))
+    regressions = image.check_image_size(c, "myapp", "t2", dockerfile)
+    assert regressions == [
+        "Image grew by 999.0MB to 1.1GB",
+        "Layer grew by 999.0MB (line 11): COPY . /code",
+    ]
+    c.config.image_size_fail = True
+    c.run.return_value = mock.Mock(
+        stdout=history(50 * 10**6, 20 * 10**6, 2 * 10**9)
+    )
+    with pytest.raises(invoke.exceptions.Exit):
+        image.check_image_size(c, "myapp", "t3", dockerfile)
+    # rebuilding a tag compares it with the build before it, not with itself
+    c.config.image_size_fail = False
+    assert image.check_image_size(c, "myapp", "t3", dockerfile) == [
+        "Image grew by 1.0GB to 2.1GB",
+        "Layer grew by 1.0GB (line 11): COPY . /code",
+    ]
+    assert [b["tag"] for b in layers.SizeHistory("myapp").builds] == ["t1", "t2", "t3"]
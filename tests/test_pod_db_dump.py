@@ -0,0 +1,86 @@
+import importlib
+import io
+import tarfile
+
+from unittest import mock
+
+import invoke
+import pytest
+
+# kubesae.pod is shadowed by the "pod" collection in the package namespace
+pod = importlib.import_module("kubesae.pod")
+
+
+@pytest.fixture
+def namespace(c):
+    c.config.namespace = "myproject-staging"
+    c.config.container_name = "myproject-web"
+    c.config.kube = {"api": False}
+    return c.config.namespace
+
+
+def tar_bytes(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def test_extract_tar_stream(tmp_path):
+    data = tar_bytes({"toc.dat": b"toc", "3001.dat.gz": b"x" * 5000})
+    chunks = [data[i : i + 1000] for i in range(0, len(data), 1000)]
+    received = pod.extract_tar_stream(chunks, str(tmp_path / "dump"))
+    assert received == len(data)
+    assert (tmp_path / "dump" / "toc.dat").read_bytes() == b"toc"
+    assert (tmp_path / "dump" / "3001.dat.gz").stat().st_size == 5000
+
+
+def test_get_db_dump__custom_format(c, namespace):
+    pod.get_db_dump(c)
+    assert "pg_dump -Fc" in c.run.call_args.args[0]
+    assert f"> {namespace}_database.dump" in c.run.call_args.args[0]
+
+
+def test_get_db_dump__jobs(c, namespace):
+    with mock.patch.object(pod, "dump_directory") as dump_directory:
+        pod.get_db_dump(c, jobs=4, compress="zstd:3")
+    dump_directory.assert_called_once_with(
+        c, "DATABASE_URL", f"{namespace}_database", 4, "zstd:3", "/tmp"
+    )
+
+
+def test_get_db_dump__jobs_existing_dir(c, namespace, tmp_path):
+    (tmp_path / "toc.dat").write_text("")
+    with pytest.raises(invoke.exceptions.Exit):
+        pod.get_db_dump(c, filename=str(tmp_path), jobs=4)
+
+
+def test_dump_directory__script(c, namespace, tmp_path):
+    process = mock.Mock()
+    process.stdout.read.side_effect = [tar_bytes({"toc.dat": b"toc"}), b""]
+    process.wait.return_value = 0
+    with mock.patch("subprocess.Popen", wraps=pod.subprocess.Popen) as popen:
+        popen.side_effect = [process, mock.DEFAULT]
+        pod.dump_directory(c, "DATABASE_URL", str(tmp_path / "dump"), 8, "6")
+    script = popen.call_args_list[0].args[0][-1]
+    assert (
+        'pg_dump -Fd -j 8 --compress=6 --no-owner --clean --dbname "$DATABASE_URL"'
+        in script
+    )
+    assert 'tar -C "$dir/dump" -cf - .' in script
+    assert (tmp_path / "dump" / "toc.dat").read_bytes() == b"toc"
+
+
+def test_dump_directory__stream_closed_without_status(c, namespace, tmp_path):
+    client = mock.Mock()
+    client.find_pod.return_value = ("web-1", "web")
+    client.exec_stream.return_value = iter(
+        [(pod.kube.STDOUT_CHANNEL, tar_bytes({"toc.dat": b"toc"}))]
+    )
+    with mock.patch.object(pod.kube, "get_client", return_value=client):
+        with pytest.raises(pod.kube.KubeStreamError):
+            pod.dump_directory(c, "DATABASE_URL", str(tmp_path / "dump"), 8)
+    c.run.assert_not_called()
@@ -0,0 +1,82 @@
+import hashlib
+import importlib
+
+from unittest import mock
+
+import pytest
+
+# kubesae.pod is shadowed by the "pod" collection in the package namespace
+pod = importlib.import_module("kubesae.pod")
+
+
+@pytest.fixture
+def namespace(c):
+    c.config.namespace = "myproject-staging"
+    c.config.container_name = "myproject-web"
+    c.config.kube = {"api": False}
+    return c.config.namespace
+
+
+def test_checksum_manifest__file(tmp_path):
+    dump = tmp_path / "db.dump"
+    dump.write_bytes(b"data")
+    size, manifest = pod.checksum_manifest(str(dump))
+    assert size == 4
+    assert manifest == f"{hashlib.sha256(b'data').hexdigest()}  db.dump\n"
+
+
+def test_checksum_manifest__directory(tmp_path):
+    (tmp_path / "dump").mkdir()
+    (tmp_path / "dump" / "toc.dat").write_bytes(b"toc")
+    (tmp_path / "dump" / "3001.dat.gz").write_bytes(b"x")
+    size, manifest = pod.checksum_manifest(str(tmp_path / "dump"))
+    assert size == 4
+    assert [line.split("  ")[1] for line in manifest.splitlines()] == [
+        "dump/3001.dat.gz",
+        "dump/toc.dat",
+    ]
+
+
+def test_restore__stdin(c, namespace):
+    pod.restore_db_from_dump(c, filename="db.dump")
+    assert c.run.call_args.args[0].endswith("< db.dump")
+
+
+def test_restore__parallel(c, namespace, tmp_path):
+    dump = tmp_path / "db.dump"
+    dump.write_bytes(b"data")
+    c.run.return_value.stdout = "/tmp/kubesae-restore.abc\n"
+    with mock.patch.object(pod, "find_pod", return_value="web-123"):
+        pod.restore_db_from_dump(c, filename=str(dump), jobs=4)
+    commands = [call.args[0] for call in c.run.call_args_list]
+    exec_ = f"kubectl --namespace {namespace} exec -i web-123 --"
+    assert commands[0].startswith(f"{exec_} mktemp -d")
+    assert commands[1].endswith(f"| {exec_} tar -xf - -C /tmp/kubesae-restore.abc")
+    assert "sha256sum -c -" in commands[2]
+    assert "pg_restore -j 4" in commands[3]
+    assert "/tmp/kubesae-restore.abc/db.dump" in commands[3]
+    assert commands[4] == f"{exec_} rm -rf /tmp/kubesae-restore.abc"
+
+
+def test_restore__parallel_cleans_up_on_failure(c, namespace, tmp_path):
+    dump = tmp_path / "db.dump"
+    dump.write_bytes(b"data")
+    c.run.return_value.stdout = "/tmp/kubesae-restore.abc\n"
+    with mock.patch.object(pod, "find_pod", return_value="web-123"):
+        with mock.patch.object(pod, "copy_to_pod", side_effect=RuntimeError):
+            with pytest.raises(RuntimeError):
+                pod.restore_db_from_dump(c, filename=str(dump), jobs=4)
+    assert c.run.call_args.args[0].endswith("rm -rf /tmp/kubesae-restore.abc")
+
+
+def test_restore__parallel_context(c, namespace, tmp_path):
+    c.config.kube = {"api": False, "context": "other-cluster"}
+    dump = tmp_path / "db.dump"
+    dump.write_bytes(b"data")
+    c.run.return_value.stdout = "/tmp/kubesae-restore.abc\n"
+    pod.restore_db_from_dump(c, filename=str(dump), jobs=4)
+    commands = [call.args[0] for call in c.run.call_args_list]
+    # finding the pod, the copy and its verification all use the configured context
+    assert commands[0].startswith("kubectl --context other-cluster --namespace")
+    assert "| kubectl --context other-cluster --namespace" in commands[2]
+    assert all("kubectl --namespace" not in x for x in commands)
@@ -0,0 +1,116 @@
+import importlib
+import json
+import threading
+
+from unittest import mock
+
+import invoke
+import pytest
+
+pod = importlib.import_module("kubesae.pod")
+kube = importlib.import_module("kubesae.kube")
+
+ENV = {"MEDIA_BUCKET": "media", "DATABASE_URL": "postgres://db/app", "MULTI": "a\nb"}
+
+
+@pytest.fixture(autouse=True)
+def clear_memo():
+    pod._namespace_env.clear()
+    yield
+    pod._namespace_env.clear()
+
+
+@pytest.fixture
+def c(c):
+    c.config.namespace = "app-production"
+    c.config.container_name = "web"
+    c.config.kube = {"api": False}
+    c.run.return_value = invoke.Result(stdout=json.dumps(ENV))
+    return c
+
+
+def test_fetch_namespace_vars(c):
+    assert pod.fetch_namespace_vars(c, ["MEDIA_BUCKET", "DATABASE_URL", "MISSING"]) == {
+        "MEDIA_BUCKET": "media",
+        "DATABASE_URL": "postgres://db/app",
+    }
+    assert pod.fetch_namespace_vars(c) == ENV
+    c.run.assert_called_once()
+    command = c.run.call_args.args[0]
+    assert command.startswith(
+        "kubectl --namespace app-production exec -i deploy/web -- sh -c"
+    )
+    assert c.run.call_args.kwargs["hide"] is True
+
+
+def test_fetch_namespace_vars__refresh(c):
+    pod.fetch_namespace_vars(c)
+    pod.fetch_namespace_vars(c, refresh=True)
+    assert c.run.call_count == 2
+
+
+def test_fetch_namespace_vars__per_namespace(c):
+    pod.fetch_namespace_vars(c)
+    c.config.namespace = "app-staging"
+    pod.fetch_namespace_vars(c)
+    assert c.run.call_count == 2
+
+
+def test_fetch_namespace_vars__api(c):
+    c.config.kube = {}
+    client = mock.Mock()
+    client.find_pod.return_value = ("web-123", "web")
+    client.exec.return_value = invoke.Result(stdout=json.dumps(ENV))
+    with mock.patch("kubesae.kube.get_client", return_value=client):
+        assert pod.fetch_namespace_vars(c, ["MULTI"]) == {"MULTI": "a\nb"}
+    assert client.exec.call_args.args[2][:2] == ["sh", "-c"]
+
+
+def test_fetch_namespace_vars__api_unavailable_after_lookups(c):
+    c.config.kube = {}
+    deployment = {"spec": {"selector": {"matchLabels": {"app": "web"}}}}
+    pods = {
+        "items": [
+            {
+                "metadata": {"name": "web-123", "creationTimestamp": "2021-01-01"},
+                "status": {},
+                "spec": {"containers": [{"name": "web"}]},
+            }
+        ]
+    }
+    client = kube.KubeClient.__new__(kube.KubeClient)
+    client.local = threading.local()
+    client.server = "https://k8s.example.com"
+    client.credentials = mock.Mock(**{"headers.return_value": {}})
+    client.pool = mock.Mock()
+    client.pool.request.side_effect = [
+        mock.Mock(status=200, data=json.dumps(deployment).encode()),
+        mock.Mock(status=200, data=json.dumps(pods).encode()),
+    ]
+    client._websocket = mock.Mock(side_effect=kube.KubeUnavailable("refused"))
+    with mock.patch("kubesae.kube.get_client", return_value=client):
+        assert pod.fetch_namespace_vars(c) == ENV
+    assert client.pool.request.call_count == 2
+    client._websocket.assert_called_once()
+    c.run.assert_called_once()
+
+
+def test_parse_env_dump__nul_separated():
+    assert pod.parse_env_dump("A=1\0B=x=y\nz\0") == {"A": "1", "B": "x=y\nz"}
+
+
+def test_fetch_namespace_var(c, capsys):
+    result = pod.fetch_namespace_var(c, "MEDIA_BUCKET")
+    assert result.stdout.strip() == "media"
+    assert capsys.readouterr().out == "media\n"
+    with pytest.raises(invoke.exceptions.UnexpectedExit):
+        pod.fetch_namespace_var(c, "MISSING")
+    c.run.assert_called_once()
+
+
+def test_fetch_namespace_var__kube_context(c):
+    c.config.kube = {"api": False, "context": "other-cluster"}
+    pod.fetch_namespace_var(c, "MEDIA_BUCKET", hide=True)
+    assert c.run.call_args.args[0].startswith(
+        "kubectl --context other-cluster --namespace app-production exec"
+    )
@@ -0,0 +1,258 @@
+import base64
+import gzip
+import hashlib
+import http.server
+import importlib
+import io
+import json
+import re
+import tarfile
+import threading
+
+import pytest
+
+from kubesae import registry
+
+OCI_MANIFEST = "application/vnd.oci.image.manifest.v1+json"
+
+
+class FakeRegistry(http.server.ThreadingHTTPServer):
+    """Enough of the distribution API to push and inspect images, behind token auth."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRegistryHandler)
+        self.blobs, self.manifests, self.uploads = {}, {}, {}
+        self.requests = []
+        self.credentials = base64.b64encode(b"user:secret").decode()
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server_address[1]}"
+
+
+class FakeRegistryHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def authorized(self):
+        if self.headers.get("Authorization") == "Bearer token123":
+            return True
+        realm = f"http://{self.server.host}/token"
+        self.send(
+            401,
+            headers={
+                "WWW-Authenticate": f'Bearer realm="{realm}",service="fake",scope="push"'
+            },
+        )
+        return False
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def do_GET(self):
+        if self.path.startswith("/token"):
+            ok = self.headers.get("Authorization") == f"Basic {self.server.credentials}"
+            return self.send(
+                200 if ok else 403, json.dumps({"token": "token123"}).encode()
+            )
+        self.do_HEAD()
+
+    def do_HEAD(self):
+        self.server.requests.append((self.command, self.path))
+        if not self.authorized():
+            return
+        match = re.match(r"/v2/(.+)/(manifests|blobs)/(.+)$", self.path)
+        store = (
+            self.server.manifests
+            if match.group(2) == "manifests"
+            else self.server.blobs
+        )
+        item = store.get((match.group(1), match.group(3)))
+        if item is None:
+            return self.send(404)
+        media_type, data = item
+        digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+        self.send(
+            200, data, {"Docker-Content-Digest": digest, "Content-Type": media_type}
+        )
+
+    def do_POST(self):
+        self.server.requests.append(("POST", self.path))
+        if not self.authorized():
+            return
+        repository = re.match(r"/v2/(.+)/blobs/uploads/$", self.path).group(1)
+        upload = f"upload{len(self.server.uploads)}"
+        self.server.uploads[upload] = repository
+        self.send(
+            202,
+            headers={"Location": f"/v2/{repository}/blobs/uploads/{upload}?state=x"},
+        )
+
+    def do_PUT(self):
+        self.server.requests.append(("PUT", self.path))
+        if not self.authorized():
+            return
+        data = self.body()
+        match = re.match(
+            r"/v2/(.+)/blobs/uploads/(\w+)\?state=x&digest=(.+)$", self.path
+        )
+        if match:
+            digest = match.group(3).replace("%3A", ":")
+            assert digest == f"sha256:{hashlib.sha256(data).hexdigest()}"
+            self.server.blobs[(match.group(1), digest)] = (
+                "application/octet-stream",
+                data,
+            )
+            return self.send(201)
+        match = re.match(r"/v2/(.+)/manifests/(.+)$", self.path)
+        manifest = json.loads(data)
+        for blob in [manifest["config"]] + manifest["layers"]:
+            assert (match.group(1), blob["digest"]) in self.server.blobs
+        digest = f"sha256:{hashlib.sha256(data).hexdigest()}"
+        for reference in (match.group(2), digest):
+            self.server.manifests[(match.group(1), reference)] = (
+                self.headers["Content-Type"],
+                data,
+            )
+        self.send(201)
+
+
+@pytest.fixture
+def fake_registry(tmp_path, monkeypatch):
+    docker_config = tmp_path / "docker"
+    docker_config.mkdir()
+    server = FakeRegistry()
+    (docker_config / "config.json").write_text(
+        json.dumps({"auths": {server.host: {"auth": server.credentials}}})
+    )
+    monkeypatch.setenv("DOCKER_CONFIG", str(docker_config))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def descriptor(media_type, data):
+    return {
+        "mediaType": media_type,
+        "digest": f"sha256:{hashlib.sha256(data).hexdigest()}",
+        "size": len(data),
+    }
+
+
+def make_archive(path, layers):
+    """Write an OCI image layout tarball, as docker save does."""
+    blobs = {}
+    config = json.dumps({"architecture": "amd64", "os": "linux"}).encode()
+    layer_descriptors = []
+    for content in layers:
+        data = gzip.compress(content, mtime=0)
+        layer_descriptors.append(
+            descriptor("application/vnd.oci.image.layer.v1.tar+gzip", data)
+        )
+        blobs[layer_descriptors[-1]["digest"]] = data
+    config_descriptor = descriptor("application/vnd.oci.image.config.v1+json", config)
+    blobs[config_descriptor["digest"]] = config
+    manifest = json.dumps(
+        {
+            "schemaVersion": 2,
+            "mediaType": OCI_MANIFEST,
+            "config": config_descriptor,
+            "layers": layer_descriptors,
+        }
+    ).encode()
+    manifest_descriptor = descriptor(OCI_MANIFEST, manifest)
+    blobs[manifest_descriptor["digest"]] = manifest
+    index = json.dumps(
+        {"schemaVersion": 2, "manifests": [manifest_descriptor]}
+    ).encode()
+    with tarfile.open(path, "w") as tar:
+        files = {"index.json": index, "oci-layout": b'{"imageLayoutVersion": "1.0.0"}'}
+        for digest, data in blobs.items():
+            files[f"blobs/sha256/{digest.partition(':')[2]}"] = data
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return manifest_descriptor["digest"]
+
+
+@pytest.mark.parametrize(
+    "reference,expected",
+    [
+        ("python", (registry.DOCKER_HUB, "library/python", "latest")),
+        ("caktus/app:1.0", (registry.DOCKER_HUB, "caktus/app", "1.0")),
+        (
+            "123.dkr.ecr.us-east-1.amazonaws.com/app:main-abc",
+            ("123.dkr.ecr.us-east-1.amazonaws.com", "app", "main-abc"),
+        ),
+        ("localhost:5000/team/app", ("localhost:5000", "team/app", "latest")),
+        ("us.gcr.io/p/app@sha256:ab", ("us.gcr.io", "p/app", "sha256:ab")),
+    ],
+)
+def test_parse_reference(reference, expected):
+    assert registry.parse_reference(reference) == expected
+
+
+def test_push_archive(fake_registry, tmp_path):
+    client = registry.RegistryClient(fake_registry.host, insecure=True)
+    path = tmp_path / "image.tar"
+    digest = make_archive(path, [b"base layer", b"app layer"])
+    archive = registry.OCIArchive(str(path))
+    assert client.manifest_digest("myapp", "v1") is None
+    assert registry.push_archive(client, archive, "myapp", "v1") == 3
+    assert client.manifest_digest("myapp", "v1") == digest
+    # the tag is up to date, so nothing is pushed
+    fake_registry.requests.clear()
+    assert registry.push_archive(client, archive, "myapp", "v1") is None
+    assert fake_registry.requests == [("HEAD", "/v2/myapp/manifests/v1")]
+    # a new image only uploads the layer that changed
+    path = tmp_path / "image2.tar"
+    make_archive(path, [b"base layer", b"new app layer"])
+    assert (
+        registry.push_archive(client, registry.OCIArchive(str(path)), "myapp", "v2")
+        == 1
+    )
+
+
+def test_push_archive__rejects_other_archives(tmp_path):
+    path = tmp_path / "image.tar"
+    with tarfile.open(path, "w") as tar:
+        info = tarfile.TarInfo("manifest.json")
+        tar.addfile(info, io.BytesIO(b""))
+    with pytest.raises(
+        registry.invoke.exceptions.Exit, match="isn't an OCI image archive"
+    ):
+        registry.OCIArchive(str(path))
+
+
+def test_bad_credentials(fake_registry, tmp_path):
+    fake_registry.credentials = base64.b64encode(b"user:other").decode()
+    client = registry.RegistryClient(fake_registry.host, insecure=True)
+    with pytest.raises(registry.RegistryError, match="403"):
+        client.manifest_digest("myapp", "v1")
+
+
+def test_image_push__oci_archive(fake_registry, tmp_path, c):
+    image = importlib.import_module("kubesae.image")
+    path = tmp_path / "image.tar"
+    make_archive(path, [b"base layer"])
+    repository = f"{fake_registry.host}/myapp"
+    args = (c, "myapp", "v1", repository)
+    assert (
+        image.push(*args, context_digest="ab12", archive=str(path))
+        == "pushed (2 blobs)"
+    )
+    assert image.push(*args, archive=str(path)) == "up to date"
+    assert ("myapp", "context-ab12") in fake_registry.manifests
+    c.run.assert_not_called()
@@ -0,0 +1,97 @@
+import os
+
+from unittest import mock
+
+import pytest
+
+from kubesae import s3
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return s3.DownloadCache(str(tmp_path / "cache"), max_size=100)
+
+
+def test_fetch__downloads_then_links(s3_client, cache, tmp_path):
+    s3_client.put_object(Bucket="backups", Key="daily.pgdump", Body=b"x" * 10)
+    first, second = tmp_path / "first.pgdump", tmp_path / "second.pgdump"
+    result = cache.fetch(s3_client, "backups", "daily.pgdump", str(first))
+    assert result["verified"] == "etag"
+    assert "cached" not in result
+    with mock.patch("kubesae.s3.download") as download:
+        result = cache.fetch(s3_client, "backups", "daily.pgdump", str(second))
+    download.assert_not_called()
+    assert result["cached"] == "linked"
+    assert second.read_bytes() == b"x" * 10
+    assert os.path.samefile(first, second)
+
+
+def test_fetch__changed_object(s3_client, cache, tmp_path):
+    dest = tmp_path / "daily.pgdump"
+    s3_client.put_object(Bucket="backups", Key="daily.pgdump", Body=b"old")
+    cache.fetch(s3_client, "backups", "daily.pgdump", str(dest))
+    s3_client.put_object(Bucket="backups", Key="daily.pgdump", Body=b"new")
+    result = cache.fetch(s3_client, "backups", "daily.pgdump", str(dest))
+    assert "cached" not in result
+    assert dest.read_bytes() == b"new"
+
+
+def test_fetch__copies_across_filesystems(s3_client, cache, tmp_path):
+    dest = tmp_path / "daily.pgdump"
+    s3_client.put_object(Bucket="backups", Key="daily.pgdump", Body=b"data")
+    cache.fetch(s3_client, "backups", "daily.pgdump", str(dest))
+    os.remove(dest)
+    with mock.patch("os.link", side_effect=OSError(18, "Invalid cross-device link")):
+        result = cache.fetch(s3_client, "backups", "daily.pgdump", str(dest))
+    assert result["cached"] == "copied"
+    assert dest.read_bytes() == b"data"
+
+
+def test_fetch__evicts_least_recently_used(s3_client, cache, tmp_path):
+    for name in ("a", "b", "c"):
+        s3_client.put_object(Bucket="backups", Key=name, Body=b"x" * 40)
+    cache.fetch(s3_client, "backups", "a", str(tmp_path / "a"))
+    cache.fetch(s3_client, "backups", "b", str(tmp_path / "b"))
+    # use "a" again, so "b" is the least recently used
+    entry_a = cache.entry(
+        "backups", "a", s3_client.head_object(Bucket="backups", Key="a")["ETag"]
+    )
+    os.utime(f"{entry_a}.used", (1, 1))
+    cache.fetch(s3_client, "backups", "a", str(tmp_path / "a2"))
+    cache.fetch(s3_client, "backups", "c", str(tmp_path / "c"))
+    cached = {os.path.basename(path) for _, _, path in cache.entries()}
+    assert os.path.basename(entry_a) in cached
+    assert len(cached) == 2
+    assert sum(size for _, size, _ in cache.entries()) <= cache.max_size
+
+
+def test_fetch__larger_than_cache(s3_client, cache, tmp_path):
+    s3_client.put_object(Bucket="backups", Key="big", Body=b"x" * 101)
+    cache.fetch(s3_client, "backups", "big", str(tmp_path / "big"))
+    assert cache.entries() == []
+    assert (tmp_path / "big").read_bytes() == b"x" * 101
+
+
+def test_fetch__leaves_linked_file_mtime(s3_client, cache, tmp_path):
+    dest = tmp_path / "daily.pgdump"
+    s3_client.put_object(Bucket="backups", Key="daily.pgdump", Body=b"data")
+    cache.fetch(s3_client, "backups", "daily.pgdump", str(dest))
+    os.utime(dest, (1, 1))
+    cache.fetch(s3_client, "backups", "daily.pgdump", str(tmp_path / "again.pgdump"))
+    assert dest.stat().st_mtime == 1
+
+
+def test_evict__skips_locked_entries_and_removes_locks(s3_client, cache, tmp_path):
+    for name in ("a", "b"):
+        s3_client.put_object(Bucket="backups", Key=name, Body=b"x" * 60)
+    cache.fetch(s3_client, "backups", "a", str(tmp_path / "a"))
+    (entry_a,) = [path for _, _, path in cache.entries()]
+    with cache.lock(os.path.basename(entry_a)):
+        cache.evict(60)
+    assert os.path.exists(entry_a)
+    cache.fetch(s3_client, "backups", "b", str(tmp_path / "b"))
+    assert not os.path.exists(entry_a)
+    locks = [x for x in os.listdir(cache.path) if x.endswith(".lock")]
+    assert sorted(locks) == sorted(
+        ["cache.lock", f"{os.path.basename(cache.entries()[0][2])}.lock"]
+    )
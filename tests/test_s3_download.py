@@ -0,0 +1,106 @@
+import hashlib
+import os
+
+from unittest import mock
+
+import pytest
+
+from kubesae import s3
+
+MB = 2**20
+
+
+@pytest.fixture
+def client(s3_client):
+    return s3_client
+
+
+def multipart_upload(client, key, parts):
+    upload = client.create_multipart_upload(Bucket="backups", Key=key)
+    etags = [
+        client.upload_part(
+            Bucket="backups",
+            Key=key,
+            UploadId=upload["UploadId"],
+            PartNumber=number,
+            Body=data,
+        )["ETag"]
+        for number, data in enumerate(parts, 1)
+    ]
+    client.complete_multipart_upload(
+        Bucket="backups",
+        Key=key,
+        UploadId=upload["UploadId"],
+        MultipartUpload={
+            "Parts": [{"ETag": e, "PartNumber": n} for n, e in enumerate(etags, 1)]
+        },
+    )
+
+
+def test_download__single_part(client, tmp_path):
+    data = os.urandom(3 * MB + 17)
+    client.put_object(Bucket="backups", Key="daily.pgdump", Body=data)
+    dest = tmp_path / "daily.pgdump"
+    result = s3.download(client, "backups", "daily.pgdump", str(dest), part_size=MB)
+    assert dest.read_bytes() == data
+    assert result == {"size": len(data), "resumed": 0, "verified": "etag"}
+    assert not os.path.exists(f"{dest}.part.json")
+
+
+def test_download__multipart_etag(client, tmp_path):
+    parts = [os.urandom(5 * MB), os.urandom(5 * MB), os.urandom(MB)]
+    multipart_upload(client, "daily.pgdump", parts)
+    dest = tmp_path / "daily.pgdump"
+    result = s3.download(client, "backups", "daily.pgdump", str(dest), concurrency=3)
+    assert dest.read_bytes() == b"".join(parts)
+    assert result["verified"] == "etag"
+
+
+def test_download__resume(client, tmp_path):
+    data = os.urandom(4 * MB)
+    client.put_object(Bucket="backups", Key="daily.pgdump", Body=data)
+    dest = tmp_path / "daily.pgdump"
+    get_object = client.get_object
+    calls = []
+
+    def flaky_get_object(**kwargs):
+        calls.append(kwargs["Range"])
+        if kwargs["Range"] == f"bytes={2 * MB}-{3 * MB - 1}":
+            raise ConnectionError("interrupted")
+        return get_object(**kwargs)
+
+    with mock.patch.object(client, "get_object", side_effect=flaky_get_object):
+        with pytest.raises(ConnectionError):
+            s3.download(client, "backups", "daily.pgdump", str(dest), part_size=MB)
+    assert os.path.exists(f"{dest}.part.json")
+
+    with mock.patch.object(client, "get_object", wraps=get_object) as resumed:
+        result = s3.download(client, "backups", "daily.pgdump", str(dest), part_size=MB)
+    assert [call.kwargs["Range"] for call in resumed.call_args_list] == [
+        f"bytes={2 * MB}-{3 * MB - 1}"
+    ]
+    assert result["resumed"] == 3 * MB
+    assert dest.read_bytes() == data
+
+
+def test_download__restarts_when_object_changed(client, tmp_path):
+    client.put_object(Bucket="backups", Key="daily.pgdump", Body=b"old" * MB)
+    dest = tmp_path / "daily.pgdump"
+    (tmp_path / "daily.pgdump.part").write_bytes(b"old" * MB)
+    (tmp_path / "daily.pgdump.part.json").write_text(
+        '{"etag": "\\"stale\\"", "size": 3145728, "part_size": 67108864, "parts": {"0": ""}}'
+    )
+    result = s3.download(client, "backups", "daily.pgdump", str(dest))
+    assert result["resumed"] == 0
+    assert dest.read_bytes() == b"old" * MB
+
+
+def test_download__checksum_mismatch(client, tmp_path):
+    client.put_object(Bucket="backups", Key="daily.pgdump", Body=b"data")
+    dest = tmp_path / "daily.pgdump"
+    corrupted = hashlib.md5(b"corrupted")
+    with mock.patch.object(s3, "_file_digest", return_value=corrupted):
+        with pytest.raises(s3.ChecksumMismatch):
+            s3.download(client, "backups", "daily.pgdump", str(dest))
+    assert not dest.exists()
+    assert not os.path.exists(f"{dest}.part")
@@ -0,0 +1,75 @@
+from unittest import mock
+
+import pytest
+
+from kubesae import s3
+
+
+@pytest.fixture
+def index(s3_client, tmp_path):
+    for name in ("daily-app-202101010000.pgdump", "weekly-app-202101010000.pgdump"):
+        s3_client.put_object(Bucket="backups", Key=f"app/{name}", Body=b"x")
+    s3_client.put_object(Bucket="backups", Key="other/daily-other.pgdump", Body=b"x")
+    return s3.ListingIndex(s3_client, "backups", "app", path=str(tmp_path))
+
+
+def names(objects):
+    return [x[0] for x in objects]
+
+
+def test_objects(index):
+    objects = index.objects()
+    assert names(objects) == [
+        "daily-app-202101010000.pgdump",
+        "weekly-app-202101010000.pgdump",
+    ]
+    assert objects[0][1] == 1
+    assert isinstance(objects[0][2], int)
+
+
+def test_objects__cached(index, s3_client):
+    index.objects()
+    s3_client.put_object(
+        Bucket="backups", Key="app/daily-app-202101020000.pgdump", Body=b"x"
+    )
+    assert len(index.objects()) == 2
+
+
+def test_objects__incremental(index, s3_client):
+    index.objects()
+    s3_client.put_object(
+        Bucket="backups", Key="app/daily-app-202101020000.pgdump", Body=b"x"
+    )
+    s3_client.delete_object(Bucket="backups", Key="app/weekly-app-202101010000.pgdump")
+    index.ttl = 0
+    with mock.patch.object(
+        index, "list_objects", wraps=index.list_objects
+    ) as list_objects:
+        objects = index.objects()
+    list_objects.assert_any_call("app/daily-", "app/daily-app-202101010000.pgdump")
+    # deleted objects are only dropped by a full listing
+    assert names(objects) == [
+        "daily-app-202101010000.pgdump",
+        "daily-app-202101020000.pgdump",
+        "weekly-app-202101010000.pgdump",
+    ]
+
+
+def test_objects__refresh(index, s3_client):
+    index.objects()
+    s3_client.delete_object(Bucket="backups", Key="app/weekly-app-202101010000.pgdump")
+    assert names(index.objects(refresh=True)) == ["daily-app-202101010000.pgdump"]
+
+
+def test_objects__full_listing_due(index, s3_client):
+    index.objects()
+    s3_client.delete_object(Bucket="backups", Key="app/weekly-app-202101010000.pgdump")
+    index.ttl = 0
+    with mock.patch(
+        "time.time", return_value=s3.time.time() + s3.FULL_LISTING_INTERVAL + 1
+    ):
+        assert names(index.objects()) == ["daily-app-202101010000.pgdump"]
+
+
+def test_list_folders(s3_client, index):
+    assert s3.list_folders(s3_client, "backups") == ["app/", "other/"]
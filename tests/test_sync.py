@@ -0,0 +1,160 @@
+import importlib
+import os
+
+from unittest import mock
+
+import pytest
+
+from kubesae import sync
+
+
+@pytest.fixture
+def source(s3_client):
+    for name in ("a.txt", "images/b.jpg", "images/c.jpg", "docs/d.pdf"):
+        s3_client.put_object(Bucket="backups", Key=f"media/{name}", Body=name.encode())
+    return sync.S3Store(s3_client, "backups/media")
+
+
+@pytest.fixture
+def target(s3_client):
+    s3_client.create_bucket(Bucket="staging")
+    return sync.S3Store(s3_client, "staging")
+
+
+def keys(client, bucket, prefix=""):
+    response = client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    return sorted(x["Key"] for x in response.get("Contents", []))
+
+
+def run(source, target, tmp_path, **kwargs):
+    lines = []
+    stats = sync.sync(
+        source, target, manifest_dir=str(tmp_path), log=lines.append, **kwargs
+    )
+    return stats, lines
+
+
+def test_sync__bucket(s3_client, source, target, tmp_path):
+    stats, lines = run(source, target, tmp_path, acl="private")
+    assert keys(s3_client, "staging") == [
+        "a.txt",
+        "docs/d.pdf",
+        "images/b.jpg",
+        "images/c.jpg",
+    ]
+    assert stats["copied"] == 4
+    assert "copy: s3://backups/media/a.txt to s3://staging/a.txt" in lines
+
+
+def test_sync__unchanged(s3_client, source, target, tmp_path):
+    run(source, target, tmp_path)
+    s3_client.put_object(Bucket="backups", Key="media/images/b.jpg", Body=b"changed")
+    stats, lines = run(source, target, tmp_path)
+    assert stats == {"copied": 1, "deleted": 0, "unchanged": 3, "failed": 0, "bytes": 7}
+    assert (
+        s3_client.get_object(Bucket="staging", Key="images/b.jpg")["Body"].read()
+        == b"changed"
+    )
+
+
+def test_sync__uses_manifest(s3_client, source, target, tmp_path):
+    run(source, target, tmp_path)
+    s3_client.put_object(Bucket="backups", Key="media/images/e.jpg", Body=b"new")
+    with mock.patch.object(target, "list") as list_target:
+        stats, _ = run(source, target, tmp_path)
+    list_target.assert_not_called()
+    assert stats["copied"] == 1
+    with mock.patch.object(target, "list", wraps=target.list) as list_target:
+        stats, _ = run(source, target, tmp_path, relist=True)
+    assert list_target.called
+    assert stats["copied"] == 0
+
+
+def test_sync__relist_repairs_target(s3_client, source, target, tmp_path):
+    run(source, target, tmp_path)
+    s3_client.delete_object(Bucket="staging", Key="images/b.jpg")
+    s3_client.put_object(Bucket="staging", Key="a.txt", Body=b"overwritten")
+    s3_client.put_object(Bucket="staging", Key="images/extra.jpg", Body=b"x")
+    # the source is unchanged, so the target isn't looked at
+    stats, _ = run(source, target, tmp_path, delete=True)
+    assert (stats["copied"], stats["deleted"], stats["unchanged"]) == (0, 0, 4)
+    stats, _ = run(source, target, tmp_path, delete=True, relist=True)
+    assert (stats["copied"], stats["deleted"]) == (2, 1)
+    assert keys(s3_client, "staging") == [
+        "a.txt",
+        "docs/d.pdf",
+        "images/b.jpg",
+        "images/c.jpg",
+    ]
+
+
+def test_sync__delete(s3_client, source, target, tmp_path):
+    s3_client.put_object(Bucket="staging", Key="old/x.txt", Body=b"x")
+    s3_client.put_object(Bucket="staging", Key="images/y.jpg", Body=b"y")
+    stats, lines = run(source, target, tmp_path, delete=True)
+    assert stats["deleted"] == 2
+    assert keys(s3_client, "staging") == [
+        "a.txt",
+        "docs/d.pdf",
+        "images/b.jpg",
+        "images/c.jpg",
+    ]
+
+
+def test_sync__dry_run(s3_client, source, target, tmp_path):
+    s3_client.put_object(Bucket="staging", Key="old/x.txt", Body=b"x")
+    stats, lines = run(source, target, tmp_path, delete=True, dry_run=True)
+    assert keys(s3_client, "staging") == ["old/x.txt"]
+    assert (
+        "(dryrun) copy: s3://backups/media/docs/d.pdf to s3://staging/docs/d.pdf"
+        in lines
+    )
+    assert "(dryrun) delete: s3://staging/old/x.txt" in lines
+
+
+def test_sync__sibling(s3_client, source, tmp_path):
+    target = sync.S3Store(s3_client, "backups/media/staging")
+    run(source, target, tmp_path)
+    stats, _ = run(source, target, tmp_path)
+    assert keys(s3_client, "backups", "media/staging/") == [
+        "media/staging/a.txt",
+        "media/staging/docs/d.pdf",
+        "media/staging/images/b.jpg",
+        "media/staging/images/c.jpg",
+    ]
+    assert stats["copied"] == 0
+
+
+def test_sync__local(s3_client, source, tmp_path):
+    target = sync.LocalStore(str(tmp_path / "media"))
+    run(source, target, tmp_path)
+    assert (tmp_path / "media/images/b.jpg").read_bytes() == b"images/b.jpg"
+    (tmp_path / "media/old.txt").write_bytes(b"old")
+    stats, _ = run(source, target, tmp_path, delete=True)
+    assert stats["copied"] == 0
+    assert stats["deleted"] == 1
+    assert not os.path.exists(tmp_path / "media/old.txt")
+
+
+def test_differs():
+    assert sync.differs([1, "abc", 10], None)
+    assert sync.differs([1, "abc", 10], [2, "abc", 10])
+    assert sync.differs([1, "abc", 10], [1, "def", 20])
+    assert not sync.differs([1, "abc-2", 10], [1, "def", 20])
+    assert sync.differs([1, None, 30], [1, None, 20])
+
+
+def test_sync_media_task(c, s3_client, source, target):
+    aws = importlib.import_module("kubesae.providers.aws")
+    c.config.env = "production"
+    c.config.app = "app"
+    c.config.container_name = "app"
+    names = iter(["backups/media", "staging"])
+    with mock.patch.object(aws, "fetch_namespace_var") as fetch, mock.patch.object(
+        aws.s3, "get_client", return_value=s3_client
+    ), mock.patch.object(aws.sync, "sync", wraps=aws.sync.sync) as run_sync:
+        fetch.side_effect = lambda *args, **kwargs: mock.Mock(stdout=next(names))
+        aws.sync_media_tree(c, workers=4, dry_run=True)
+    assert str(run_sync.call_args.args[0]) == "s3://backups/media/"
+    assert str(run_sync.call_args.args[1]) == "s3://staging/"
+    assert run_sync.call_args.kwargs["workers"] == 4
@@ -0,0 +1,166 @@
+import base64
+import datetime
+import hashlib
+import io
+import sys
+
+from unittest import mock
+
+import invoke
+import pytest
+
+from kubesae import sync
+
+
+class FakeBlob:
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket, self.name, self.chunk_size = bucket, name, chunk_size
+
+    @property
+    def _data(self):
+        return self.bucket.objects[self.name]
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    @property
+    def md5_hash(self):
+        return base64.b64encode(hashlib.md5(self._data).digest()).decode()
+
+    @property
+    def updated(self):
+        return self.bucket.updated[self.name]
+
+    def _store(self, data):
+        self.bucket.objects[self.name] = data
+        self.bucket.updated[self.name] = datetime.datetime.now(datetime.timezone.utc)
+
+    def upload_from_file(self, fileobj, size):
+        chunks = []
+        while True:
+            chunk = fileobj.read(self.chunk_size)
+            assert len(chunk) <= self.chunk_size
+            if not chunk:
+                break
+            chunks.append(chunk)
+        assert sum(len(x) for x in chunks) == size
+        self._store(b"".join(chunks))
+
+    def open(self, mode, chunk_size):
+        return io.BytesIO(self._data)
+
+    def rewrite(self, source, token=None):
+        self._store(source._data)
+        return None, source.size, source.size
+
+
+class FakeBucket:
+    def __init__(self, name):
+        self.name, self.objects, self.updated = name, {}, {}
+
+    def blob(self, name, chunk_size=None):
+        return FakeBlob(self, name, chunk_size)
+
+    def delete_blob(self, name):
+        del self.objects[name]
+
+
+class FakeBlobs(list):
+    prefixes = ()
+
+
+class FakeGCS:
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeBucket(name))
+
+    def list_blobs(self, bucket, prefix, delimiter=None, fields=None):
+        blobs, prefixes = FakeBlobs(), set()
+        for name in sorted(bucket.objects):
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix) :]
+            if delimiter and delimiter in rest:
+                prefixes.add(prefix + rest.split(delimiter)[0] + delimiter)
+            else:
+                blobs.append(FakeBlob(bucket, name))
+        blobs.prefixes = prefixes
+        return blobs
+
+    def batch(self):
+        return mock.MagicMock()
+
+
+@pytest.fixture
+def gcs():
+    return FakeGCS()
+
+
+@pytest.fixture
+def source(s3_client):
+    for name in ("a.txt", "images/b.jpg", "images/c.jpg"):
+        s3_client.put_object(Bucket="backups", Key=f"media/{name}", Body=name.encode())
+    s3_client.put_object(
+        Bucket="backups", Key="media/big.bin", Body=b"x" * (20 * 2**20)
+    )
+    return sync.S3Store(s3_client, "backups/media")
+
+
+def test_sync__s3_to_gcs(source, gcs, tmp_path):
+    target = sync.GCSStore(gcs, "media-bucket/uploads")
+    stats = sync.sync(source, target, manifest_dir=str(tmp_path), log=lambda x: None)
+    bucket = gcs.bucket("media-bucket")
+    assert sorted(bucket.objects) == [
+        "uploads/a.txt",
+        "uploads/big.bin",
+        "uploads/images/b.jpg",
+        "uploads/images/c.jpg",
+    ]
+    assert bucket.objects["uploads/big.bin"] == b"x" * (20 * 2**20)
+    assert stats["copied"] == 4
+    # the size and MD5 of single part objects match, so they are skipped when relisting
+    stats = sync.sync(
+        source, target, manifest_dir=str(tmp_path), relist=True, log=lambda x: None
+    )
+    assert stats["copied"] == 0
+
+
+def test_sync__gcs_to_s3(s3_client, gcs, tmp_path):
+    bucket = gcs.bucket("media-bucket")
+    FakeBlob(bucket, "docs/d.pdf")._store(b"pdf")
+    FakeBlob(bucket, "e.txt")._store(b"e")
+    s3_client.create_bucket(Bucket="staging")
+    s3_client.put_object(Bucket="staging", Key="e.txt", Body=b"e")
+    target = sync.S3Store(s3_client, "staging")
+    stats = sync.sync(
+        sync.GCSStore(gcs, "media-bucket"),
+        target,
+        manifest_dir=str(tmp_path),
+        log=lambda x: None,
+    )
+    assert stats["copied"] == 1
+    assert stats["unchanged"] == 1
+    assert (
+        s3_client.get_object(Bucket="staging", Key="docs/d.pdf")["Body"].read()
+        == b"pdf"
+    )
+
+
+def test_get_gcs_client__missing():
+    with mock.patch.dict(sys.modules, {"google.cloud": None}):
+        with pytest.raises(invoke.exceptions.Exit) as e:
+            sync.get_gcs_client()
+    assert "google-cloud-storage" in e.value.message
+
+
+def test_namespace_context(c):
+    c.config.app = "app"
+    c.config.container_name = "web"
+    c.config.kube = {"api": False}
+    cc = sync.namespace_context(c, "production", "other-cluster")
+    assert cc.config.namespace == "app-production"
+    assert cc.config.kube == {"api": False, "context": "other-cluster"}
+    assert "context" not in c.config.kube
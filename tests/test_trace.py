@@ -0,0 +1,100 @@
+import json
+import pty
+
+import invoke
+import pytest
+
+from invoke.context import Context
+
+from kubesae import trace
+
+
+@pytest.fixture
+def profiler(tmp_path):
+    profiler = trace.enable(str(tmp_path / "trace.json"))
+    yield profiler
+    trace.finish()
+
+
+@invoke.task
+def inner(c):
+    c.run("echo hello", hide=True, in_stream=False)
+
+
+@invoke.task
+def outer(c):
+    inner(c)
+    c.run("exit 3", hide=True, warn=True, in_stream=False)
+
+
+def test_profile_records_tasks_and_commands(profiler, tmp_path, capsys):
+    outer(Context())
+    trace.finish()
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    spans = {event["name"]: event for event in events}
+    assert spans["echo hello"]["args"] == {
+        "exit_code": 0,
+        "output_bytes": 6,
+        "subprocesses": 1,
+    }
+    assert spans["exit 3"]["args"]["exit_code"] == 3
+    assert spans["test_trace.outer"]["args"]["subprocesses"] == 2
+    assert spans["test_trace.inner"]["args"]["subprocesses"] == 1
+    assert all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+    out = capsys.readouterr().out
+    assert "test_trace.outer" in out
+    assert f"trace written to {tmp_path / 'trace.json'}" in out
+
+
+def test_profile_failed_command(profiler, tmp_path):
+    with pytest.raises(invoke.exceptions.UnexpectedExit):
+        Context().run("echo oops; exit 2", hide=True, in_stream=False)
+    trace.finish()
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert events[0]["args"]["exit_code"] == 2
+    assert events[0]["args"]["output_bytes"] == 5
+
+
+def test_finish_restores_patches(profiler):
+    trace.finish()
+    assert invoke.Context.run.__name__ == "run"
+    assert invoke.Task.__call__.__name__ == "__call__"
+
+
+def test_profile_output_bytes(profiler, tmp_path):
+    Context().run("printf 'caf\\303\\251'", hide=True, in_stream=False)
+    trace.finish()
+    (event,) = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    # "café" is 5 bytes in UTF-8
+    assert event["args"]["output_bytes"] == 5
+
+
+def test_profile_counts_pty_forks(tmp_path, monkeypatch):
+    # c.run(..., pty=True) forks with pty.fork rather than Popen
+    monkeypatch.setattr(pty, "fork", lambda: (1234, 5))
+
+    @invoke.task
+    def shell(c):
+        pty.fork()
+
+    trace.enable(str(tmp_path / "trace.json"))
+    try:
+        shell(Context())
+    finally:
+        trace.finish()
+    (event,) = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert event["args"]["subprocesses"] == 1
+
+
+def test_import_leaves_invoke_alone():
+    # profiling patches invoke only once it's enabled
+    for function in (invoke.Task.__call__, invoke.Context.run):
+        assert function.__module__.startswith("invoke.")
+        assert not hasattr(function, "__wrapped__")
+
+
+def test_profile_is_a_top_level_task():
+    import kubesae
+
+    assert kubesae.profile is trace.profile
+    assert "profile" not in kubesae.utils.tasks
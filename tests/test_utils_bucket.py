@@ -1,6 +1,22 @@
+import time
+
+from unittest import mock
+
 import pytest
 
-from kubesae.utils import BASE_BACKUP_BUCKET, get_backup_from_hosting
+from kubesae.utils import (
+    BASE_BACKUP_BUCKET,
+    classify_backups,
+    count_backups,
+    get_backup_from_hosting,
+    list_backup_schedules,
+)
+
+
+@pytest.fixture(autouse=True)
+def download():
+    with mock.patch("kubesae.utils.download_backup") as download_backup:
+        yield download_backup
 
 
 @pytest.fixture
@@ -18,34 +34,102 @@ def test_folder(c):
 
 
 @pytest.fixture
-def s3_filename(c, test_folder):
-    filename = f"daily-{test_folder}-202101010000.pgdump"
-    listing = f"2021-01-01 08:00:00 111266 {filename}"
-    c.run.return_value.stdout.strip.return_value = listing
+def index():
+    with mock.patch("kubesae.utils.backup_index") as backup_index:
+        yield backup_index
+
+
+@pytest.fixture
+def utc(monkeypatch):
+    # backup dates are shown in local time
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.fixture
+def s3_filename(c, test_folder, index):
+    filename = f"daily-{test_folder}-202101020000.pgdump"
+    index.return_value = [
+        [f"daily-{test_folder}-202101010000.pgdump", 111266, 1609488000],
+        [filename, 111266, 1609574400],
+        [f"weekly-{test_folder}-202101030000.pgdump", 111266, 1609660800],
+    ]
     return filename
 
 
-def test_backup_bucket__default(c, test_folder):
+def test_backup_bucket__default(c, test_folder, download):
     get_backup_from_hosting(c, backup_name="-")
-    assert f"aws s3 cp s3://{BASE_BACKUP_BUCKET}" in c.run.call_args.args[0]
+    assert download.call_args.args[0] == BASE_BACKUP_BUCKET
 
 
-def test_backup_bucket__custom(c, test_bucket, test_folder):
+def test_backup_bucket__custom(c, test_bucket, test_folder, download):
     get_backup_from_hosting(c, backup_name="-")
-    assert f"aws s3 cp s3://{test_bucket}" in c.run.call_args.args[0]
+    assert download.call_args.args[0] == test_bucket
 
 
-def test_bucket_folder(c, test_bucket, test_folder):
+def test_bucket_folder(c, test_bucket, test_folder, download):
     get_backup_from_hosting(c, backup_name="-")
-    cmd = c.run.call_args.args[0]
-    assert f"aws s3 cp s3://{test_bucket}/{test_folder}" in cmd
+    assert download.call_args.args[1] == f"{test_folder}/-"
 
 
-def test_backup_name__default(c, test_bucket, test_folder, s3_filename):
+def test_backup_name__default(c, test_bucket, test_folder, s3_filename, download):
     get_backup_from_hosting(c)
-    assert f"./{s3_filename}" in c.run.call_args.args[0]
+    assert download.call_args.args[1] == f"{test_folder}/{s3_filename}"
+    assert download.call_args.args[2] == s3_filename
+
+
+def test_backup_name__custom(c, test_bucket, test_folder, download):
+    get_backup_from_hosting(c, backup_name="mydb.pgdump")
+    assert download.call_args.args[2] == "mydb.pgdump"
+
+
+def test_concurrency__config(c, test_bucket, test_folder, download):
+    c.config.hosting_services_backup_concurrency = 16
+    get_backup_from_hosting(c, backup_name="mydb.pgdump")
+    assert download.call_args.args[4] == 16
 
 
-def test_backup_name__custom(c, test_bucket, test_folder):
+def test_cache__config(c, test_bucket, test_folder, download):
+    c.config.hosting_services_backup_cache_dir = "/tmp/backup-cache"
+    c.config.hosting_services_backup_cache_size = 1000
     get_backup_from_hosting(c, backup_name="mydb.pgdump")
-    assert "./mydb.pgdump" in c.run.call_args.args[0]
+    cache = download.call_args.args[5]
+    assert (cache.path, cache.max_size) == ("/tmp/backup-cache", 1000)
+
+
+def test_cache__disabled(c, test_bucket, test_folder, download):
+    get_backup_from_hosting(c, backup_name="mydb.pgdump", cache=False)
+    assert download.call_args.args[5] is None
+
+
+def test_list_backup_schedules(c, test_folder, s3_filename, index, capsys):
+    list_backup_schedules(c)
+    assert index.call_args.args[1:3] == ("caktus-hosting-services-backups", test_folder)
+    assert capsys.readouterr().out.split("\n")[2:4] == ["daily", "weekly"]
+
+
+def test_count_backups(c, test_folder, s3_filename, index, capsys, utc):
+    count_backups(c, refresh=True)
+    assert index.call_args.args[-1] is True
+    out = capsys.readouterr().out
+    assert "002: daily (0.0 GiB, 2021-01-01 to 2021-01-02)" in out
+    assert "001: weekly" in out
+    assert "000: monthly\n" in out
+
+
+def test_classify_backups():
+    objects = [
+        ["daily-app-202101010000.pgdump", 10, 100],
+        ["daily-app-202101020000.pgdump", 20, 200],
+        ["every-hour-app-202101020000.pgdump", 5, 150],
+        ["hour-app-202101020000.pgdump.tmp", 5, 150],
+        ["weekly-daily-app.txt", 1, 1],
+    ]
+    result = classify_backups(["daily", "weekly", "hour", "every-hour"], objects)
+    assert result["daily"] == {"count": 2, "bytes": 30, "oldest": 100, "newest": 200}
+    assert result["every-hour"]["count"] == 1
+    assert result["hour"]["count"] == 0
+    assert result["weekly"] == {"count": 0, "bytes": 0, "oldest": None, "newest": None}
@@ -0,0 +1,85 @@
+import time
+
+from unittest import mock
+
+import pytest
+
+from kubesae import kube
+from kubesae.utils import scale_app
+
+
+@pytest.fixture
+def namespace(c):
+    c.config.namespace = "myproject-staging"
+    c.config.container_name = "myproject-web"
+    c.config.kube = {"api": False}
+    return c.config.namespace
+
+
+def workload(replicas, ready, generation=1, observed=1):
+    return {
+        "metadata": {"generation": generation, "resourceVersion": "1"},
+        "spec": {"selector": {"matchLabels": {"app": "web"}}},
+        "status": {
+            "observedGeneration": observed,
+            "replicas": replicas,
+            "readyReplicas": ready,
+        },
+    }
+
+
+def test_rolled_out():
+    assert kube.rolled_out(workload(2, 2), 2)
+    assert not kube.rolled_out(workload(2, 1), 2)
+    assert not kube.rolled_out(workload(2, 2, generation=2), 2)
+    assert kube.rolled_out(workload(0, 0), 0)
+
+
+def test_wait_for_rollout__watches_until_ready():
+    client = mock.Mock()
+    client.get.return_value = workload(2, 0)
+    client.watch.return_value = iter(
+        [("MODIFIED", workload(2, 1)), ("MODIFIED", workload(2, 2))]
+    )
+    kube.wait_for_rollout(client, "ns", "deployments", "web", 2, time.monotonic() + 10)
+    assert client.watch.call_count == 1
+    assert client.watch.call_args.kwargs["fieldSelector"] == "metadata.name=web"
+
+
+def test_wait_for_rollout__scale_down_waits_for_pods():
+    client = mock.Mock()
+    pods = {
+        "metadata": {"resourceVersion": "5"},
+        "items": [{"metadata": {"name": "web-1"}}],
+    }
+    client.get.side_effect = [workload(0, 0), pods]
+    client.watch.return_value = iter(
+        [("DELETED", {"metadata": {"name": "web-1", "resourceVersion": "6"}})]
+    )
+    kube.wait_for_rollout(client, "ns", "deployments", "web", 0, time.monotonic() + 10)
+    assert client.watch.call_args.kwargs["labelSelector"] == "app=web"
+
+
+def test_wait_for_rollout__timeout():
+    client = mock.Mock()
+    client.get.return_value = workload(2, 0)
+    with pytest.raises(TimeoutError):
+        kube.wait_for_rollout(client, "ns", "deployments", "web", 2, time.monotonic())
+
+
+def test_scale_app__celery(c, namespace):
+    scale_app(c, down=True, celery=True)
+    commands = sorted(call.args[0] for call in c.run.call_args_list)
+    assert commands == [
+        f"kubectl scale -n {namespace} deployment/celery-worker --replicas=0",
+        f"kubectl scale -n {namespace} deployment/myproject-web --replicas=0",
+        f"kubectl scale -n {namespace} statefulset/celery-beat --replicas=0",
+    ]
+
+
+def test_scale_app__wait(c, namespace):
+    scale_app(c, container_count=3, wait=True, timeout=60)
+    commands = [call.args[0] for call in c.run.call_args_list]
+    assert commands[1].startswith(
+        f"kubectl rollout status -n {namespace} deployment/myproject-web"
+    )